@@ -0,0 +1,58 @@
+'''
+Compares the JSON codecs available to pycivi on large Contact.get replies.
+
+Usage:
+    python benchmark_codec.py                   # synthetic reply with 20000 contacts
+    python benchmark_codec.py reply1.json ...   # recorded raw API replies
+'''
+import sys
+import json
+import time
+import random
+
+from pycivi import json_codec
+
+ROUNDS = 5
+
+
+def synthetic_reply(count):
+    values = list()
+    for i in range(count):
+        values.append({
+            'id': str(i), 'contact_id': str(i), 'contact_type': 'Individual', 'contact_sub_type': '',
+            'sort_name': 'Müller, Jörg %d' % i, 'display_name': 'Jörg Müller %d' % i,
+            'first_name': 'Jörg', 'last_name': 'Müller', 'external_identifier': 'EXT-%08d' % i,
+            'email': 'joerg.mueller%d@example.org' % i, 'phone': '+49 30 %07d' % random.randint(0, 9999999),
+            'street_address': 'Hauptstraße %d' % (i % 200), 'postal_code': '%05d' % (i % 99999),
+            'city': 'Berlin', 'country_id': '1082', 'is_deleted': '0', 'is_opt_out': '0',
+            'birth_date': '1970-01-01', 'created_date': '2013-01-01 12:00:00', 'modified_date': '2016-01-01 12:00:00',
+        })
+    return json.dumps({'is_error': 0, 'version': 3, 'count': count, 'values': values}).encode('utf-8')
+
+
+def measure(function, payload):
+    timestamp = time.time()
+    for i in range(ROUNDS):
+        function(payload)
+    return (time.time() - timestamp) / ROUNDS
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        payloads = [(path, open(path, 'rb').read()) for path in sys.argv[1:]]
+    else:
+        payloads = [('synthetic Contact.get (20000 rows)', synthetic_reply(20000))]
+
+    codecs = [json_codec.StdlibCodec()]
+    if json_codec.ujson:
+        codecs.append(json_codec.UjsonCodec())
+    if json_codec.orjson:
+        codecs.append(json_codec.OrjsonCodec())
+
+    for name, payload in payloads:
+        print("%s: %.1f MB" % (name, len(payload) / 1048576.0))
+        runtime = measure(lambda data: json.loads(data.decode('utf-8')), payload)
+        print("  %-32s %8.1f ms" % ('json.loads(reply.text) [old]', runtime * 1000))
+        for codec in codecs:
+            runtime = measure(codec.loads, payload)
+            print("  %-32s %8.1f ms" % ('%s.loads(reply.content)' % codec.name, runtime * 1000))
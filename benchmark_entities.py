@@ -0,0 +1,67 @@
+'''
+Measures the memory and time it takes to wrap Contact.get rows in entity
+objects: entities with a per-instance __dict__ (the old behaviour),
+entities with __slots__, and raw dicts (getEntities/iterEntities with raw=True).
+
+Usage:
+    python benchmark_entities.py            # 1000000 rows
+    python benchmark_entities.py <rows>
+'''
+import sys
+import time
+import tracemalloc
+
+from pycivi.CiviCRM import CiviCRM
+from pycivi.CiviEntity import CiviContactEntity
+
+
+class DictEntity:
+    """
+    the entity object as it was before: attributes in __dict__
+    """
+    def __init__(self, entity_type, entity_id, civicrm, attributes=dict()):
+        self.entity_type = entity_type
+        self.attributes = attributes
+        self.civicrm = civicrm
+        self.attributes['id'] = entity_id
+
+
+class BenchmarkCiviCRM(CiviCRM):
+    def __init__(self):
+        pass
+
+
+def rows(count):
+    return [{'id': str(i), 'contact_type': 'Individual', 'display_name': 'Contact %d' % i,
+             'external_identifier': 'EXT-%08d' % i, 'is_deleted': '0'} for i in range(count)]
+
+
+def measure(wrap, count):
+    """
+    returns the memory (bytes) and time (seconds) used for wrapping count rows
+    """
+    data = rows(count)
+    tracemalloc.start()
+    timestamp = time.time()
+    wrapped = wrap(data)
+    runtime = time.time() - timestamp
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del wrapped
+    return size, runtime
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    civicrm = BenchmarkCiviCRM()
+
+    candidates = [
+        ('entities with __dict__ [old]', lambda data: [DictEntity('Contact', row.get('id', None), civicrm, row) for row in data]),
+        ('entities with __slots__', lambda data: [civicrm._createEntity('Contact', row) for row in data]),
+        ('raw dicts', lambda data: list(data)),
+    ]
+
+    print("%d Contact rows, %d bytes per entity with __slots__" % (count, sys.getsizeof(CiviContactEntity('Contact', '1', civicrm, {}))))
+    for name, wrap in candidates:
+        size, runtime = measure(wrap, count)
+        print("  %-32s %8.1f MB %8.1f ms" % (name, size / 1048576.0, runtime * 1000))
@@ -0,0 +1,71 @@
+'''
+Compares the calls per second of CiviCRM_REST with pooled keep-alive
+connections against the old behaviour of a new connection per call.
+
+Usage:
+    python benchmark_rest.py                              # local stand-in server
+    python benchmark_rest.py <url> <site_key> <user_key>  # real CiviCRM
+'''
+import sys
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pycivi.CiviCRM_REST import CiviCRM_REST
+
+CALLS = 500
+THREADS = 4
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _reply(self):
+        body = json.dumps({'is_error': 0, 'count': 1, 'values': [{'id': '1', 'contact_id': '1'}]}).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._reply()
+
+    def log_message(self, *args):
+        pass
+
+
+def run(civi, calls, threads):
+    def worker(count):
+        for i in range(count):
+            civi.performAPICall({'entity': 'Contact', 'action': 'get', 'id': i})
+
+    thread_list = [threading.Thread(target=worker, args=(calls // threads,)) for i in range(threads)]
+    timestamp = time.time()
+    for thread in thread_list:
+        thread.start()
+    for thread in thread_list:
+        thread.join()
+    return (calls // threads * threads) / (time.time() - timestamp)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4:
+        url, site_key, user_key = sys.argv[1:]
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:%d/sites/all/modules/civicrm/extern/rest.php' % server.server_address[1]
+        site_key, user_key = 'site_key', 'user_key'
+
+    for keep_alive in [False, True]:
+        civi = CiviCRM_REST(url, site_key, user_key, keep_alive=keep_alive, pool_size=THREADS)
+        civi._logger.setLevel('WARN')
+        rate = run(civi, CALLS, THREADS)
+        print("keep_alive=%s: %.1f calls/s (%d calls, %d threads)" % (keep_alive, rate, CALLS, THREADS))
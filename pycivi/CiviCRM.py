@@ -38,21 +38,42 @@ import time
 import threading
 import os
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from .CiviEntity import *
+from . import json_codec
+from .CiviLookupCache import LookupCache, SQLiteLookupStore, MISSING
 
 class CiviAPIException(Exception):
     pass
 
 class CiviCRM:
 
+    CASEFOLD_NAMESPACES = ['option_group', 'option_value', 'option_value_id', 'location_type2id', 'membership_status2id',
+                           'membership_type2id', 'financial_type2id', 'custom_group', 'custom_field', 'custom_field_optiongroup',
+                           'custom_field_of_type', 'campaign', 'tag', 'group']
+
     def __init__(self, url, site_key, user_key, logfile=None):
         raise Exception("You probably meant to call the REST core of the API. Try CiviCRM_REST.CiviCRM_REST(...) instead of CiviCRM.CiviCRM(...)!")
 
     def __init__(self, logfile=None):
         # init some attributes
-        self.lookup_cache = dict()
-        self.lookup_cache_lock = threading.Condition()
+        self.lookup_cache = LookupCache()
+        # metadata is looked up by name, case insensitively like MySQL compares them
+        for namespace in self.CASEFOLD_NAMESPACES:
+            self.lookup_cache.configure(namespace, casefold=True)
+        # option values might get created, so don't remember they're missing
+        self.lookup_cache.configure('option_value_id', negative_ttl=0)
+        # resolved contacts (see getContactID), misses expire quickly. Contacts deleted
+        # or merged by our calls are forgotten right away (see _callCompleted), the
+        # ones changed by others after ttl
+        self.lookup_cache.configure('contact', max_size=100000, ttl=600, negative_ttl=0, persistent=False, index_values=True)
+        self.lookup_cache.configure('contact_missing', max_size=100000, ttl=60, persistent=False)
+        # tags and groups get created, see getOrCreateTagIDs/getOrCreateGroupIDs
+        self.lookup_cache.configure('tag', negative_ttl=0)
+        self.lookup_cache.configure('group', negative_ttl=0)
+        self.lookup_store = None
+        self._create_lock = threading.Lock()
 
         # set up logging
         self.logger_format = "%(level)s;%(type)s;%(entity_type)s;%(first_id)s;%(second_id)s;%(duration)sms;%(thread_id)s;%(text)s"
@@ -86,6 +107,9 @@ class CiviCRM:
         self.api_version = 3
         self._api_calls = 0
         self._api_calls_time = 0.0
+        self._api_errors = 0
+        self._api_stats_lock = threading.Lock()
+        self.codec = json_codec.getCodec()
 
 
     def _getLevelString(self, level):
@@ -134,10 +158,58 @@ class CiviCRM:
         self.log(message + exception_text, level, type, command, entity_type, first_id, second_id, duration)
 
 
-    def performAPICall(self, params=dict()):
+    def _countCalls(self, runtime, calls=1):
+        """
+        record completed API calls (thread safe)
+        """
+        with self._api_stats_lock:
+            self._api_calls += calls
+            self._api_calls_time += runtime
+
+    def _countError(self):
+        """
+        record a failed API call: an error reply, or no reply at all (thread safe)
+        """
+        with self._api_stats_lock:
+            self._api_errors += 1
+
+    def getCallStats(self):
+        """
+        get the number of API calls, their total runtime and the number of failed calls
+        """
+        with self._api_stats_lock:
+            return (self._api_calls, self._api_calls_time, self._api_errors)
+
+
+    def performAPICall(self, params=dict(), execParams=dict()):
         raise NotImplementedError("You need to use a CiviCRM implementation like CiviCRM_DRUSH or CiviCRM_REST!")
 
 
+    def performAPICalls(self, list_of_params, batch_size=None):
+        """
+        run a list of API calls, returning the results in the same order.
+
+        A failing call doesn't affect the others, its result is an API
+        error reply (is_error set). Implementations may override this to
+        send batch_size calls at once.
+        """
+        results = list()
+        for params in list_of_params:
+            try:
+                results.append(self.performAPICall(params))
+            except Exception as err:
+                results.append({'is_error': 1, 'error_message': str(err)})
+        return results
+
+
+    def setPoolSize(self, pool_size):
+        """
+        adjust the number of connections the implementation keeps open
+        for concurrent callers. Ignored by implementations without a pool.
+        """
+        pass
+
+
     def probe(self):
         # check by calling get contact
         try:
@@ -192,7 +264,11 @@ class CiviCRM:
             return None
 
 
-    def getEntities(self, entity_type, attributes, primary_attributes=['id', 'external_identifier']):
+    def getEntities(self, entity_type, attributes, primary_attributes=['id', 'external_identifier'], raw=False):
+        """
+        get all entities matching the primary attributes.
+        If raw is set, the plain attribute dicts are returned instead of entity objects
+        """
         timestamp = time.time()
 
         query = dict()
@@ -216,17 +292,107 @@ class CiviCRM:
         entities = list()
         self.log("Entities found: %s" % result['count'],
             logging.DEBUG, 'pycivi', 'get', entity_type, first_key, None, time.time()-timestamp)
-        if isinstance(result['values'], dict):
-            for entity_id in result['values']:
-                entity = self._createEntity(entity_type, result['values'][entity_id])
-                entities.append(entity)
-        else:
-            for entity_data in result['values']:
-                entity = self._createEntity(entity_type, entity_data)
-                entities.append(entity)
+        values = result['values']
+        if isinstance(values, dict):
+            values = list(values.values())
+        if raw:
+            return values
+        for entity_data in values:
+            entity = self._createEntity(entity_type, entity_data)
+            entities.append(entity)
         return entities
 
 
+    def chain(self, entity_type, action, params=dict()):
+        """
+        start a chained API call, that will be sent as one request, e.g.
+
+            contact, emails = civicrm.chain('Contact', 'create', contact_data) \
+                                     .then('Email', 'create', {'email': email}) \
+                                     .execute()
+
+        the chained calls will automatically refer to the main entity
+        (here: contact_id), other references can be passed as '$value.<field>'
+        """
+        return CiviChain(self, entity_type, action, params)
+
+
+    def iterEntities(self, entity_type, filters=dict(), page_size=1000, return_fields=None, prefetch=False, raw=False):
+        """
+        Iterate over all entities matching the given filters, fetching page_size entities per call.
+        If raw is set, the plain attribute dicts are yielded instead of entity objects.
+
+        Pages are selected by id (keyset), or by offset if the filters already restrict the id.
+        If prefetch is set, the next page will be fetched in the background while
+        the current one is being processed.
+        """
+        keyset = 'id' not in filters
+        if return_fields is not None:
+            return_fields = list(return_fields)
+            if keyset and 'id' not in return_fields:
+                return_fields.append('id')
+
+        def next_cursor(cursor, page):
+            if keyset:
+                return page[-1]['id']
+            else:
+                return cursor + len(page)
+
+        executor = ThreadPoolExecutor(1) if prefetch else None
+        try:
+            cursor = None if keyset else 0
+            if executor:
+                pending = executor.submit(self._fetchPage, entity_type, filters, cursor, keyset, page_size, return_fields)
+            while True:
+                if executor:
+                    page = pending.result()
+                else:
+                    page = self._fetchPage(entity_type, filters, cursor, keyset, page_size, return_fields)
+                last_page = len(page) < page_size
+                if not last_page:
+                    cursor = next_cursor(cursor, page)
+                    if executor:
+                        pending = executor.submit(self._fetchPage, entity_type, filters, cursor, keyset, page_size, return_fields)
+
+                if raw:
+                    for entity_data in page:
+                        yield entity_data
+                else:
+                    for entity_data in page:
+                        yield self._createEntity(entity_type, entity_data)
+
+                if last_page:
+                    break
+        finally:
+            if executor:
+                executor.shutdown(wait=False)
+
+
+    def _fetchPage(self, entity_type, filters, cursor, keyset, page_size, return_fields):
+        timestamp = time.time()
+        query = dict(filters)
+        query['entity'] = entity_type
+        query['action'] = 'get'
+        query['options'] = {'limit': page_size, 'sort': 'id ASC'}
+        if keyset:
+            if cursor is not None:
+                query['id'] = {'>': cursor}
+        else:
+            query['options']['offset'] = cursor
+        if return_fields is not None:
+            query['return'] = return_fields
+
+        result = self.performAPICall(query, {'json_parameters': True})
+        if result['is_error']:
+            raise CiviAPIException(result['error_message'])
+        page = result['values']
+        if isinstance(page, dict):
+            page = list(page.values())
+        self.log("Fetched page of %d entities." % len(page),
+            logging.DEBUG, 'pycivi', 'get', entity_type, cursor, None, time.time()-timestamp)
+        return page
+
+
     def createEntity(self, entity_type, attributes):
         """
         simply creates a new entity of the given type
@@ -238,6 +404,8 @@ class CiviCRM:
         result = self.performAPICall(query)
         if result['is_error']:
             raise CiviAPIException(result['error_message'])
+        if entity_type == etype.CONTACT:
+            self._contactCreated(dict(query, **result['values'][0]))
         return self._createEntity(entity_type, result['values'][0])
 
 
@@ -278,9 +446,12 @@ class CiviCRM:
                 if result['is_error']:
                     raise CiviAPIException(result['error_message'])
                 if isinstance(result['values'], dict):
-                    return self._createEntity(entity_type, result['values'][str(result['id'])])
+                    entity = self._createEntity(entity_type, result['values'][str(result['id'])])
                 else:
-                    return self._createEntity(entity_type, result['values'][0])
+                    entity = self._createEntity(entity_type, result['values'][0])
+                if entity_type == etype.CONTACT:
+                    self._contactCreated(dict(query, **entity.attributes))
+                return entity
 
 
     def createIfNotExists(self, entity_type, attributes, primary_attributes=['id', 'external_identifier']):
@@ -313,9 +484,12 @@ class CiviCRM:
             if result['is_error']:
                 raise CiviAPIException(result['error_message'])
             if isinstance(result['values'], dict):
-                return self._createEntity(entity_type, result['values'][str(result['id'])])
+                entity = self._createEntity(entity_type, result['values'][str(result['id'])])
             else:
-                return self._createEntity(entity_type, result['values'][0])
+                entity = self._createEntity(entity_type, result['values'][0])
+            if entity_type == etype.CONTACT:
+                self._contactCreated(dict(query, **entity.attributes))
+            return entity
 
 
     ###########################################################################
@@ -324,12 +498,75 @@ class CiviCRM:
 
 
     def getContactID(self, attributes, primary_attributes=['external_identifier'], search_deleted=True):
-        timestamp = time.time()
+        """
+        Resolve the contact ID with the given primary attributes.
+
+        The results are kept in an LRU cache ('contact' namespace), misses for
+        a minute ('contact_missing'). Creating a contact clears the misses it
+        matches, deleting one removes the entries pointing to it.
+        """
         if 'id' in attributes:
             return attributes['id']
         elif 'contact_id' in attributes:
             return attributes['contact_id']
 
+        cache_key = self._getContactCacheKey(attributes, primary_attributes, search_deleted)
+        if not cache_key[0]:
+            return self._resolveContactID(attributes, primary_attributes, search_deleted)
+
+        contact_id = self.lookup_cache.get('contact_missing', cache_key, MISSING)
+        if contact_id is not MISSING:
+            return contact_id
+        contact_id = self.lookup_cache.lookup('contact', cache_key,
+            lambda: self._resolveContactID(attributes, primary_attributes, search_deleted))
+        if not contact_id:
+            self.lookup_cache.set('contact_missing', cache_key, contact_id)
+        return contact_id
+
+
+    def _getContactCacheKey(self, attributes, primary_attributes, search_deleted):
+        return (tuple((key, str(attributes[key])) for key in primary_attributes if key in attributes), search_deleted)
+
+
+    def _contactCreated(self, attributes):
+        """
+        a contact with the given attributes has been created, so the cached
+        misses it matches are wrong now. Attributes that aren't known
+        are assumed to match.
+        """
+        attributes = dict((key, str(value).lower()) for key, value in attributes.items() if value is not None)
+        def matches(cache_key, contact_id):
+            for key, value in cache_key[0]:
+                if key in attributes and attributes[key] != value.lower():
+                    return False
+            return True
+        self.lookup_cache.discard('contact_missing', matches)
+
+
+    def _contactDeleted(self, contact_id):
+        """
+        a contact has been deleted, remove the resolutions pointing to it
+        """
+        self.lookup_cache.discardValue('contact', str(contact_id))
+
+
+    def _callCompleted(self, entity, action, params):
+        """
+        called by the implementations for every successful API call, to
+        keep the lookup cache in line with the changes it made: contacts
+        deleted or merged into another one are forgotten
+        """
+        if str(entity).lower() != 'contact':
+            return
+        action = str(action).lower()
+        if action == 'delete' and params.get('id'):
+            self._contactDeleted(params['id'])
+        elif action == 'merge' and params.get('to_remove_id'):
+            self._contactDeleted(params['to_remove_id'])
+
+
+    def _resolveContactID(self, attributes, primary_attributes, search_deleted):
+        timestamp = time.time()
         query = dict()
         first_key = None
         for key in primary_attributes:
@@ -364,13 +601,65 @@ class CiviCRM:
                 new_primary_attributes = list(primary_attributes)
                 new_attributes['is_deleted'] = '1'
                 new_primary_attributes += ['is_deleted']
-                return self.getContactID(new_attributes, new_primary_attributes, search_deleted)
+                return self._resolveContactID(new_attributes, new_primary_attributes, search_deleted)
             #print "STILL NOT FOUND!"
             self.log("Contact not found.",
                 logging.DEBUG, 'pycivi', 'get', 'Contact', first_key, None, time.time()-timestamp)
             return 0
 
 
+    def getContactIDs(self, external_identifiers, search_deleted=True, chunk_size=500):
+        """
+        Resolve a whole list of external identifiers with one 'IN' query per chunk.
+        If search_deleted is set, the deleted contacts are searched by the same
+        query, the ones not deleted are preferred.
+
+        Returns a dict external_identifier => contact ID (0 if not found).
+        The results are cached, so getContactID will not query them again.
+        """
+        timestamp = time.time()
+        # remove duplicates, keeping the order
+        identifiers = list(dict.fromkeys(external_identifier for external_identifier in external_identifiers if external_identifier))
+
+        contact_ids = dict()
+        for i in range(0, len(identifiers), chunk_size):
+            query = { 'entity': 'Contact',
+                      'action': 'get',
+                      'external_identifier': {'IN': identifiers[i:i+chunk_size]},
+                      'is_deleted': {'IN': ['0', '1']} if search_deleted else '0',
+                      'return': 'id,external_identifier,is_deleted',
+                      'options': {'limit': 0},
+                      }
+            result = self.performAPICall(query, {'json_parameters': True})
+            if result['is_error']:
+                raise CiviAPIException(result['error_message'])
+            deleted = set()
+            for contact in result['values']:
+                external_identifier = contact['external_identifier']
+                if str(contact.get('contact_is_deleted', contact.get('is_deleted', '0'))) == '1':
+                    if external_identifier not in contact_ids:
+                        contact_ids[external_identifier] = contact['id']
+                        deleted.add(external_identifier)
+                elif external_identifier not in contact_ids or external_identifier in deleted:
+                    contact_ids[external_identifier] = contact['id']
+                    deleted.discard(external_identifier)
+
+        for external_identifier in identifiers:
+            contact_ids.setdefault(external_identifier, 0)
+
+        # store values
+        for external_identifier, contact_id in contact_ids.items():
+            cache_key = self._getContactCacheKey({'external_identifier': external_identifier}, ['external_identifier'], search_deleted)
+            if contact_id:
+                self.lookup_cache.set('contact', cache_key, contact_id)
+            else:
+                self.lookup_cache.set('contact_missing', cache_key, contact_id)
+
+        self.log("Resolved %d of %d external identifiers." % (len([c for c in contact_ids.values() if c]), len(identifiers)),
+            logging.DEBUG, 'pycivi', 'get', 'Contact', None, None, time.time()-timestamp)
+        return contact_ids
+
+
     def getEntityID(self, attributes, entity_type, primary_attributes):
         timestamp = time.time()
         if 'id' in attributes:
@@ -406,174 +695,333 @@ class CiviCRM:
             logging.DEBUG, 'pycivi', 'get', 'Entity', first_key, None, time.time()-timestamp)
         return 0
 
-    def getCampaignID(self, attribute_value, attribute_key='title'):
-        """
-        Get the ID for a given campaign
+    PRELOAD_TABLES = ['option_groups', 'option_values', 'location_types', 'membership_statuses', 'membership_types',
+                      'financial_types', 'custom_groups', 'custom_fields', 'campaigns']
+    PRELOAD_ENTITIES = {'option_groups': 'OptionGroup', 'option_values': 'OptionValue', 'location_types': 'LocationType',
+                        'membership_statuses': 'MembershipStatus', 'membership_types': 'MembershipType',
+                        'financial_types': 'FinancialType', 'custom_groups': 'CustomGroup', 'custom_fields': 'CustomField',
+                        'campaigns': 'Campaign', 'tags': 'Tag', 'groups': 'Group'}
 
-        Results will be cached
+    def preload(self, tables=PRELOAD_TABLES, complete=True, page_size=1000, validate=True, validate_interval=3600):
+        """
+        Fill the lookup cache with whole metadata tables (see PRELOAD_TABLES),
+        fetched page by page, so the getters (getOptionValue, getLocationTypeID,
+        getCustomFieldID, ...) don't have to query them one by one.
+
+        If complete is set, the preloaded namespaces are marked complete:
+        names not found there resolve to 0 without an API call. Like MySQL,
+        names are matched case insensitively (see CASEFOLD_NAMESPACES).
+        Campaigns are never marked complete, they're created during imports.
+        Tags and groups (not preloaded by default) can be, as getOrCreateTagIDs
+        and getOrCreateGroupIDs (like getOrCreatePrefix and getOrCreateGreeting)
+        look the names missing there up again before creating them.
+
+        With a lookup store (see useLookupStore), tables loaded by an earlier
+        run are not fetched again. If validate is set, they are checked with
+        a single 'getcount' call once validate_interval seconds have passed,
+        and reloaded if the number of entities has changed. Until then, another
+        process might have added entities, so the namespaces are only complete
+        until the next validation is due.
         """
         timestamp = time.time()
-        if 'campaign' in self.lookup_cache and attribute_key in self.lookup_cache['campaign'] and attribute_value in self.lookup_cache['campaign'][attribute_key]:
-            return self.lookup_cache['campaign'][attribute_key][attribute_value]
+        def name(entity):
+            return [entity.get('name')]
+
+        def entity_id(entity):
+            return entity.get('id')
+
+        for table in tables:
+            if table not in self.PRELOAD_ENTITIES:
+                raise ValueError("Unknown metadata table '%s'" % table)
+            entity_type = self.PRELOAD_ENTITIES[table]
+            if self._preloadFromStore(table, complete, validate, validate_interval):
+                continue
+
+            if table == 'option_groups':
+                mappings = [('option_group', name, entity_id, 'zero')]
+                return_fields = ['name']
+            elif table == 'option_values':
+                key = lambda entity: [(str(entity.get('option_group_id')), entity.get('name'))]
+                mappings = [('option_value', key, lambda entity: entity.get('value'), 'zero'),
+                            ('option_value_id', key, entity_id, 'first')]
+                return_fields = ['option_group_id', 'name', 'value']
+            elif table == 'location_types':
+                mappings = [('location_type2id', name, entity_id, 'skip')]
+                return_fields = ['name']
+            elif table == 'membership_statuses':
+                mappings = [('membership_status2id', name, entity_id, 'skip')]
+                return_fields = ['name']
+            elif table == 'membership_types':
+                mappings = [('membership_type2id', name, entity_id, 'skip')]
+                return_fields = ['name']
+            elif table == 'financial_types':
+                mappings = [('financial_type2id', name, entity_id, 'skip')]
+                return_fields = ['name']
+            elif table == 'custom_groups':
+                mappings = [('custom_group', lambda entity: [entity.get('title')], entity_id, 'zero')]
+                return_fields = ['title']
+            elif table == 'custom_fields':
+                group_titles = dict((group.get('id'), group.get('title')) for group in self.iterEntities('CustomGroup', page_size=page_size, return_fields=['title'], raw=True))
+                field_keys = lambda entity: [('label', entity.get('label')), ('name', entity.get('name')),
+                                             ('group', group_titles.get(entity.get('custom_group_id')), entity.get('label'))]
+                mappings = [('custom_field', field_keys, entity_id, 'zero'),
+                            ('custom_field_optiongroup', lambda entity: [entity.get('label')], lambda entity: entity.get('option_group_id', 0) or 0, 'zero')]
+                return_fields = ['label', 'name', 'custom_group_id', 'option_group_id']
+            elif table == 'campaigns':
+                mappings = [('campaign', lambda entity: [('title', entity.get('title')), ('name', entity.get('name'))], entity_id, 'zero')]
+                return_fields = ['title', 'name']
+            elif table == 'tags':
+                mappings = [('tag', name, entity_id, 'skip')]
+                return_fields = ['name']
+            elif table == 'groups':
+                mappings = [('group', lambda entity: [entity.get('title')], entity_id, 'skip')]
+                return_fields = ['title']
+
+            loaded, count = self._preloadTable(entity_type, return_fields, page_size, mappings)
+            if table == 'campaigns':
+                loaded = list()
+            if complete:
+                for namespace in loaded:
+                    self.lookup_cache.setComplete(namespace, ttl=self._getCompleteTTL(validate, validate_interval))
+            if self.lookup_store is not None:
+                self.lookup_store.setTable(table, entity_type, count, {'all': [mapping[0] for mapping in mappings], 'complete': loaded})
+
+        self.log("Preloaded %s." % ', '.join(tables),
+            logging.INFO, 'pycivi', 'preload', None, None, None, time.time()-timestamp)
+
+
+    def _preloadFromStore(self, table, complete, validate, validate_interval):
+        """
+        check if the table has been preloaded into the lookup store before
+        (and is still valid), returns True if it doesn't have to be loaded
+        """
+        if self.lookup_store is None:
+            return False
+        info = self.lookup_store.getTable(table)
+        if info is None:
+            return False
 
-        query = dict()
-        query['entity'] = 'Campaign'
-        query['action'] = 'get'
-        query[attribute_key] = attribute_value
-        result = self.performAPICall(query)
-        if result['count']>1:
-            campaign_id = 0
-            self.log("More than one campaign found with %s '%s'!" % (attribute_key, attribute_value),
-                logging.WARN, 'pycivi', 'getCampaignID', 'Campaign', None, None, time.time()-timestamp)
-        elif result['count']==0:
-            campaign_id = 0
-            self.log("No campaign found with %s '%s'!" % (attribute_key, attribute_value),
-                logging.DEBUG, 'pycivi', 'getCampaignID', 'Campaign', None, None, time.time()-timestamp)
-        else:
-            campaign_id = result['values'][0]['id']
-            self.log("Campaign with %s '%s' resolved to ID %s!" % (attribute_key, attribute_value, campaign_id),
-                logging.DEBUG, 'pycivi', 'getCampaignID', 'Campaign', None, None, time.time()-timestamp)
+        if validate and time.time() - info['checked'] >= validate_interval:
+            if self.getEntityCount(info['entity_type']) != info['count']:
+                self.log("Metadata table '%s' has changed, reloading." % table,
+                    logging.INFO, 'pycivi', 'preload', info['entity_type'], None, None, 0)
+                for namespace in info['namespaces']['all']:
+                    self.lookup_cache.clear(namespace)
+                self.lookup_store.dropTable(table)
+                return False
+            self.lookup_store.touchTable(table)
+            info = self.lookup_store.getTable(table)
+
+        if complete:
+            ttl = self._getCompleteTTL(validate, validate_interval - (time.time() - info['checked']))
+            for namespace in info['namespaces']['complete']:
+                self.lookup_cache.setComplete(namespace, ttl=ttl)
+        return True
+
+
+    def _getCompleteTTL(self, validate, validate_interval):
+        """
+        the time preloaded namespaces stay complete: with a lookup store
+        (validated by preload), until the next validation is due
+        """
+        if self.lookup_store is None or not validate:
+            return None
+        return max(0.0, validate_interval)
 
-        # store value
-        self.lookup_cache_lock.acquire()
-        if 'campaign' not in self.lookup_cache:
-            self.lookup_cache['campaign'] = dict()
-        if attribute_key not in self.lookup_cache['campaign']:
-            self.lookup_cache['campaign'][attribute_key] = dict()
-        self.lookup_cache['campaign'][attribute_key][attribute_value] = campaign_id
-        self.lookup_cache_lock.notifyAll()
-        self.lookup_cache_lock.release()
 
-        return campaign_id
+    def _preloadTable(self, entity_type, return_fields, page_size, mappings):
+        """
+        store all entities of the type in the lookup cache.
 
+        mappings is a list of (namespace, keys function, value function, duplicates),
+        with duplicates saying what happens if a key matches more than one entity,
+        in line with the getters: 'first' uses the first one, 'zero' stores 0, and
+        'skip' leaves it to the getter (which will complain).
 
-    def getCustomFieldID(self, field_name, entity_type='Contact', use_label=True):
+        Returns the namespaces that are now completely loaded, and the number of entities
         """
-        Get the ID for a given custom field
+        count = 0
+        collected = [dict() for mapping in mappings]
+        for entity in self.iterEntities(entity_type, page_size=page_size, return_fields=return_fields, raw=True):
+            count += 1
+            for (namespace, keys, value, duplicates), values in zip(mappings, collected):
+                for key in keys(entity):
+                    # names only differing in case are duplicates as well
+                    key = self.lookup_cache.storedKey(namespace, key)
+                    values.setdefault(key, list()).append(value(entity))
+
+        loaded = list()
+        for (namespace, keys, value, duplicates), values in zip(mappings, collected):
+            skipped = False
+            items = list()
+            for key, key_values in values.items():
+                if len(key_values) == 1 or duplicates == 'first':
+                    items.append((key, key_values[0]))
+                elif duplicates == 'zero':
+                    items.append((key, 0))
+                else:
+                    self.lookup_cache.delete(namespace, key)
+                    skipped = True
+            self.lookup_cache.setMany(namespace, items)
+            if not skipped:
+                loaded.append(namespace)
+        return loaded, count
+
+
+    def useLookupStore(self, path, site=None):
         """
-        timestamp = time.time()
-        if 'custom_field' in self.lookup_cache and field_name in self.lookup_cache['custom_field']:
-            return self.lookup_cache['custom_field'][field_name]
+        keep the lookup cache in the SQLite database at path, so the resolved
+        IDs are shared by subsequent runs and other processes. The entries
+        are kept per site, by default the one returned by getSiteIdentifier()
+        """
+        self.lookup_store = SQLiteLookupStore(path, site or self.getSiteIdentifier())
+        self.lookup_cache.attachStore(self.lookup_store)
 
-        query = dict()
-        query['entity'] = 'CustomField'
-        query['action'] = 'get'
-        if use_label:
-            query['label'] = field_name
-        else:
-            query['name'] = field_name
+
+    def getSiteIdentifier(self):
+        """
+        identifies the CiviCRM instance, e.g. for the lookup store
+        """
+        return self.__class__.__name__
+
+
+    def getEntityCount(self, entity_type, filters=dict()):
+        """
+        get the number of entities matching the filters, with a single API call
+        """
+        query = dict(filters)
+        query['entity'] = entity_type
+        query['action'] = 'getcount'
         result = self.performAPICall(query)
-        if result['count']>1:
-            field_id = 0
-            self.log("More than one custom field found with name '%s'!" % field_name,
-                logging.WARN, 'API', 'get', 'CustomField', None, None, time.time()-timestamp)
-        elif result['count']==0:
-            field_id = 0
-            self.log("Custom field '%s' does not exist." % field_name,
-                logging.DEBUG, 'API', 'get', 'CustomField', None, None, time.time()-timestamp)
-        else:
-            field_id = result['values'][0]['id']
-            self.log("Custom field '%s' resolved to ID %s" % (field_name, field_id),
-                logging.DEBUG, 'API', 'get', 'CustomField', field_id, None, time.time()-timestamp)
+        if isinstance(result, dict):
+            if result.get('is_error', 0):
+                raise CiviAPIException(result['error_message'])
+            result = result.get('result', result.get('count'))
+        return int(result)
 
-        # store value
-        self.lookup_cache_lock.acquire()
-        if 'custom_field' not in self.lookup_cache:
-            self.lookup_cache['custom_field'] = dict()
-        self.lookup_cache['custom_field'][field_name] = field_id
-        self.lookup_cache_lock.notifyAll()
-        self.lookup_cache_lock.release()
 
-        return field_id
+    def getCampaignID(self, attribute_value, attribute_key='title'):
+        """
+        Get the ID for a given campaign
 
+        Results will be cached
+        """
+        def load():
+            timestamp = time.time()
+            query = dict()
+            query['entity'] = 'Campaign'
+            query['action'] = 'get'
+            query[attribute_key] = attribute_value
+            result = self.performAPICall(query)
+            if result['count']>1:
+                campaign_id = 0
+                self.log("More than one campaign found with %s '%s'!" % (attribute_key, attribute_value),
+                    logging.WARN, 'pycivi', 'getCampaignID', 'Campaign', None, None, time.time()-timestamp)
+            elif result['count']==0:
+                campaign_id = 0
+                self.log("No campaign found with %s '%s'!" % (attribute_key, attribute_value),
+                    logging.DEBUG, 'pycivi', 'getCampaignID', 'Campaign', None, None, time.time()-timestamp)
+            else:
+                campaign_id = result['values'][0]['id']
+                self.log("Campaign with %s '%s' resolved to ID %s!" % (attribute_key, attribute_value, campaign_id),
+                    logging.DEBUG, 'pycivi', 'getCampaignID', 'Campaign', None, None, time.time()-timestamp)
+            return campaign_id
 
-    def getCustomGroupID(self, group_name):
+        return self.lookup_cache.lookup('campaign', (attribute_key, attribute_value), load)
+
+
+    def getCustomFieldID(self, field_name, entity_type='Contact', use_label=True):
         """
         Get the ID for a given custom field
         """
-        timestamp = time.time()
-        if 'custom_group' in self.lookup_cache and group_name in self.lookup_cache['custom_group']:
-            return self.lookup_cache['custom_group'][group_name]
+        attribute_key = 'label' if use_label else 'name'
 
-        query = dict()
-        query['entity'] = 'CustomGroup'
-        query['action'] = 'get'
-        query['title'] = group_name
+        def load():
+            timestamp = time.time()
+            query = dict()
+            query['entity'] = 'CustomField'
+            query['action'] = 'get'
+            query[attribute_key] = field_name
+            result = self.performAPICall(query)
+            if result['count']>1:
+                field_id = 0
+                self.log("More than one custom field found with name '%s'!" % field_name,
+                    logging.WARN, 'API', 'get', 'CustomField', None, None, time.time()-timestamp)
+            elif result['count']==0:
+                field_id = 0
+                self.log("Custom field '%s' does not exist." % field_name,
+                    logging.DEBUG, 'API', 'get', 'CustomField', None, None, time.time()-timestamp)
+            else:
+                field_id = result['values'][0]['id']
+                self.log("Custom field '%s' resolved to ID %s" % (field_name, field_id),
+                    logging.DEBUG, 'API', 'get', 'CustomField', field_id, None, time.time()-timestamp)
+            return field_id
 
-        result = self.performAPICall(query)
-        if result['count']>1:
-            group_id = 0
-            self.log("More than one CustomGroup found with name '%s'!" % group_name,
-                logging.WARN, 'API', 'get', 'CustomGroup', None, None, time.time()-timestamp)
-        elif result['count']==0:
-            group_id = 0
-            self.log("CustomGroup '%s' does not exist." % group_name,
-                logging.DEBUG, 'API', 'get', 'CustomGroup', None, None, time.time()-timestamp)
-        else:
-            group_id = result['values'][0]['id']
-            self.log("CustomGroup '%s' resolved to ID %s" % (group_name, group_id),
-                logging.DEBUG, 'API', 'get', 'CustomGroup', group_id, None, time.time()-timestamp)
+        return self.lookup_cache.lookup('custom_field', (attribute_key, field_name), load)
 
-        # store value
-        self.lookup_cache_lock.acquire()
-        if 'custom_group' not in self.lookup_cache:
-            self.lookup_cache['custom_group'] = dict()
-        self.lookup_cache['custom_group'][group_name] = group_id
-        self.lookup_cache_lock.notifyAll()
-        self.lookup_cache_lock.release()
 
-        return group_id
+    def getCustomGroupID(self, group_name):
+        """
+        Get the ID for a given custom field
+        """
+        def load():
+            timestamp = time.time()
+            query = dict()
+            query['entity'] = 'CustomGroup'
+            query['action'] = 'get'
+            query['title'] = group_name
+
+            result = self.performAPICall(query)
+            if result['count']>1:
+                group_id = 0
+                self.log("More than one CustomGroup found with name '%s'!" % group_name,
+                    logging.WARN, 'API', 'get', 'CustomGroup', None, None, time.time()-timestamp)
+            elif result['count']==0:
+                group_id = 0
+                self.log("CustomGroup '%s' does not exist." % group_name,
+                    logging.DEBUG, 'API', 'get', 'CustomGroup', None, None, time.time()-timestamp)
+            else:
+                group_id = result['values'][0]['id']
+                self.log("CustomGroup '%s' resolved to ID %s" % (group_name, group_id),
+                    logging.DEBUG, 'API', 'get', 'CustomGroup', group_id, None, time.time()-timestamp)
+            return group_id
+
+        return self.lookup_cache.lookup('custom_group', group_name, load)
 
 
     def getCustomFieldIDWithGroupName(self, field_name, group_name):
         """
         Get the ID for a given custom field
         """
-        timestamp = time.time()
-        lookup_name = '{0}__{1}'.format(field_name, group_name)
-        if 'custom_field' in self.lookup_cache and lookup_name in self.lookup_cache['custom_field']:
-            return self.lookup_cache['custom_field'][lookup_name]
-
-        # get group_id
-        group_id = self.getCustomGroupID(group_name)
-        if not group_id:
-            self.lookup_cache_lock.acquire()
-            if 'custom_field' not in self.lookup_cache:
-                self.lookup_cache['custom_field'] = dict()
-            self.lookup_cache['custom_field'][lookup_name] = 0
-            self.lookup_cache_lock.notifyAll()
-            self.lookup_cache_lock.release()
-            return 0
-
-        query = dict()
-        query['entity'] = 'CustomField'
-        query['action'] = 'get'
-        query['custom_group_id'] = group_id
-        query['label'] = field_name
+        def load():
+            timestamp = time.time()
+            # get group_id
+            group_id = self.getCustomGroupID(group_name)
+            if not group_id:
+                return 0
 
-        result = self.performAPICall(query)
-        if result['count']>1:
-            field_id = 0
-            self.log("More than one custom field found with name '%s'!" % field_name,
-                logging.WARN, 'API', 'get', 'CustomField', None, None, time.time()-timestamp)
-        elif result['count']==0:
-            field_id = 0
-            self.log("Custom field '%s' does not exist." % field_name,
-                logging.WARN, 'API', 'get', 'CustomField', None, None, time.time()-timestamp)
-        else:
-            field_id = result['values'][0]['id']
-            self.log("Custom field '%s' resolved to ID %s" % (field_name, field_id),
-                logging.DEBUG, 'API', 'get', 'CustomField', field_id, None, time.time()-timestamp)
+            query = dict()
+            query['entity'] = 'CustomField'
+            query['action'] = 'get'
+            query['custom_group_id'] = group_id
+            query['label'] = field_name
 
-        # store value
-        self.lookup_cache_lock.acquire()
-        if 'custom_field' not in self.lookup_cache:
-            self.lookup_cache['custom_field'] = dict()
-        self.lookup_cache['custom_field'][lookup_name] = field_id
-        self.lookup_cache_lock.notifyAll()
-        self.lookup_cache_lock.release()
+            result = self.performAPICall(query)
+            if result['count']>1:
+                field_id = 0
+                self.log("More than one custom field found with name '%s'!" % field_name,
+                    logging.WARN, 'API', 'get', 'CustomField', None, None, time.time()-timestamp)
+            elif result['count']==0:
+                field_id = 0
+                self.log("Custom field '%s' does not exist." % field_name,
+                    logging.WARN, 'API', 'get', 'CustomField', None, None, time.time()-timestamp)
+            else:
+                field_id = result['values'][0]['id']
+                self.log("Custom field '%s' resolved to ID %s" % (field_name, field_id),
+                    logging.DEBUG, 'API', 'get', 'CustomField', field_id, None, time.time()-timestamp)
+            return field_id
 
-        return field_id
+        return self.lookup_cache.lookup('custom_field', ('group', group_name, field_name), load)
 
 
     def setCustomFieldOptionValue(self, entity_id, field_name, value, entity_type='Contact', create_option_value_if_not_exists=True):
@@ -599,9 +1047,7 @@ class CiviCRM:
             return
 
         # get the associated option group id
-        if 'custom_field_optiongroup' in self.lookup_cache and field_name in self.lookup_cache['custom_field_optiongroup']:
-            option_group_id = self.lookup_cache['custom_field_optiongroup'][field_name]
-        else:
+        def load():
             query = dict()
             query['entity'] = 'CustomField'
             query['action'] = 'get'
@@ -624,15 +1070,9 @@ class CiviCRM:
                 option_group_id = result['values'][0]['option_group_id']
                 self.log("Custom field '%s' resolved to ID %s" % (field_name, field_id),
                     logging.DEBUG, 'API', 'get', 'CustomField', field_id, None, time.time()-timestamp)
+            return option_group_id
 
-            # store value
-            self.lookup_cache_lock.acquire()
-            if 'custom_field_optiongroup' not in self.lookup_cache:
-                self.lookup_cache['custom_field_optiongroup'] = dict()
-            self.lookup_cache['custom_field_optiongroup'][field_name] = option_group_id
-            self.lookup_cache_lock.notifyAll()
-            self.lookup_cache_lock.release()
-
+        option_group_id = self.lookup_cache.lookup('custom_field_optiongroup', field_name, load)
         if not option_group_id:
             self.log("Custom field '%s' cannot be set. Either not found or not a custom_value type." % field_name,
                 logging.WARN, 'API', 'get', 'CustomField', None, None, time.time()-timestamp)
@@ -683,126 +1123,97 @@ class CiviCRM:
         Get the ID for a given option group
         """
         # FIXME: Is there a good reason to set group_id to 0? Such a value will lead to an api-error
-        timestamp = time.time()
-        if 'option_group' in self.lookup_cache and group_name in self.lookup_cache['option_group']:
-            return self.lookup_cache['option_group'][group_name]
-
-        query = dict()
-        query['entity'] = 'OptionGroup'
-        query['action'] = 'get'
-        query['name'] = group_name
-        result = self.performAPICall(query)
-        if result['is_error']:
-            raise CiviAPIException(result['error_message'])
-        if result['count']>1:
-            group_id = 0
-            self.log("More than one group found with name '%s'!" % group_name,
-                logging.WARN, 'API', 'get', 'OptionGroup', None, None, time.time()-timestamp)
-        elif result['count']==0:
-            group_id = 0
-            self.log("Group '%s' does not exist." % group_name,
-                logging.DEBUG, 'API', 'get', 'OptionGroup', group_id, None, time.time()-timestamp)
-        else:
-            group_id = result['values'][0]['id']
-            self.log("Group '%s' resolved to ID %s" % (group_name, group_id),
-                logging.DEBUG, 'API', 'get', 'OptionGroup', group_id, None, time.time()-timestamp)
-
-        # store value
-        self.lookup_cache_lock.acquire()
-        if 'option_group' not in self.lookup_cache:
-            self.lookup_cache['option_group'] = dict()
-        self.lookup_cache['option_group'][group_name] = group_id
-        self.lookup_cache_lock.notifyAll()
-        self.lookup_cache_lock.release()
+        def load():
+            timestamp = time.time()
+            query = dict()
+            query['entity'] = 'OptionGroup'
+            query['action'] = 'get'
+            query['name'] = group_name
+            result = self.performAPICall(query)
+            if result['is_error']:
+                raise CiviAPIException(result['error_message'])
+            if result['count']>1:
+                group_id = 0
+                self.log("More than one group found with name '%s'!" % group_name,
+                    logging.WARN, 'API', 'get', 'OptionGroup', None, None, time.time()-timestamp)
+            elif result['count']==0:
+                group_id = 0
+                self.log("Group '%s' does not exist." % group_name,
+                    logging.DEBUG, 'API', 'get', 'OptionGroup', group_id, None, time.time()-timestamp)
+            else:
+                group_id = result['values'][0]['id']
+                self.log("Group '%s' resolved to ID %s" % (group_name, group_id),
+                    logging.DEBUG, 'API', 'get', 'OptionGroup', group_id, None, time.time()-timestamp)
+            return group_id
 
-        return group_id
+        return self.lookup_cache.lookup('option_group', group_name, load)
 
 
     def getOptionValueID(self, option_group_id, name):
         """
         Get the ID for a given option value
-        """
-        timestamp = time.time()
-        if 'option_value_id' in self.lookup_cache and option_group_id in self.lookup_cache['option_value_id'] and name in self.lookup_cache['option_value_id'][option_group_id]:
-            return self.lookup_cache['option_value_id'][option_group_id][name]
 
-        query = dict()
-        query['entity'] = 'OptionValue'
-        query['action'] = 'get'
-        query['name'] = name
-        query['option_group_id'] = option_group_id
-        result = self.performAPICall(query)
-        if result['is_error']:
-            raise CiviAPIException(result['error_message'])
-        if result['count']>1:
-            value_id = result['values'][0]['id']
-            self.log("More than one value found with name '%s'! Using first one..." % name,
-                logging.WARN, 'API', 'get', 'OptionValue', None, None, time.time()-timestamp)
-        elif result['count']==0:
-            value_id = 0
-            self.log("Value '%s' does not exist." % name,
-                logging.DEBUG, 'API', 'get', 'OptionValue', value_id, None, time.time()-timestamp)
-        else:
-            #value_id = result['values'][0]['value']
-            value_id = result['values'][0]['id']
-            self.log("Value '%s' resolved to ID %s" % (name, value_id),
-                logging.DEBUG, 'API', 'get', 'OptionValue', value_id, None, time.time()-timestamp)
-
-        # store value
-        if value_id:
-            self.lookup_cache_lock.acquire()
-            if 'option_value_id' not in self.lookup_cache:
-                self.lookup_cache['option_value_id'] = dict()
-            if option_group_id not in self.lookup_cache['option_value_id']:
-                self.lookup_cache['option_value_id'][option_group_id] = dict()
-            self.lookup_cache['option_value_id'][option_group_id][name] = value_id
-            self.lookup_cache_lock.notifyAll()
-            self.lookup_cache_lock.release()
+        Misses are not cached (see __init__), since the option value might get created
+        """
+        def load():
+            timestamp = time.time()
+            query = dict()
+            query['entity'] = 'OptionValue'
+            query['action'] = 'get'
+            query['name'] = name
+            query['option_group_id'] = option_group_id
+            result = self.performAPICall(query)
+            if result['is_error']:
+                raise CiviAPIException(result['error_message'])
+            if result['count']>1:
+                value_id = result['values'][0]['id']
+                self.log("More than one value found with name '%s'! Using first one..." % name,
+                    logging.WARN, 'API', 'get', 'OptionValue', None, None, time.time()-timestamp)
+            elif result['count']==0:
+                value_id = 0
+                self.log("Value '%s' does not exist." % name,
+                    logging.DEBUG, 'API', 'get', 'OptionValue', value_id, None, time.time()-timestamp)
+            else:
+                #value_id = result['values'][0]['value']
+                value_id = result['values'][0]['id']
+                self.log("Value '%s' resolved to ID %s" % (name, value_id),
+                    logging.DEBUG, 'API', 'get', 'OptionValue', value_id, None, time.time()-timestamp)
+            return value_id
 
-        return value_id
+        return self.lookup_cache.lookup('option_value_id', (str(option_group_id), name), load)
 
 
-    def getOptionValue(self, option_group_id, name):
+    def getOptionValue(self, option_group_id, name, verify_miss=False):
         """
-        Get the 'value' for a given option value
+        Get the 'value' for a given option value,
+        with verify_miss set, a cached miss is looked up again
         """
         # FIXME: Is there a good reason to set value to 0? Such a value will lead to an api-error.
-        timestamp = time.time()
-        if 'option_value' in self.lookup_cache and option_group_id in self.lookup_cache['option_value'] and name in self.lookup_cache['option_value'][option_group_id]:
-            return self.lookup_cache['option_value'][option_group_id][name]
-
-        query = dict()
-        query['entity'] = 'OptionValue'
-        query['action'] = 'get'
-        query['name'] = name
-        query['option_group_id'] = option_group_id
-        result = self.performAPICall(query)
-        if result['is_error']:
-            raise CiviAPIException(result['error_message'])
-        if result['count']>1:
-            value = 0
-            self.log("More than one value found with name '%s'!" % name,
-                logging.WARN, 'API', 'get', 'OptionValue', None, None, time.time()-timestamp)
-        elif result['count']==0:
-            value = 0
-            self.log("Value '%s' does not exist." % name,
-                logging.DEBUG, 'API', 'get', 'OptionValue', value, None, time.time()-timestamp)
-        else:
-            value = result['values'][0]['value']
-            self.log("Value '%s' resolved to ID %s" % (name, value),
-                logging.DEBUG, 'API', 'get', 'OptionValue', value, None, time.time()-timestamp)
-
-        # store value
-        self.lookup_cache_lock.acquire()
-        if 'option_value' not in self.lookup_cache:
-            self.lookup_cache['option_value'] = dict()
-        if option_group_id not in self.lookup_cache['option_value']:
-            self.lookup_cache['option_value'][option_group_id] = dict()
-        self.lookup_cache['option_value'][option_group_id][name] = value
-        self.lookup_cache_lock.notifyAll()
-        self.lookup_cache_lock.release()
+        def load():
+            timestamp = time.time()
+            query = dict()
+            query['entity'] = 'OptionValue'
+            query['action'] = 'get'
+            query['name'] = name
+            query['option_group_id'] = option_group_id
+            result = self.performAPICall(query)
+            if result['is_error']:
+                raise CiviAPIException(result['error_message'])
+            if result['count']>1:
+                value = 0
+                self.log("More than one value found with name '%s'!" % name,
+                    logging.WARN, 'API', 'get', 'OptionValue', None, None, time.time()-timestamp)
+            elif result['count']==0:
+                value = 0
+                self.log("Value '%s' does not exist." % name,
+                    logging.DEBUG, 'API', 'get', 'OptionValue', value, None, time.time()-timestamp)
+            else:
+                value = result['values'][0]['value']
+                self.log("Value '%s' resolved to ID %s" % (name, value),
+                    logging.DEBUG, 'API', 'get', 'OptionValue', value, None, time.time()-timestamp)
+            return value
 
-        return value
+        return self.lookup_cache.lookup('option_value', (str(option_group_id), name), load, verify_miss)
 
 
     def setOptionValue(self, option_group_id, name, attributes=dict()):
@@ -821,143 +1232,106 @@ class CiviCRM:
 
         # store value
         value_id = result['values'][0]['value']
-        self.lookup_cache_lock.acquire()
-        if 'option_value' not in self.lookup_cache:
-            self.lookup_cache['option_value'] = dict()
-        if option_group_id not in self.lookup_cache['option_value']:
-            self.lookup_cache['option_value'][option_group_id] = dict()
-        self.lookup_cache['option_value'][option_group_id][name] = value_id
-        self.lookup_cache_lock.notifyAll()
-        self.lookup_cache_lock.release()
+        self.lookup_cache.set('option_value', (str(option_group_id), name), value_id)
+        self.lookup_cache.set('option_value_id', (str(option_group_id), name), result['values'][0]['id'])
 
         return value_id
 
 
     def getLocationTypeID(self, location_name):
-        # first: look up in cache
-        if 'location_type2id' in self.lookup_cache and location_name in self.lookup_cache['location_type2id']:
-            return self.lookup_cache['location_type2id'][location_name]
+        def load():
+            timestamp = time.time()
+            query = {     'action': 'get',
+                        'entity': 'LocationType',
+                        'name': location_name }
+            result = self.performAPICall(query)
+            if result['count']>1:
+                self.log("Query result not unique, please provide a unique query for 'getOrCreate'.",
+                    logging.WARN, 'API', 'get', 'LocationType', None, None, time.time()-timestamp)
+                raise CiviAPIException("Query result not unique, please provide a unique query for 'getOrCreate'.")
+            elif result['count']==1:
+                location_id = result['values'][0]['id']
+                self.log("Location type '%s' resolved to id %s." % (location_name, location_id),
+                    logging.DEBUG, 'API', 'get', 'LocationType', location_id, None, time.time()-timestamp)
+            else:
+                location_id = 0
+                self.log("Location type '%s' resolved to id %s." % (location_name, location_id),
+                    logging.ERROR, 'API', 'get', 'LocationType', location_id, None, time.time()-timestamp)
+            return location_id
 
-        timestamp = time.time()
-        query = {     'action': 'get',
-                    'entity': 'LocationType',
-                    'name': location_name }
-        result = self.performAPICall(query)
-        if result['count']>1:
-            self.log("Query result not unique, please provide a unique query for 'getOrCreate'.",
-                logging.WARN, 'API', 'get', 'LocationType', None, None, time.time()-timestamp)
-            raise CiviAPIException("Query result not unique, please provide a unique query for 'getOrCreate'.")
-        elif result['count']==1:
-            location_id = result['values'][0]['id']
-            self.log("Location type '%s' resolved to id %s." % (location_name, location_id),
-                logging.DEBUG, 'API', 'get', 'LocationType', location_id, None, time.time()-timestamp)
-        else:
-            location_id = 0
-            self.log("Location type '%s' resolved to id %s." % (location_name, location_id),
-                logging.ERROR, 'API', 'get', 'LocationType', location_id, None, time.time()-timestamp)
-        self.lookup_cache_lock.acquire()
-        if 'location_type2id' not in self.lookup_cache:
-            self.lookup_cache['location_type2id'] = dict()
-        self.lookup_cache['location_type2id'][location_name] = location_id
-        self.lookup_cache_lock.notifyAll()
-        self.lookup_cache_lock.release()
-        return location_id
+        return self.lookup_cache.lookup('location_type2id', location_name, load)
 
 
     def getMembershipStatusID(self, membership_status_name):
-        # first: look up in cache
-        if 'membership_status2id' in self.lookup_cache and membership_status_name in self.lookup_cache['membership_status2id']:
-            return self.lookup_cache['membership_status2id'][membership_status_name]
-
-        timestamp = time.time()
-        query = {     'action': 'get',
-                    'entity': 'MembershipStatus',
-                    'name': membership_status_name }
-        result = self.performAPICall(query)
-        if result['count']>1:
-            self.log("Non-uniqe membership status name '%s'" % membership_status_name,
-                logging.WARN, 'API', 'get', 'MembershipStatus', None, None, time.time()-timestamp)
-            raise CiviAPIException("Non-uniqe membership status name '%s'" % membership_status_name)
-        elif result['count']==1:
-            status_id = result['values'][0]['id']
-            self.log("Membership status '%s' resolved to id %s." % (membership_status_name, status_id),
-                logging.DEBUG, 'API', 'get', 'MembershipStatus', status_id, None, time.time()-timestamp)
-        else:
-            status_id = 0
-            self.log("Membership status '%s' could NOT be resolved",
-                logging.DEBUG, 'API', 'get', 'MembershipStatus', None, None, time.time()-timestamp)
+        def load():
+            timestamp = time.time()
+            query = {     'action': 'get',
+                        'entity': 'MembershipStatus',
+                        'name': membership_status_name }
+            result = self.performAPICall(query)
+            if result['count']>1:
+                self.log("Non-uniqe membership status name '%s'" % membership_status_name,
+                    logging.WARN, 'API', 'get', 'MembershipStatus', None, None, time.time()-timestamp)
+                raise CiviAPIException("Non-uniqe membership status name '%s'" % membership_status_name)
+            elif result['count']==1:
+                status_id = result['values'][0]['id']
+                self.log("Membership status '%s' resolved to id %s." % (membership_status_name, status_id),
+                    logging.DEBUG, 'API', 'get', 'MembershipStatus', status_id, None, time.time()-timestamp)
+            else:
+                status_id = 0
+                self.log("Membership status '%s' could NOT be resolved" % membership_status_name,
+                    logging.DEBUG, 'API', 'get', 'MembershipStatus', None, None, time.time()-timestamp)
+            return status_id
 
-        self.lookup_cache_lock.acquire()
-        if 'membership_status2id' not in self.lookup_cache:
-            self.lookup_cache['membership_status2id'] = dict()
-        self.lookup_cache['membership_status2id'][membership_status_name] = status_id
-        self.lookup_cache_lock.notifyAll()
-        self.lookup_cache_lock.release()
-        return status_id
+        return self.lookup_cache.lookup('membership_status2id', membership_status_name, load)
 
 
     def getMembershipTypeID(self, membership_type_name):
-        # first: look up in cache
-        if 'membership_type2id' in self.lookup_cache and membership_type_name in self.lookup_cache['membership_type2id']:
-            return self.lookup_cache['membership_type2id'][membership_type_name]
-
-        timestamp = time.time()
-        query = {     'action': 'get',
-                    'entity': 'MembershipType',
-                    'name': membership_type_name }
-        result = self.performAPICall(query)
-        if result['count']>1:
-            self.log("Non-uniqe membership type name '%s'" % membership_type_name,
-                logging.WARN, 'API', 'get', 'MembershipType', None, None, time.time()-timestamp)
-            raise CiviAPIException("Non-uniqe membership type name '%s'" % membership_type_name)
-        elif result['count']==1:
-            type_id = result['values'][0]['id']
-            self.log("Membership type '%s' resolved to id %s." % (membership_type_name, type_id),
-                logging.DEBUG, 'API', 'get', 'MembershipType', type_id, None, time.time()-timestamp)
-        else:
-            type_id = 0
-            self.log("Membership type '%s' could NOT be resolved",
-                logging.DEBUG, 'API', 'get', 'MembershipTypes', None, None, time.time()-timestamp)
+        def load():
+            timestamp = time.time()
+            query = {     'action': 'get',
+                        'entity': 'MembershipType',
+                        'name': membership_type_name }
+            result = self.performAPICall(query)
+            if result['count']>1:
+                self.log("Non-uniqe membership type name '%s'" % membership_type_name,
+                    logging.WARN, 'API', 'get', 'MembershipType', None, None, time.time()-timestamp)
+                raise CiviAPIException("Non-uniqe membership type name '%s'" % membership_type_name)
+            elif result['count']==1:
+                type_id = result['values'][0]['id']
+                self.log("Membership type '%s' resolved to id %s." % (membership_type_name, type_id),
+                    logging.DEBUG, 'API', 'get', 'MembershipType', type_id, None, time.time()-timestamp)
+            else:
+                type_id = 0
+                self.log("Membership type '%s' could NOT be resolved" % membership_type_name,
+                    logging.DEBUG, 'API', 'get', 'MembershipTypes', None, None, time.time()-timestamp)
+            return type_id
 
-        self.lookup_cache_lock.acquire()
-        if 'membership_type2id' not in self.lookup_cache:
-            self.lookup_cache['membership_type2id'] = dict()
-        self.lookup_cache['membership_type2id'][membership_type_name] = type_id
-        self.lookup_cache_lock.notifyAll()
-        self.lookup_cache_lock.release()
-        return type_id
+        return self.lookup_cache.lookup('membership_type2id', membership_type_name, load)
 
 
     def getFinancialTypeID(self, financial_type_name):
-        # first: look up in cache
-        if 'financial_type2id' in self.lookup_cache and financial_type_name in self.lookup_cache['financial_type2id']:
-            return self.lookup_cache['financial_type2id'][financial_type_name]
-
-        timestamp = time.time()
-        query = {     'action': 'get',
-                    'entity': 'FinancialType',
-                    'name': financial_type_name }
-        result = self.performAPICall(query)
-        if result['count']>1:
-            self.log("Non-uniqe financial type name '%s'" % financial_type_name,
-                logging.WARN, 'API', 'get', 'FinancialType', None, None, time.time()-timestamp)
-            raise CiviAPIException("Non-uniqe financial type name '%s'" % financial_type_name)
-        elif result['count']==1:
-            type_id = result['values'][0]['id']
-            self.log("Financial type '%s' resolved to id %s." % (financial_type_name, type_id),
-                logging.DEBUG, 'API', 'get', 'FinancialType', type_id, None, time.time()-timestamp)
-        else:
-            type_id = 0
-            self.log("Financial type '%s' could NOT be resolved",
-                logging.DEBUG, 'API', 'get', 'FinancialType', None, None, time.time()-timestamp)
+        def load():
+            timestamp = time.time()
+            query = {     'action': 'get',
+                        'entity': 'FinancialType',
+                        'name': financial_type_name }
+            result = self.performAPICall(query)
+            if result['count']>1:
+                self.log("Non-uniqe financial type name '%s'" % financial_type_name,
+                    logging.WARN, 'API', 'get', 'FinancialType', None, None, time.time()-timestamp)
+                raise CiviAPIException("Non-uniqe financial type name '%s'" % financial_type_name)
+            elif result['count']==1:
+                type_id = result['values'][0]['id']
+                self.log("Financial type '%s' resolved to id %s." % (financial_type_name, type_id),
+                    logging.DEBUG, 'API', 'get', 'FinancialType', type_id, None, time.time()-timestamp)
+            else:
+                type_id = 0
+                self.log("Financial type '%s' could NOT be resolved" % financial_type_name,
+                    logging.DEBUG, 'API', 'get', 'FinancialType', None, None, time.time()-timestamp)
+            return type_id
 
-        self.lookup_cache_lock.acquire()
-        if 'financial_type2id' not in self.lookup_cache:
-            self.lookup_cache['financial_type2id'] = dict()
-        self.lookup_cache['financial_type2id'][financial_type_name] = type_id
-        self.lookup_cache_lock.notifyAll()
-        self.lookup_cache_lock.release()
-        return type_id
+        return self.lookup_cache.lookup('financial_type2id', financial_type_name, load)
 
 
     def getEmail(self, contact_id, location_type_id):
@@ -1117,7 +1491,7 @@ class CiviCRM:
                 logging.ERROR, 'pycivi', 'getOrCreatePrefix', 'OptionGroup', None, None, time.time()-timestamp)
             return
 
-        greeting_id = self.getOptionValue(option_group_id, prefix_text)
+        greeting_id = self.getOptionValue(option_group_id, prefix_text, verify_miss=True)
         if greeting_id:
             self.log("Prefix '%s' already exists [%s]" % (prefix_text, greeting_id),
                 logging.INFO, 'pycivi', 'getOrCreatePrefix', 'OptionValue', None, None, time.time()-timestamp)
@@ -1145,7 +1519,7 @@ class CiviCRM:
                 logging.ERROR, 'pycivi', 'getOrCreateGreeting', 'OptionGroup', None, None, time.time()-timestamp)
             return
 
-        greeting_id = self.getOptionValue(option_group_id, greeting_text)
+        greeting_id = self.getOptionValue(option_group_id, greeting_text, verify_miss=True)
         if greeting_id:
             self.log("Greeting '%s' already exists [%s]" % (greeting_text, greeting_id),
                 logging.INFO, 'pycivi', 'getOrCreateGreeting', 'OptionValue', None, None, time.time()-timestamp)
@@ -1158,42 +1532,107 @@ class CiviCRM:
 
 
     def getOrCreateTagID(self, tag_name, description = None):
-        query = { 'entity': 'Tag',
-                  'action': 'get',
-                  'name' : tag_name}
-        result = self.performAPICall(query)
-        if result['count']>1:
-            raise CiviAPIException("Tag name query result not unique, this should not happen!")
-        elif result['count']==1:
-            return result['values'][0]['id']
-        else:
-            # tag doesn't exist => create
-            query = dict()
-            query['entity'] = 'Tag'
-            query['action'] = 'create'
-            query['name'] = tag_name
-            if description: query['description'] = description
-            result = self.performAPICall(query)
-            return result['values'][0]['id']
+        """
+        Get the ID of the tag with the given name, create it if it doesn't exist
+
+        Results will be cached
+        """
+        return self.getOrCreateTagIDs([tag_name], description)[tag_name]
+
+
+    def getOrCreateTagIDs(self, tag_names, description = None):
+        """
+        Resolve a list of tag names, creating the missing tags.
+
+        Returns a dict tag name => tag ID. See _getOrCreateIDs
+        """
+        create = {'entity': 'Tag'}
+        if description: create['description'] = description
+        return self._getOrCreateIDs('tag', 'Tag', 'name', tag_names, create)
 
 
     def getOrCreateGroupID(self, group_name, description = None):
-        query = { 'entity': 'Group',
-                  'action': 'get',
-                  'title' : group_name}
-        result = self.performAPICall(query)
-        if result['count']>1:
-            raise CiviAPIException("Group name query result not unique, this should not happen!")
-        elif result['count']==1:
-            return result['values'][0]['id']
-        else:
-            # group doesn't exist => create
-            query['action'] = 'create'
-            query['group_type'] = 'Mailing List'  # set as Mailing Group
-            if description:
-                query['description'] = description
-            result = self.performAPICall(query)
-            return result['values'][0]['id']
+        """
+        Get the ID of the group with the given title, create it
+        (as mailing list) if it doesn't exist
+
+        Results will be cached
+        """
+        return self.getOrCreateGroupIDs([group_name], description)[group_name]
+
+
+    def getOrCreateGroupIDs(self, group_names, description = None):
+        """
+        Resolve a list of group titles, creating the missing groups (as mailing lists).
+
+        Returns a dict group title => group ID. See _getOrCreateIDs
+        """
+        create = {'entity': 'Group', 'group_type': 'Mailing List'}  # set as Mailing Group
+        if description: create['description'] = description
+        return self._getOrCreateIDs('group', 'Group', 'title', group_names, create)
+
+
+    def _getOrCreateIDs(self, namespace, entity_type, name_field, names, create):
+        """
+        Resolve the names (values of name_field) to entity IDs through the lookup
+        cache. The names not cached are queried with a single 'IN' query, the missing
+        ones are then created in one section locked against the other threads.
+        Created IDs are cached right away, so each name is created only once.
+
+        If the namespace was preloaded (see preload), no queries are needed for the
+        names found there, the others are queried again before they are created.
+        Like MySQL, names are matched case insensitively: 'vip' resolves to 'VIP'.
+        """
+        timestamp = time.time()
+        ids = dict()
+        unknown = dict()
+        for name in names:
+            value = self.lookup_cache.find(namespace, name)
+            if value is MISSING or not value:
+                unknown.setdefault(name.casefold(), name)
+            else:
+                ids[name] = value
+
+        if unknown:
+            query = { 'entity': entity_type,
+                      'action': 'get',
+                      name_field: {'IN': list(unknown.values())},
+                      'return': 'id,%s' % name_field,
+                      'options': {'limit': 0},
+                      }
+            result = self.performAPICall(query, {'json_parameters': True})
+            if result['is_error']:
+                raise CiviAPIException(result['error_message'])
+            found = dict()
+            for entity in result['values']:
+                folded_name = entity[name_field].casefold()
+                if folded_name in found:
+                    raise CiviAPIException("%s name query result not unique, this should not happen!" % entity_type)
+                found[folded_name] = entity['id']
+            self.lookup_cache.setMany(namespace, found.items())
+            for name in names:
+                if name not in ids:
+                    ids[name] = found.get(name.casefold(), 0)
+
+        missing = [name for name in ids if not ids[name]]
+        if missing:
+            with self._create_lock:
+                for name in missing:
+                    # maybe another thread has created it in the meantime
+                    entity_id = self.lookup_cache.get(namespace, name)
+                    if not entity_id:
+                        query = dict(create)
+                        query['action'] = 'create'
+                        query[name_field] = name
+                        result = self.performAPICall(query)
+                        if result['is_error']:
+                            raise CiviAPIException(result['error_message'])
+                        entity_id = result['values'][0]['id']
+                        self.lookup_cache.set(namespace, name, entity_id)
+                        self.log("%s '%s' created [%s]" % (entity_type, name, entity_id),
+                            logging.INFO, 'pycivi', 'create', entity_type, entity_id, None, time.time()-timestamp)
+                    ids[name] = entity_id
+        return ids
 
 
     def getContactTagIds(self, entity_id):
@@ -1250,6 +1689,83 @@ class CiviCRM:
         return groups
 
 
+    def getContactTagIdMap(self, contact_ids, chunk_size=500, page_size=1000):
+        """
+        Bulk version of getContactTagIds: get the tag IDs of all the given contacts,
+        with one 'IN' query (paged) per chunk of contacts.
+
+        Returns a dict contact ID => set of tag IDs
+        """
+        return self.getEntityTagIdMap(contact_ids, 'civicrm_contact', chunk_size, page_size)
+
+
+    def getEntityTagIdMap(self, entity_ids, entity_table, chunk_size=500, page_size=1000):
+        """
+        Bulk version of getEntityTagIds: get the tag IDs of all the given entities,
+        with one 'IN' query (paged) per chunk of entities.
+
+        Returns a dict entity ID => set of tag IDs
+        """
+        # civicrm_contribution_recur => ContributionRecur
+        parent_type = ''.join(part.capitalize() for part in entity_table[len('civicrm_'):].split('_'))
+        return self._getRelatedIdMap('EntityTag', 'entity_id', 'tag_id', entity_ids, {'entity_table': entity_table}, chunk_size, page_size, parent_type)
+
+
+    def getContactGroupIdMap(self, contact_ids, status='Added', chunk_size=500, page_size=1000):
+        """
+        Bulk version of getContactGroupIds: get the IDs of the groups the given
+        contacts are members of, with one 'IN' query (paged) per chunk of contacts.
+
+        Returns a dict contact ID => set of group IDs
+        """
+        return self._getRelatedIdMap('GroupContact', 'contact_id', 'group_id', contact_ids, {'status': status}, chunk_size, page_size, 'Contact')
+
+
+    def _getRelatedIdMap(self, entity_type, key_field, value_field, entity_ids, filters, chunk_size, page_size, parent_type):
+        """
+        collect value_field of all entity_type rows with key_field in entity_ids.
+        The returned map has an entry (maybe an empty set) for each of the entity_ids
+
+        API v3 answers EntityTag.get with an entity_id and GroupContact.get with a
+        contact_id by legacy code for a single ID, ignoring 'IN', the paging options
+        and the id keyset. So the parent_type entities (with id IN the chunk) are
+        paged instead, each with the entity_type rows as a chained call.
+        """
+        timestamp = time.time()
+        id_map = dict()
+        keys = dict()
+        for entity_id in entity_ids:
+            if str(entity_id) not in keys:
+                keys[str(entity_id)] = entity_id
+                id_map[entity_id] = set()
+
+        chained = 'api.%s.get' % entity_type
+        chained_query = dict(filters)
+        chained_query[key_field] = '$value.id'
+        chained_query['options'] = {'limit': 0}
+        key_list = list(keys)
+        for i in range(0, len(key_list), chunk_size):
+            query = {'id': {'IN': key_list[i:i+chunk_size]}, chained: chained_query}
+            if parent_type == 'Contact':
+                # including the contacts in the trash
+                query['is_deleted'] = {'IN': ['0', '1']}
+            for parent in self.iterEntities(parent_type, query, page_size=page_size, return_fields=['id'], raw=True):
+                entity_id = keys.get(str(parent.get('id')))
+                result = parent.get(chained, dict())
+                if entity_id is None or not result:
+                    continue
+                if result.get('is_error', 0):
+                    raise CiviAPIException(result.get('error_message', 'Unknown error'))
+                values = result.get('values', list())
+                if isinstance(values, dict):
+                    values = list(values.values())
+                id_map[entity_id].update(row.get(value_field) for row in values)
+
+        self.log("Fetched %s of %d entities." % (entity_type, len(key_list)),
+            logging.DEBUG, 'pycivi', 'get', entity_type, None, None, time.time()-timestamp)
+        return id_map
+
+
     def tagContact(self, entity_id, tag_id, value=True):
         # TODO: can it safely be replaced by
         #    self.tagEntity(entity_id, 'cvicirm_contact', tag_id, value)
@@ -1328,22 +1844,157 @@ class CiviCRM:
 
 
 
-    def _createEntity(self, entity_type, attributes):
-        if entity_type==etype.CONTACT:
-            return CiviContactEntity(entity_type, attributes.get('id', None), self, attributes)
-        elif entity_type==etype.CONTRIBUTION:
-            return CiviContributionEntity(entity_type, attributes.get('id', None), self, attributes)
-        elif entity_type==etype.PHONE:
-            return CiviPhoneEntity(entity_type, attributes.get('id', None), self, attributes)
-        elif entity_type==etype.CAMPAIGN:
-            return CiviCampaignEntity(entity_type, attributes.get('id', None), self, attributes)
-        elif entity_type==etype.NOTE:
-            return CiviNoteEntity(entity_type, attributes.get('id', None), self, attributes)
-        elif entity_type==etype.RELATIONSHIP_TYPE:
-            return CiviRelationshipTypeEntity(entity_type, attributes.get('id', None), self, attributes)
-        elif entity_type==etype.ADDRESS:
-            return CiviAddressEntity(entity_type, attributes.get('id', None), self, attributes)
-        elif entity_type==etype.EMAIL:
-            return CiviEmailEntity(entity_type, attributes.get('id', None), self, attributes)
+    def tagEntities(self, tag_id, entity_ids, value=True, entity_table='civicrm_contact', chunk_size=1000):
+        """
+        Bulk version of tagContact/tagEntity: (un)tag all the given entities,
+        with one call per chunk_size entities.
+
+        Returns the number of entities that were actually (un)tagged
+        """
+        if entity_table == 'civicrm_contact':
+            key_field = 'contact_id'
         else:
-            return CiviEntity(entity_type, attributes.get('id', None), self, attributes)
+            key_field = 'entity_id'
+        return self._setRelations('EntityTag', key_field, entity_ids, {'tag_id': tag_id, 'entity_table': entity_table}, value, chunk_size)
+
+
+    def setGroupMemberships(self, group_id, contact_ids, value=True, status='Added', chunk_size=1000):
+        """
+        Bulk version of setGroupMembership: add all the given contacts to the
+        group (or remove them), with one call per chunk_size contacts.
+
+        Returns the number of contacts that were actually added/removed
+        """
+        return self._setRelations('GroupContact', 'contact_id', contact_ids, {'group_id': group_id, 'status': status}, value, chunk_size)
+
+
+    def _setRelations(self, entity_type, key_field, entity_ids, attributes, value, chunk_size):
+        """
+        create (or delete) the entity_type relations for a list of entities,
+        passed as key_field.1, key_field.2, ... which EntityTag and GroupContact
+        accept in place of a single ID. They're sent as JSON parameters, a chunk
+        as separate POST variables would exceed PHP's max_input_vars (1000)
+        """
+        timestamp = time.time()
+        if value:
+            action, counter = 'create', 'added'
+        else:
+            action, counter = 'delete', 'removed'
+
+        entity_ids = list(entity_ids)
+        changed = 0
+        for i in range(0, len(entity_ids), chunk_size):
+            query = dict(attributes)
+            query['entity'] = entity_type
+            query['action'] = action
+            for index, entity_id in enumerate(entity_ids[i:i+chunk_size]):
+                query['%s.%d' % (key_field, index + 1)] = entity_id
+            result = self.performAPICall(query, {'json_parameters': True})
+            if result['is_error']:
+                raise CiviAPIException(result['error_message'])
+            changed += int(result.get(counter, 0) or 0)
+
+        self.log("%s: %s %d of %d entities" % (entity_type, counter.capitalize(), changed, len(entity_ids)),
+            logging.INFO, 'pycivi', action, entity_type, None, None, time.time()-timestamp)
+        return changed
+
+
+    def _createEntity(self, entity_type, attributes):
+        """
+        wrap the attributes in the class registered for the
+        entity type (see CiviEntity.registerEntityClass)
+        """
+        return getEntityClass(entity_type)(entity_type, attributes.get('id', None), self, attributes)
+
+
+
+class CiviChain:
+    """
+    An API call with chained sub calls ('api.<Entity>.<action>'),
+    see CiviCRM.chain
+    """
+    def __init__(self, civicrm, entity_type, action, params=dict()):
+        self.civicrm = civicrm
+        self.entity_type = entity_type
+        self.action = action
+        self.params = dict(params)
+        self.chained = list()
+
+    def then(self, entity_type, action, params=dict()):
+        """
+        add a call to be executed for the result of the main call
+        """
+        self.chained.append((entity_type, action, dict(params)))
+        return self
+
+    def getQuery(self):
+        """
+        build the API query including all chained calls
+        """
+        query = dict(self.params)
+        for entity_type, action, params in self.chained:
+            key = 'api.%s.%s' % (entity_type, action)
+            if key not in query:
+                query[key] = params
+            elif isinstance(query[key], list):
+                # don't extend the list passed in params
+                query[key] = query[key] + [params]
+            else:
+                query[key] = [query[key], params]
+        query['entity'] = self.entity_type
+        query['action'] = self.action
+        return query
+
+    def execute(self):
+        """
+        send the chained call as one request.
+
+        Returns a list: the main entity (or None if there was no result),
+        followed by a list of entities for each of the chained calls in order
+        """
+        timestamp = time.time()
+        query = self.getQuery()
+        result = self.civicrm.performAPICall(query, {'json_parameters': True})
+        if result['is_error']:
+            raise CiviAPIException(result['error_message'])
+        values = result['values']
+        if isinstance(values, dict):
+            values = list(values.values())
+        if self.entity_type == etype.CONTACT and self.action == 'create':
+            self.civicrm._contactCreated(dict(self.params, **(values[0] if values else dict())))
+        if not values:
+            self.civicrm.log("Chained call did not produce a result.",
+                logging.DEBUG, 'pycivi', self.action, self.entity_type, None, None, time.time()-timestamp)
+            return [None] + [list() for call in self.chained]
+
+        # split the nested results from the main entity
+        row = values[0]
+        main_attributes = dict()
+        for key in row:
+            if not key.startswith('api.'):
+                main_attributes[key] = row[key]
+        results = [self.civicrm._createEntity(self.entity_type, main_attributes)]
+
+        # the results of the sub calls passed in params come first
+        index = dict()
+        for key, value in self.params.items():
+            if key.startswith('api.'):
+                index[key] = len(value) if isinstance(value, list) else 1
+        for entity_type, action, params in self.chained:
+            key = 'api.%s.%s' % (entity_type, action)
+            sub_result = row.get(key, dict())
+            if isinstance(query[key], list):
+                # multiple calls with the same key deliver a list of results
+                sub_result = sub_result[index.get(key, 0)]
+                index[key] = index.get(key, 0) + 1
+            if sub_result.get('is_error', False):
+                raise CiviAPIException("Chained call '%s' failed: %s" % (key, sub_result.get('error_message', '')))
+
+            sub_values = sub_result.get('values', list())
+            if isinstance(sub_values, dict):
+                sub_values = list(sub_values.values())
+            results.append([self.civicrm._createEntity(entity_type, data) for data in sub_values])
+
+        self.civicrm.log("Chained call with %d sub calls executed." % len(self.chained),
+            logging.DEBUG, 'pycivi', self.action, self.entity_type, main_attributes.get('id', None), None, time.time()-timestamp)
+        return results
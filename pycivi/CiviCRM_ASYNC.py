@@ -0,0 +1,547 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+This is a python API wrapper for CiviCRM (https://civicrm.org/)
+Copyright (C) 2013 Systopia  (endres@systopia.de)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+__author__      = "Björn Endres"
+__copyright__   = "Copyright 2013, Systopia"
+__license__     = "GPLv3"
+__maintainer__  = "Björn Endres"
+__email__       = "endres[at]systopia.de"
+
+
+import logging
+import sys
+import json
+import time
+import asyncio
+
+from .CiviEntity import *
+from .CiviCRM import CiviCRM
+from .CiviLookupCache import MISSING
+from .CiviCRM_REST import CiviCRM_REST, CiviAPIException, _exceedsGetLength
+
+try:
+    import aiohttp
+except ImportError as err:
+    # optional dependency, see extras_require['async'] in setup.py
+    raise ImportError("CiviCRM_ASYNC needs aiohttp, install it with 'pip install pycivi[async]' (%s)" % err)
+
+
+class CiviCRM_ASYNC(CiviCRM):
+    """
+    asyncio based REST implementation.
+
+    performAPICall and the methods getEntity, createOrUpdate, getContactID
+    and the ID lookups are coroutines, at most max_in_flight calls are
+    sent at the same time. The other (synchronous) methods inherited
+    from CiviCRM are not available with this implementation.
+
+    The entities returned can't do API calls themselves (store, reload,
+    delete raise a TypeError), use storeEntity, reloadEntity and
+    deleteEntity instead.
+
+    Use as:
+        async with CiviCRM_ASYNC(url, site_key, user_key) as civicrm:
+            contact_id = await civicrm.getContactID(record)
+    """
+
+    URL_PATHS = CiviCRM_REST.URL_PATHS
+
+    # see CiviEntity._getCiviCRM
+    asynchronous = True
+
+    def __init__(self, url, site_key, user_key, logfile=None, htaccess=None,
+                 force_post=False, debug=False, verify_ssl=True, json_params=None,
+                 max_in_flight=100, max_get_length=2000):
+        # init some attributes
+        super().__init__(logfile)
+        self.url = url
+        self.site_key = site_key
+        self.user_key = user_key
+        self.forcePost = force_post
+        self.debug = debug
+        self.verify_ssl = verify_ssl
+        self.json_parameters = json_params
+        self.max_in_flight = max_in_flight
+        self.max_get_length = max_get_length
+
+        self.headers = {}
+        self.auth = None
+        self.rest_url = None
+        self._session = None
+        self._semaphore = None
+        self._lookups = dict()
+
+        if htaccess and 'auth_user' in htaccess and 'auth_pass' in htaccess:
+            self.auth = aiohttp.BasicAuth(htaccess['auth_user'], htaccess['auth_pass'])
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def connect(self):
+        """
+        open the HTTP session and find the REST url.
+        Has to be called from within the event loop.
+        """
+        if self._session:
+            return
+
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight, ssl=None if self.verify_ssl else False)
+        self._session = aiohttp.ClientSession(connector=connector, auth=self.auth, headers=self.headers)
+
+        url = self.url
+        if url.endswith('extern/rest.php'):
+            await self.test_rest_api(url)
+            self.rest_url = url
+            return
+
+        if url.endswith('/civicrm'):
+            url = url[:-8]
+
+        # probe all candidates at the same time, the first working one in order wins
+        candidates = [url.rstrip('/') + path for path in self.URL_PATHS]
+        results = await asyncio.gather(*[self.test_rest_api(candidate) for candidate in candidates], return_exceptions=True)
+        for candidate, result in zip(candidates, results):
+            if not isinstance(result, Exception):
+                self.rest_url = candidate
+                return
+
+        await self.close()
+        msg = '\n\n'.join(str(e) for e in results)
+        msg += CiviCRM_REST.API_ERROR_MSG
+        raise CiviAPIException(msg)
+
+    def getSiteIdentifier(self):
+        return self.rest_url or self.url
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    async def test_rest_api(self, url):
+        msg = "The api is not reachable at: {}".format(url)
+        try:
+            async with self._session.get(url) as reply:
+                status = reply.status
+                history = reply.history
+        except Exception as exc:
+            msg += "\nAn error occured:"
+            msg += "\n{}: {}".format(type(exc).__name__, exc)
+            raise CiviAPIException(msg)
+        if history:
+            msg += "\nWe were redirected to: {}".format(history[-1].url)
+            raise CiviAPIException(msg)
+        elif not status in [200, 403]:
+            msg += "\nError code was: {}".format(status)
+            raise CiviAPIException(msg)
+
+    async def performAPICall(self, params=dict(), execParams=dict()):
+        if not self._session:
+            await self.connect()
+
+        timestamp = time.time()
+        call_params = params
+        params = params.copy()
+        params['api_key'] = self.user_key
+        params['key'] = self.site_key
+        params['sequential'] = 1
+        params['json'] = 1
+        params['version'] = self.api_version
+        if self.debug:
+            params['debug'] = 1
+
+        if self.json_parameters or execParams.get('json_parameters', False):
+            # pack complex parameters into a serialised json block
+            not_json = ['api_key', 'key', 'action', 'entity']
+            json_params = dict()
+            for param in list(params.keys()):
+                if not param in not_json:
+                    json_params[param] = params.pop(param)
+            params['json'] = self.codec.dumps(json_params)
+
+        # check for complex parameters
+        for param in params:
+            if type(params[param]) in [list, dict, tuple, set]:
+                self.log("Parameter '%s' is not of basic type. For complex parameters, consider turning on the 'json_parameters' option." % param,
+                    logging.WARN, 'API', params.get('action', "NO ACTION SET"), params.get('entity', "NO ENTITY SET!"), params.get('id', ''), params.get('external_identifier', ''), time.time()-timestamp)
+                break
+
+        # aiohttp only accepts strings
+        params = dict((key, str(value)) for key, value in params.items() if value is not None)
+
+        forcePost = execParams.get('forcePost', False) or self.forcePost
+        async with self._semaphore:
+            if (params['action'] in ['create', 'delete']) or forcePost or _exceedsGetLength(self.rest_url, params, self.max_get_length):
+                request = self._session.post(self.rest_url, data=params)
+            else:
+                request = self._session.get(self.rest_url, params=params)
+            try:
+                async with request as reply:
+                    status = reply.status
+                    reply_url = reply.url
+                    content = await reply.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                self._countError()
+                raise
+
+        self.log("API call completed - status: %d, url: '%s'" % (status, reply_url),
+            logging.DEBUG, 'API', params.get('action', "NO ACTION SET"), params.get('entity', "NO ENTITY SET!"), params.get('id', ''), params.get('external_identifier', ''), time.time()-timestamp)
+
+        if status == 414:
+            raise CiviAPIException("Request is too long, please check server settings or use forcePost")
+        elif status != 200:
+            self._countError()
+            raise CiviAPIException("HTML response code %d received, please check URL" % status, status)
+
+        try:
+            result = self.codec.loads(content)
+        except ValueError as exc:
+            self.log("Unable to parse reply as json: %s" % content[:1000].decode("utf8", "replace"),
+                logging.ERROR, 'API', params.get('action', "NO ACTION SET"), params.get('entity', "NO ENTITY SET!"), params.get('id', ''), params.get('external_identifier', ''), time.time()-timestamp)
+            raise exc
+
+        # do some logging
+        runtime = time.time()-timestamp
+        self._countCalls(runtime)
+
+        if 'undefined_fields' in result:
+            fields = result['undefined_fields']
+            if fields:
+                self.log("API call: Undefined fields reported: %s" % str(fields),
+                    logging.DEBUG, 'API', params['action'], params['entity'], params.get('id', ''), params.get('external_identifier', ''), time.time()-timestamp)
+
+        if 'is_error' in result and result['is_error']:
+            self.log("API call error: '%s'" % result['error_message'],
+                logging.ERROR, 'API', params['action'], params['entity'], params.get('id', ''), params.get('external_identifier', ''), time.time()-timestamp)
+            raise CiviAPIException(result['error_message'])
+        else:
+            self._callCompleted(call_params.get('entity'), call_params.get('action'), call_params)
+            return result
+
+
+    async def load(self, entity_type, entity_id):
+        result = await self.performAPICall({'entity':entity_type, 'action':'get', 'id':entity_id})
+        if result['count']:
+            return self._createEntity(entity_type, result['values'][0])
+        else:
+            return None
+
+
+    async def getEntity(self, entity_type, attributes, primary_attributes=['id', 'external_identifier']):
+        timestamp = time.time()
+
+        query = dict()
+        first_key = None
+        for key in primary_attributes:
+            if key in attributes:
+                query[key] = attributes[key]
+                if first_key==None:
+                    first_key = attributes[key]
+        if not len(query) > 0:
+            self.log("No primary key provided with contact '%s'." % str(attributes),
+                logging.DEBUG, 'pycivi', 'get', entity_type, first_key, None, time.time()-timestamp)
+            return 0
+
+        query['entity'] = entity_type
+        query['action'] = 'get'
+        result = await self.performAPICall(query)
+        if result['count']>1:
+            self.log("Query result not unique, please provide a unique query for 'getEntity'.",
+                logging.WARN, 'pycivi', 'get', entity_type, first_key, None, time.time()-timestamp)
+            raise CiviAPIException("Query result not unique, please provide a unique query for 'getEntity'.")
+        elif result['count']==1:
+            entity = self._createEntity(entity_type, result['values'][0])
+            self.log("Entity found: %s" % str(entity),
+                logging.DEBUG, 'pycivi', 'get', entity_type, first_key, None, time.time()-timestamp)
+            return entity
+        else:
+            self.log("Entity not found.",
+                logging.DEBUG, 'pycivi', 'get', entity_type, first_key, None, time.time()-timestamp)
+            return None
+
+
+    async def createEntity(self, entity_type, attributes):
+        query = dict(attributes)
+        query['action']             = 'create'
+        query['entity']             = entity_type
+        result = await self.performAPICall(query)
+        return self._createEntity(entity_type, result['values'][0])
+
+
+    async def createOrUpdate(self, entity_type, attributes, update_type='update', primary_attributes=['id', 'external_identifier']):
+        query = dict()
+        for key in primary_attributes:
+            if key in attributes:
+                query[key] = attributes[key]
+
+        if query:
+            # try to find the entity
+            query['entity'] = entity_type
+            query['action'] = 'get'
+            result = await self.performAPICall(query)
+        else:
+            # if there are no criteria given, not results should be expected
+            result = {'count': 0}
+
+        if result['count']>1:
+            raise CiviAPIException("Query result not unique, please provide a unique query for 'getOrCreate'.")
+        elif result['count']==1:
+            entity = self._createEntity(entity_type, result['values'][0])
+            if update_type=='update':
+                changed = entity.update(attributes)
+            elif update_type=='fill':
+                changed = entity.fill(attributes)
+            elif update_type=='replace':
+                changed = entity.replace(attributes)
+            else:
+                raise CiviAPIException("Bad update_type '%s' selected. Must be 'update', 'fill' or 'replace'." % update_type)
+            await self.storeEntity(entity)
+            return entity
+        else:
+            query.update(attributes)
+            query['entity'] = entity_type
+            query['action'] = 'create'
+            result = await self.performAPICall(query)
+            if isinstance(result['values'], dict):
+                return self._createEntity(entity_type, result['values'][str(result['id'])])
+            else:
+                return self._createEntity(entity_type, result['values'][0])
+
+
+    async def storeEntity(self, entity, verify=False):
+        """
+        async version of entity.store(): store the attributes changed since the
+        entity was loaded. If verify is set, the entity is fetched again and all
+        attributes differing from the stored state are written instead
+        """
+        if verify:
+            result = await self.performAPICall({'entity':entity.entity_type, 'action':'get', 'id':entity.getID()})
+            current_state = result['values'][0]
+            changes = dict()
+            for key in entity.attributes:
+                if key not in current_state or entity.attributes[key]!=current_state[key]:
+                    changes[key] = entity.attributes[key]
+        else:
+            changes = entity.getChanges()
+
+        if changes:
+            # the entity's _storeChanges (adding the fields the API needs) returns our coroutine
+            await entity._storeChanges(changes)
+            entity._resetChanges()
+            self.log("Stored changes to '%s'" % str(entity), logging.INFO)
+        else:
+            self.log("No changes have been made, not storing '%s'" % str(entity), logging.INFO)
+
+
+    async def reloadEntity(self, entity):
+        """
+        async version of entity.reload()
+        """
+        result = await self.performAPICall({'entity':entity.entity_type, 'action':'get', 'id':entity.getID()})
+        entity.attributes = result['values'][0]
+        entity._resetChanges()
+
+
+    async def deleteEntity(self, entity):
+        """
+        async version of entity.delete()
+        """
+        await self.performAPICall({'entity':entity.entity_type, 'action':'delete', 'id':entity.getID()})
+
+
+    ###########################################################################
+    #                            Lookup methods                               #
+    ###########################################################################
+
+
+    async def getContactID(self, attributes, primary_attributes=['external_identifier'], search_deleted=True):
+        timestamp = time.time()
+        if 'id' in attributes:
+            return attributes['id']
+        elif 'contact_id' in attributes:
+            return attributes['contact_id']
+
+        query = dict()
+        first_key = None
+        for key in primary_attributes:
+            if key in attributes:
+                query[key] = attributes[key]
+                if first_key==None:
+                    first_key = attributes[key]
+        if not len(query) > 0:
+            self.log("No primary key provided with contact '%s'." % str(attributes),
+                logging.DEBUG, 'pycivi', 'get', 'Contact', first_key, None, time.time()-timestamp)
+            return 0
+
+        query['entity'] = 'Contact'
+        query['action'] = 'get'
+        query['return'] = 'contact_id'
+
+        result = await self.performAPICall(query)
+        if result['count']>1:
+            self.log("Query result not unique, please provide a unique query for 'getOrCreate'.",
+                logging.WARN, 'pycivi', 'get', 'Contact', first_key, None, time.time()-timestamp)
+            raise CiviAPIException("Query result not unique, please provide a unique query for 'getOrCreate'.")
+        elif result['count']==1:
+            self.log("Contact ID resolved.",
+                logging.DEBUG, 'pycivi', 'get', 'Contact', first_key, None, time.time()-timestamp)
+            return result['values'][0]['contact_id']
+        elif search_deleted and not int(attributes.get('is_deleted', '0'))==1:
+            # NOT found, but we haven't looked into the deleted contacts
+            new_attributes = dict(attributes)
+            new_attributes['is_deleted'] = '1'
+            return await self.getContactID(new_attributes, list(primary_attributes) + ['is_deleted'], search_deleted)
+        else:
+            self.log("Contact not found.",
+                logging.DEBUG, 'pycivi', 'get', 'Contact', first_key, None, time.time()-timestamp)
+            return 0
+
+
+    async def _lookup(self, cache_name, key, query, value_field='id', unique=False):
+        """
+        resolve a single value (the ID by default) with the given query, results are cached.
+
+        if unique is set, ambiguous results raise an exception, otherwise they resolve to 0
+        """
+        return await self._lookupWith(cache_name, key, lambda: self._loadValue(cache_name, key, query, value_field, unique))
+
+
+    async def _lookupWith(self, cache_name, key, load):
+        """
+        get the cached value, or resolve (and cache) it with the coroutine load()
+        """
+        value = self.lookup_cache.find(cache_name, key)
+        if value is not MISSING:
+            return value
+
+        # concurrent lookups of the same key share one API call
+        task = self._lookups.get((cache_name, key))
+        if task is None:
+            task = asyncio.ensure_future(load())
+            self._lookups[(cache_name, key)] = task
+            task.add_done_callback(lambda done: self._lookups.pop((cache_name, key), None))
+        return await asyncio.shield(task)
+
+
+    async def _loadValue(self, cache_name, key, query, value_field, unique):
+        timestamp = time.time()
+        result = await self.performAPICall(query)
+        if result['count']>1:
+            self.log("More than one %s found for '%s'!" % (query['entity'], key),
+                logging.WARN, 'API', 'get', query['entity'], None, None, time.time()-timestamp)
+            if unique:
+                raise CiviAPIException("Non-uniqe %s '%s'" % (query['entity'], key))
+            value = 0
+        elif result['count']==0:
+            value = 0
+            self.log("%s '%s' could NOT be resolved" % (query['entity'], key),
+                logging.DEBUG, 'API', 'get', query['entity'], None, None, time.time()-timestamp)
+        else:
+            value = result['values'][0][value_field]
+            self.log("%s '%s' resolved to %s" % (query['entity'], key, value),
+                logging.DEBUG, 'API', 'get', query['entity'], value, None, time.time()-timestamp)
+
+        self.lookup_cache.set(cache_name, key, value)
+        return value
+
+
+    async def getCampaignID(self, attribute_value, attribute_key='title'):
+        return await self._lookup('campaign', (attribute_key, attribute_value),
+            {'entity': 'Campaign', 'action': 'get', attribute_key: attribute_value})
+
+    async def getCustomFieldID(self, field_name, entity_type='Contact', use_label=True):
+        """
+        get the ID of the custom field of the given entity type (including
+        the contact types for 'Contact'), ambiguous names resolve to 0.
+
+        Unlike CiviCRM.getCustomFieldID, the fields are filtered by entity type,
+        so they're cached in their own namespace
+        """
+        attribute_key = 'label' if use_label else 'name'
+        key = (attribute_key, field_name, entity_type)
+
+        async def load():
+            group_ids = await self._getCustomGroupIDs(entity_type)
+            result = await self.performAPICall({'entity': 'CustomField', 'action': 'get', attribute_key: field_name,
+                                                'return': 'id,custom_group_id', 'options': {'limit': 0}}, {'json_parameters': True})
+            field_ids = [field['id'] for field in result['values'] if str(field.get('custom_group_id')) in group_ids]
+            if len(field_ids)==1:
+                value = field_ids[0]
+            else:
+                value = 0
+                self.log("Custom field '%s' of %s not found or not unique." % (field_name, entity_type),
+                    logging.DEBUG, 'API', 'get', 'CustomField', None, None, 0)
+            self.lookup_cache.set('custom_field_of_type', key, value)
+            return value
+
+        return await self._lookupWith('custom_field_of_type', key, load)
+
+    async def _getCustomGroupIDs(self, entity_type):
+        """
+        get the (string) IDs of the custom groups extending the entity type
+        """
+        async def load():
+            extends = [entity_type]
+            if entity_type == 'Contact':
+                extends += ['Individual', 'Organization', 'Household']
+            result = await self.performAPICall({'entity': 'CustomGroup', 'action': 'get', 'extends': {'IN': extends},
+                                                'return': 'id', 'options': {'limit': 0}}, {'json_parameters': True})
+            group_ids = [str(group['id']) for group in result['values']]
+            self.lookup_cache.set('custom_group_extends', entity_type, group_ids, negative=False)
+            return group_ids
+
+        return set(await self._lookupWith('custom_group_extends', entity_type, load))
+
+    async def getOptionGroupID(self, group_name):
+        return await self._lookup('option_group', group_name,
+            {'entity': 'OptionGroup', 'action': 'get', 'name': group_name})
+
+    async def getOptionValue(self, option_group_id, name):
+        return await self._lookup('option_value', (str(option_group_id), name),
+            {'entity': 'OptionValue', 'action': 'get', 'name': name, 'option_group_id': option_group_id}, 'value')
+
+    async def getOptionValueID(self, option_group_id, name):
+        return await self._lookup('option_value_id', (str(option_group_id), name),
+            {'entity': 'OptionValue', 'action': 'get', 'name': name, 'option_group_id': option_group_id})
+
+    async def getLocationTypeID(self, location_name):
+        return await self._lookup('location_type2id', location_name,
+            {'entity': 'LocationType', 'action': 'get', 'name': location_name}, unique=True)
+
+    async def getMembershipStatusID(self, membership_status_name):
+        return await self._lookup('membership_status2id', membership_status_name,
+            {'entity': 'MembershipStatus', 'action': 'get', 'name': membership_status_name}, unique=True)
+
+    async def getMembershipTypeID(self, membership_type_name):
+        return await self._lookup('membership_type2id', membership_type_name,
+            {'entity': 'MembershipType', 'action': 'get', 'name': membership_type_name}, unique=True)
+
+    async def getFinancialTypeID(self, financial_type_name):
+        return await self._lookup('financial_type2id', financial_type_name,
+            {'entity': 'FinancialType', 'action': 'get', 'name': financial_type_name}, unique=True)
@@ -37,9 +37,11 @@ import time
 import threading
 import os
 import random
-import dateutil
+import dateutil.parser
 import datetime
 import traceback
+import collections
+from concurrent.futures import Future, TimeoutError
 from distutils.version import LooseVersion
 
 
@@ -64,16 +66,43 @@ class CiviAPIException(Exception):
     pass
 
 class CiviCRM_BRIDGED(CiviCRM):
-
+    """
+    CiviCRM accessed through an asynchronous API bridge, created
+    with the wrapped instance.
+
+    options:
+      auth_user, auth_pass  HTTP basic authentication for the bridge
+      batch                 push and fetch up to batch_size calls per HTTP request,
+                            the bridge has to support the batch endpoints
+      batch_size            see batch, default is 100
+      renew_lease           replace the bridge in a background thread before it expires
+      lease_time            the number of seconds a bridge stays valid, by default this is
+                            taken from its 'expires' timestamp - which can't be compared if
+                            it has no timezone and the server is in another one than we are
+    """
 
     def __init__(self, instance, logfile=None, options=dict()):
         CiviCRM.__init__(self, logfile)
         self.wrapped_instance = instance
         self.max_exec_time = 60
         self.bridge = None
+        self.bridge_deadline = 0
+        self.bridge_lock = threading.RLock()
+        self.retired_bridges = list()
         self.calls = dict()
+        self.pushing = collections.Counter()   # id(bridge) => pushes in progress
         self.call_base    = random.randint(1000000, 9999999)
         self.call_counter = 1
+        self.calls_lock   = threading.Lock()
+        self.poll_delay   = 0.05
+        self.max_poll_delay = 2.0
+        self.batch = options.get('batch', False)
+        self.batch_size = options.get('batch_size', 100)
+        self.renew_lease = options.get('renew_lease', False)
+        self.lease_time = options.get('lease_time', None)
+        self._creation = None           # Future of the bridge being created
+        self._renewal_thread = None
+        self._renewal_stop = threading.Event()
 
         self.auth = None
         self.headers = {}
@@ -84,11 +113,220 @@ class CiviCRM_BRIDGED(CiviCRM):
 
 
     def performAPICall(self, params=dict(), execParams=dict()):
-        callID = self.queueCall(params)
-        return self.fetchCall(callID)
+        return self.gather([self.submit(params)])[0]
+
+
+
+    def performAPICalls(self, list_of_params, batch_size=None):
+        """
+        run a list of API calls through the bridge at once,
+        see CiviCRM.performAPICalls
+        """
+        futures = self.submitAll(list_of_params, batch_size)
+        results = list()
+        for result in self.gather(futures, return_exceptions=True):
+            if isinstance(result, Exception):
+                result = {'is_error': 1, 'error_message': str(result)}
+            results.append(result)
+        return results
+
+
+
+    def submit(self, params):
+        """
+        push the API call to the bridge without waiting for it.
+
+        Returns a concurrent.futures.Future, resolved by gather()
+        """
+        return self.submitAll([params])[0]
+
+
+
+    def submitAll(self, list_of_params, batch_size=None):
+        """
+        push all API calls to the bridge without waiting for them, in batches
+        of batch_size calls per request if batch mode is enabled.
+
+        Returns a list of concurrent.futures.Future, resolved by gather()
+        """
+        batch_size = batch_size or self.batch_size
+        if not self.batch:
+            batch_size = 1
+
+        futures = list()
+        for start in range(0, len(list_of_params), batch_size):
+            batch = list_of_params[start:start+batch_size]
+            bridge = self._acquireBridge()
+            if not bridge:
+                futures.extend(self._register(None, None, params) for params in batch)
+                continue
+            try:
+                if len(batch) == 1:
+                    call_ids = [self.queueCall(batch[0], bridge)]
+                else:
+                    call_ids = self.queueCalls(batch, bridge)
+                futures.extend(self._register(call_id, bridge, params) for call_id, params in zip(call_ids, batch))
+            finally:
+                with self.calls_lock:
+                    self.pushing[id(bridge)] -= 1
+                    if not self.pushing[id(bridge)]:
+                        del self.pushing[id(bridge)]
+        return futures
+
+
+
+    def _acquireBridge(self):
+        """
+        get the bridge to push calls to, marked as pushing: from here on it
+        counts as in use, so it's not closed as retired before the futures of
+        the calls pushed are registered. submitAll() releases it again.
+        """
+        while True:
+            bridge = self.getBridge()
+            if not bridge:
+                return None
+            with self.bridge_lock:
+                # unless it has been closed since getBridge() returned it
+                if bridge is self.bridge or any(retired is bridge for retired in self.retired_bridges):
+                    with self.calls_lock:
+                        self.pushing[id(bridge)] += 1
+                    return bridge
+
+
+
+    def _register(self, call_id, bridge, params):
+        """
+        create the future for a call pushed to the bridge
+        (or failed, if call_id is None)
+        """
+        future = Future()
+        future.params = params
+        if call_id is None:
+            future.set_exception(CiviAPIException("Call could not be queued, bridge not available."))
+        else:
+            future.call_id = call_id
+            future.bridge = bridge
+            with self.calls_lock:
+                self.calls[call_id] = future
+        return future
+
+
+
+    def gather(self, futures, timeout=None, return_exceptions=False):
+        """
+        wait for the futures returned by submit(), fetching the results
+        as they become ready. The bridge is polled with an exponential
+        backoff (poll_delay up to max_poll_delay) while nothing arrives.
+
+        Returns the results in the order of futures. Failed calls raise
+        their exception, or have it returned in place if return_exceptions is set.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        delay = self.poll_delay
+        while True:
+            pending = [future for future in futures if not future.done()]
+            if not pending:
+                break
+
+            if self.batch:
+                progress = self._fetchFutures(pending)
+            else:
+                progress = False
+                for future in pending:
+                    progress |= self._fetchFuture(future)
+
+            if progress:
+                delay = self.poll_delay
+            elif any(not future.done() for future in pending):
+                if deadline is not None and time.time() + delay > deadline:
+                    raise TimeoutError("%d bridged calls still pending." % len([f for f in futures if not f.done()]))
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_poll_delay)
+
+        self._closeRetiredBridges()
+
+        results = list()
+        for future in futures:
+            error = future.exception()
+            if error is not None and not return_exceptions:
+                raise error
+            results.append(error if error is not None else future.result())
+        return results
+
+
+
+    def _resolve(self, call_id, reply):
+        """
+        resolve the future for call_id with the given API reply
+        """
+        with self.calls_lock:
+            future = self.calls.pop(call_id, None)
+        if future is None or future.done():
+            return
+        if reply.get('is_error', 0):
+            future.set_exception(CiviAPIException(reply.get('error_message', 'Unknown error')))
+        else:
+            self._callCompleted(future.params.get('entity'), future.params.get('action'), future.params)
+            future.set_result(reply)
+
+
+
+    def _fail(self, future, error):
+        with self.calls_lock:
+            self.calls.pop(future.call_id, None)
+        if not future.done():
+            future.set_exception(error)
+
+
+
+    def _fetchFuture(self, future):
+        """
+        try to fetch the result for the future, returns True if it got resolved
+        """
+        try:
+            ready, reply = self._tryFetch(future.call_id, future.bridge)
+        except Exception as err:
+            self._fail(future, err)
+            return True
+        if ready:
+            self._resolve(future.call_id, reply)
+        return ready
+
+
+
+    def _fetchFutures(self, futures):
+        """
+        try to fetch the results for the futures, batch_size calls per
+        request. Returns True if any of them got resolved
+        """
+        by_bridge = dict()
+        for future in futures:
+            by_bridge.setdefault(id(future.bridge), list()).append(future)
+
+        progress = False
+        for bridge_futures in by_bridge.values():
+            bridge = bridge_futures[0].bridge
+            for start in range(0, len(bridge_futures), self.batch_size):
+                batch = bridge_futures[start:start+self.batch_size]
+                try:
+                    replies = self._tryFetchMany([future.call_id for future in batch], bridge)
+                except Exception as err:
+                    for future in batch:
+                        self._fail(future, err)
+                    progress = True
+                    continue
+                for call_id, reply in replies.items():
+                    self._resolve(call_id, reply)
+                    progress = True
+        return progress
+
+
+
+    def getSiteIdentifier(self):
+        return self.wrapped_instance.getSiteIdentifier()
+
 
 
-    
     def probe(self):
         bridge = self.getBridge()
         return bridge != None
@@ -96,60 +334,260 @@ class CiviCRM_BRIDGED(CiviCRM):
 
 
     def fetchCall(self, call_id):
-        bridge = self.getBridge()
-        if bridge:
-            url = bridge['fetch_url'] + '&call_id=' + call_id
-            reply = requests.get(url, verify=False, auth=self.auth, headers=self.headers)
+        """
+        fetch the result of the call, None if it's not (yet) available
+        """
+        ready, result = self._tryFetch(call_id)
+        return result
+
+
+
+    def _tryFetch(self, call_id, bridge=None):
+        """
+        fetch the result of the call. Returns (False, None) while the
+        call is still being processed (202, 204 or an empty reply)
+        """
+        bridge = bridge or self.getBridge()
+        if not bridge:
+            raise CiviAPIException("Bridge not available.")
+
+        url = bridge['fetch_url'] + '&call_id=' + call_id
+        reply = requests.get(url, verify=False, auth=self.auth, headers=self.headers)
+
+        if reply.status_code == 404:
+            self.bridgeExpired(bridge)
+            raise CiviAPIException("Bridge expired before call '%s' was fetched." % call_id)
+        elif reply.status_code in (202, 204) or not reply.content.strip():
+            return False, None
+        elif reply.status_code != 200:
+            raise CiviAPIException("HTML response code %d received from bridge." % reply.status_code)
+        else:
+            return True, self.codec.loads(reply.content)
 
-            if reply.status_code == 404:
-                self.bridgeExpired()
-                return None
-            else:
-                result = json.loads(reply.text)
-                return result
 
 
+    def _tryFetchMany(self, call_ids, bridge):
+        """
+        fetch the results of the calls with one request.
+        Returns {call_id: result} for the calls that are ready
+        """
+        url = bridge['fetch_url'] + '&call_ids=' + ','.join(call_ids)
+        reply = requests.get(url, verify=False, auth=self.auth, headers=self.headers)
 
-    def queueCall(self, call_data):
-        bridge = self.getBridge()
-        if bridge:
+        if reply.status_code == 404:
+            self.bridgeExpired(bridge)
+            raise CiviAPIException("Bridge expired before the calls were fetched.")
+        elif reply.status_code in (202, 204) or not reply.content.strip():
+            return dict()
+        elif reply.status_code != 200:
+            raise CiviAPIException("HTML response code %d received from bridge." % reply.status_code)
+
+        results = self.codec.loads(reply.content)
+        return dict((call_id, result) for call_id, result in results.items() if call_id in call_ids and result)
+
+
+
+    def _nextCallID(self):
+        with self.calls_lock:
             call_id = '%s-%06d' % tuple([self.call_base, self.call_counter])
             self.call_counter += 1
+        return call_id
+
+
+
+    def queueCall(self, call_data, bridge=None):
+        bridge = bridge or self.getBridge()
+        if bridge:
+            call_id = self._nextCallID()
             url = bridge['push_url'] + '&call_id=' + call_id
-            reply = requests.post(url, data=json.dumps(call_data), verify=False, auth=self.auth, headers=self.headers)
-            
+            reply = requests.post(url, data=self.codec.dumps(call_data), verify=False, auth=self.auth, headers=self.headers)
+
             if reply.status_code == 404:
-                self.bridgeExpired()
+                self.bridgeExpired(bridge)
                 return None
             else:
                 return call_id
-        
 
 
-    def bridgeExpired(self):
-        result = self.wrapped_instance.performAPICall({'action': 'delete', 'entity': 'ApiBridge', 'bridge_key': self.bridge['bridge_key']})
-        self.bridge = None
+
+    def queueCalls(self, list_of_call_data, bridge=None):
+        """
+        push all calls to the bridge with one request,
+        returns the list of call ids (None if the push failed)
+        """
+        bridge = bridge or self.getBridge()
+        if not bridge:
+            return [None] * len(list_of_call_data)
+
+        calls = dict((self._nextCallID(), call_data) for call_data in list_of_call_data)
+        url = bridge['push_url'] + '&batch=1'
+        reply = requests.post(url, data=self.codec.dumps(calls), verify=False, auth=self.auth, headers=self.headers)
+
+        if reply.status_code == 404:
+            self.bridgeExpired(bridge)
+            return [None] * len(list_of_call_data)
+        else:
+            return list(calls.keys())
+
+
+
+    def bridgeExpired(self, bridge=None):
+        """
+        delete the bridge (default: the current one)
+        """
+        with self.bridge_lock:
+            bridge = bridge or self.bridge
+            if bridge is None:
+                return
+            if bridge is self.bridge:
+                self.bridge = None
+            if bridge in self.retired_bridges:
+                self.retired_bridges.remove(bridge)
+        result = self.wrapped_instance.performAPICall({'action': 'delete', 'entity': 'ApiBridge', 'bridge_key': bridge['bridge_key']})
 
 
 
     def getBridge(self):
-        if self.bridge:
-            # check if expires soon (within max_exec_time)
-            exiration_date = dateutil.parser.parse(self.bridge['expires'])
-            current_time   = datetime.datetime.now()
-            time_diff = exiration_date - current_time
-            if time_diff.total_seconds < self.max_exec_time:
-                # this bridge is running out => close it
-                self.bridgeExpired()
-            else:
-                # this bridge is still fine
+        with self.bridge_lock:
+            if self.renew_lease and self._renewal_thread is None:
+                self._renewal_thread = threading.Thread(target=self._renewLease, name='bridge lease renewal', daemon=True)
+                self._renewal_thread.start()
+
+            bridge = self.bridge
+            if bridge:
+                # check if expires soon (within max_exec_time)
+                if self.bridge_deadline - time.monotonic() >= self.max_exec_time:
+                    # this bridge is still fine
+                    return bridge
+        return self._replaceBridge(bridge)
+
+
+
+    def _replaceBridge(self, old_bridge):
+        """
+        create a new bridge replacing old_bridge (None if there's none yet),
+        unless another thread has already replaced it. The old one is retired:
+        it's deleted as soon as all calls pushed to it are fetched.
+
+        The bridge is created without holding the bridge_lock, so the calls
+        pushed to the current one go on. Threads asking for a new bridge while
+        it's being created wait for (and use) that one.
+        """
+        with self.bridge_lock:
+            if self.bridge is not old_bridge and self.bridge:
                 return self.bridge
-
-        result = self.wrapped_instance.performAPICall({'action': 'create', 'entity': 'ApiBridge'})
-        bridge = result['values']
-        if bridge.get('bridge_key', None):
-            self.bridge = bridge
-            print("NEW BRIDGE")
-            return bridge
+            creation = self._creation
+            creating = creation is None
+            if creating:
+                creation = self._creation = Future()
+        if not creating:
+            return creation.result()
+
+        try:
+            result = self.wrapped_instance.performAPICall({'action': 'create', 'entity': 'ApiBridge'})
+            bridge = result['values']
+            if bridge.get('bridge_key', None):
+                deadline = time.monotonic() + self._getLeaseTime(bridge)
+                with self.bridge_lock:
+                    old_bridge = self.bridge
+                    self.bridge = bridge
+                    self.bridge_deadline = deadline
+                    if old_bridge:
+                        self.retired_bridges.append(old_bridge)
+                self.log("New API bridge created, expires %s" % bridge['expires'],
+                    logging.INFO, 'API', 'create', 'ApiBridge', '', '', 0)
+            else:
+                bridge = None
+            creation.set_result(bridge)
+        except BaseException as err:
+            creation.set_exception(err)
+            raise
+        finally:
+            with self.bridge_lock:
+                self._creation = None
+
+        self._closeRetiredBridges()
+        return bridge
+
+
+
+    def _getLeaseTime(self, bridge):
+        """
+        the number of seconds the (new) bridge stays valid, see lease_time.
+        This is turned into a monotonic deadline right away.
+        """
+        if self.lease_time:
+            return self.lease_time
+
+        expiration_date = dateutil.parser.parse(bridge['expires'])
+        if expiration_date.tzinfo is None:
+            # the server's local time, hopefully ours
+            time_left = (expiration_date - datetime.datetime.now()).total_seconds()
         else:
-            return
+            time_left = (expiration_date - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+        if time_left < 2 * self.max_exec_time:
+            # don't replace it with every call, expired bridges are replaced anyway
+            self.log("API bridge expires %s, less than %ds from now. If the server is in another timezone, set the 'lease_time' option." % (bridge['expires'], 2 * self.max_exec_time),
+                logging.WARN, 'API', 'create', 'ApiBridge', '', '', 0)
+            time_left = 2 * self.max_exec_time
+        return time_left
+
+
+
+    def _closeRetiredBridges(self):
+        """
+        delete the retired bridges without pending calls
+        """
+        with self.bridge_lock:
+            # submitAll() marks a bridge as pushing under the same locks
+            with self.calls_lock:
+                in_use = set(id(future.bridge) for future in self.calls.values())
+                in_use.update(self.pushing)
+            retired = [bridge for bridge in self.retired_bridges if id(bridge) not in in_use]
+            for bridge in retired:
+                self.retired_bridges.remove(bridge)
+        for bridge in retired:
+            self.bridgeExpired(bridge)
+
+
+
+    def _renewLease(self):
+        """
+        background thread replacing the bridge before it expires
+        """
+        while not self._renewal_stop.is_set():
+            with self.bridge_lock:
+                bridge = self.bridge
+                if bridge:
+                    wait = self.bridge_deadline - time.monotonic() - 2 * self.max_exec_time
+                else:
+                    # not created yet, look again soon
+                    wait = self.max_exec_time
+            if wait <= 0:
+                try:
+                    self._replaceBridge(bridge)
+                except Exception as err:
+                    self.log("Could not replace API bridge: %s" % err,
+                        logging.WARN, 'API', 'create', 'ApiBridge', '', '', 0)
+                # don't keep replacing bridges with a short lifetime
+                self._renewal_stop.wait(max(5.0, self.max_exec_time / 2))
+                continue
+            self._closeRetiredBridges()
+            self._renewal_stop.wait(min(wait, 10.0))
+
+
+
+    def close(self):
+        """
+        stop the lease renewal and delete all bridges
+        """
+        self._renewal_stop.set()
+        if self._renewal_thread is not None:
+            self._renewal_thread.join()
+            self._renewal_thread = None
+        with self.bridge_lock:
+            bridges = list(self.retired_bridges)
+            if self.bridge:
+                bridges.append(self.bridge)
+        for bridge in bridges:
+            self.bridgeExpired(bridge)
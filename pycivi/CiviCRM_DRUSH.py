@@ -38,64 +38,511 @@ import threading
 import os
 import traceback
 import subprocess
+import queue
+import weakref
 
 
 from .CiviEntity import *
 from .CiviCRM import CiviCRM
 
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'drush_server.php')
+
+
 class CiviAPIException(Exception):
     pass
 
+
+class DrushProcessError(CiviAPIException):
+    """
+    the resident drush process is gone. If sent is False,
+    the request never reached it and can safely be repeated.
+    """
+    def __init__(self, msg, sent=True):
+        super().__init__(msg)
+        self.sent = sent
+
+
+REPLY_MARKER = b'#pycivi-reply#'
+
+
+class DrushProcess(object):
+    """
+    a resident drush process running drush_server.php, answering one
+    JSON encoded API call per line. Each reply is framed as
+
+        <REPLY_MARKER><length>\n<JSON reply>\n
+
+    on a line of its own, so other output (notices, warnings), even without
+    a trailing line break, can't garble it. A reader thread collects the
+    output, so a call can give up after timeout seconds.
+    """
+
+    def __init__(self, command, codec, timeout=None):
+        self.command = command
+        self.codec = codec
+        self.timeout = timeout
+        self.process = None
+        self.calls = 0
+        self.last_used = 0
+        self._replies = None
+
+    def start(self):
+        self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.calls = 0
+        self.last_used = time.time()
+        self._replies = queue.Queue()
+        reader = threading.Thread(target=self._read, args=(self.process.stdout, self._replies), daemon=True)
+        reader.start()
+
+    @staticmethod
+    def _read(stdout, replies):
+        """
+        reader thread: pass ('output', line) for each line of other output,
+        ('reply', data) for each reply and ('eof', None) at the end to replies
+        """
+        try:
+            while True:
+                line = stdout.readline()
+                if not line:
+                    break
+                position = line.find(REPLY_MARKER)
+                if position < 0:
+                    if line.strip():
+                        replies.put(('output', line))
+                    continue
+                if line[:position].strip():
+                    replies.put(('output', line[:position] + b'\n'))
+                try:
+                    length = int(line[position+len(REPLY_MARKER):])
+                except ValueError:
+                    replies.put(('output', line))
+                    continue
+                data = stdout.read(length)
+                stdout.readline()
+                if len(data) < length:
+                    break
+                replies.put(('reply', data))
+        except (OSError, ValueError):
+            # stdout closed by stop()
+            pass
+        replies.put(('eof', None))
+
+    def isAlive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        """
+        close stdin to let the process end, kill it if it doesn't
+        """
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except (OSError, ValueError):
+            pass
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+
+    def ping(self):
+        """
+        check if the process still answers
+        """
+        try:
+            reply, output = self.call({'ping': 1}, count=False)
+        except DrushProcessError:
+            return False
+        return reply.get('pong') == 1
+
+    def call(self, request, count=True):
+        """
+        send the request, return the reply and the list of other
+        output lines (notices, warnings) received before it.
+        Unless count is False, the call counts towards max_calls.
+        """
+        try:
+            self.process.stdin.write(self.codec.dumps(request).encode('utf-8') + b'\n')
+            self.process.stdin.flush()
+        except (OSError, ValueError) as err:
+            raise DrushProcessError("drush process not available: %s" % err, sent=False)
+
+        output = list()
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        while True:
+            try:
+                if deadline is None:
+                    kind, data = self._replies.get()
+                else:
+                    kind, data = self._replies.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                # hung, its reply would confuse the next call
+                self.process.kill()
+                raise DrushProcessError("drush process didn't reply within %s seconds. Output: %s" % (self.timeout, b''.join(output)))
+            if kind == 'eof':
+                try:
+                    exit_code = self.process.wait(timeout=1)
+                except subprocess.TimeoutExpired:
+                    exit_code = None
+                raise DrushProcessError("drush process terminated (exit code %s). Output: %s" % (exit_code, b''.join(output)))
+            if kind == 'output':
+                output.append(data)
+                continue
+            try:
+                reply = self.codec.loads(data)
+            except ValueError:
+                raise DrushProcessError("drush process sent an invalid reply: %s" % data)
+            if count:
+                self.calls += 1
+            return reply, output
+
+
+class _PinnedProcess(object):
+    """
+    a process pinned to a thread, kept in the pool's threading.local.
+    When the thread ends, the holder is dropped and the finalizer
+    stops the process.
+    """
+    __slots__ = ('process', 'finalizer', '__weakref__')
+
+    def __init__(self, process, unpin):
+        self.process = process
+        self.finalizer = weakref.finalize(self, unpin, process)
+
+
+class DrushPool(object):
+    """
+    a pool of resident drush processes.
+
+    Each call borrows an idle process from the queue, or - with
+    pin_threads - every thread keeps a process of its own until it ends.
+    In both modes there are at most size processes, with pin_threads
+    further threads wait for a pinned thread to end. Processes are
+    (re)started when they are borrowed, checked with a ping if they have
+    been idle for health_check_interval seconds and recycled after
+    max_calls calls to contain PHP memory leaks.
+    """
+
+    def __init__(self, command, codec, size=1, max_calls=None, pin_threads=False, health_check_interval=60.0, timeout=None):
+        self.command = command
+        self.codec = codec
+        self.timeout = timeout
+        self.size = 0
+        self.max_calls = max_calls
+        self.pin_threads = pin_threads
+        self.health_check_interval = health_check_interval
+        self._idle = queue.Queue()
+        self._local = threading.local()
+        self._processes = list()
+        self._excess = 0
+        self._pinned = 0
+        self._lock = threading.Lock()
+        self._unpinned = threading.Condition(self._lock)
+        self.resize(size)
+
+    def _newProcess(self):
+        process = DrushProcess(self.command, self.codec, self.timeout)
+        with self._lock:
+            self._processes.append(process)
+        return process
+
+    def _discard(self, process):
+        process.stop()
+        with self._lock:
+            if process in self._processes:
+                self._processes.remove(process)
+
+    def _unpin(self, process):
+        """
+        stop a process pinned to a thread, making room for another thread
+        """
+        self._discard(process)
+        with self._unpinned:
+            self._pinned -= 1
+            self._unpinned.notify()
+
+    def resize(self, size):
+        """
+        set the number of processes shared by the calling threads
+        """
+        size = max(1, size)
+        if self.pin_threads:
+            # one process per thread, created on demand
+            with self._unpinned:
+                self.size = size
+                self._unpinned.notify_all()
+            return
+        with self._lock:
+            difference = size - self.size
+            self.size = size
+        if difference > 0:
+            for i in range(difference):
+                self._idle.put(self._newProcess())
+        else:
+            for i in range(-difference):
+                try:
+                    self._discard(self._idle.get_nowait())
+                except queue.Empty:
+                    # busy right now, drop it when it's released
+                    with self._lock:
+                        self._excess += 1
+
+    def acquire(self):
+        """
+        get a healthy, running process for exclusive use
+        """
+        if self.pin_threads:
+            pinned = getattr(self._local, 'pinned', None)
+            if pinned is None:
+                with self._unpinned:
+                    while self._pinned >= self.size:
+                        self._unpinned.wait()
+                    self._pinned += 1
+                pinned = _PinnedProcess(self._newProcess(), self._unpin)
+                self._local.pinned = pinned
+            process = pinned.process
+        else:
+            process = self._idle.get()
+
+        try:
+            if not process.isAlive():
+                process.stop()
+                process.start()
+            elif self.health_check_interval is not None and time.time() - process.last_used > self.health_check_interval:
+                if not process.ping():
+                    process.stop()
+                    process.start()
+        except OSError:
+            self.release(process)
+            raise
+        return process
+
+    def release(self, process):
+        """
+        return a process acquired before
+        """
+        process.last_used = time.time()
+        if self.max_calls and process.calls >= self.max_calls:
+            # restarted with the next acquire
+            process.stop()
+        if self.pin_threads:
+            with self._lock:
+                drop = self._pinned > self.size
+            if drop:
+                # the pool shrunk, give the process up
+                pinned = self._local.pinned
+                del self._local.pinned
+                pinned.finalizer()
+            return
+
+        with self._lock:
+            drop = self._excess > 0
+            if drop:
+                self._excess -= 1
+        if drop:
+            self._discard(process)
+        else:
+            self._idle.put(process)
+
+    def close(self):
+        """
+        stop all processes
+        """
+        with self._lock:
+            processes = list(self._processes)
+        for process in processes:
+            process.stop()
+
+
 class CiviCRM_DRUSH(CiviCRM):
 
-    def __init__(self, folder='.', drush_path='drush', site='default', logfile=None):
+    def __init__(self, folder='.', drush_path='drush', site='default', logfile=None, persistent=False, server_script=SERVER_SCRIPT,
+                 pool_size=1, max_calls=None, pin_threads=False, health_check_interval=60.0, batch_size=100, timeout=300.0):
+        """
+        if persistent is set, the API calls are passed to resident drush
+        processes running server_script instead of starting drush for each call.
+
+        pool_size resident processes are shared by the calling threads
+        (see DrushPool), parallelize() grows the pool to its number of workers.
+
+        batch_size is the default number of calls performAPICalls() sends at once.
+
+        timeout is the number of seconds to wait for drush to answer a call
+        (or batch), before the process is considered hung and stopped.
+        """
         # init some attributes
         CiviCRM.__init__(self, logfile)
         self.folder = os.path.expanduser(folder)
         self.drush_path = os.path.expanduser(drush_path)
-        self.site = 'default'
+        self.site = site
+        self.persistent = persistent
+        self.server_script = server_script
+        self.batch_size = batch_size
+        self.timeout = timeout
         self.non_parameters = {'action', 'entity', 'key', 'api_key', 'sequential', 'json'}
+        self._pool = None
+        if persistent:
+            self._pool = DrushPool(self._getServerCommand(), self.codec, pool_size, max_calls, pin_threads, health_check_interval, timeout)
 
+    def getSiteIdentifier(self):
+        return '%s#%s' % (os.path.abspath(self.folder), self.site)
 
-    def performAPICall(self, params=dict()):
-        timestamp = time.time()
+    def _getServerCommand(self):
+        return [self.drush_path, '-r', self.folder, '-l', self.site, 'php-script', self.server_script]
+
+    def setPoolSize(self, pool_size):
+        """
+        set the number of resident drush processes
+        """
+        if self._pool is not None:
+            self._pool.resize(pool_size)
+
+    def _serverCall(self, request):
+        """
+        pass the request to a resident drush process,
+        restarting it if necessary
+        """
+        process = self._pool.acquire()
+        try:
+            try:
+                reply, output = process.call(request)
+            except DrushProcessError as err:
+                process.stop()
+                if err.sent:
+                    raise
+                # the request didn't reach the old process, so it's safe to repeat it
+                process.start()
+                reply, output = process.call(request)
+        finally:
+            self._pool.release(process)
+
+        self._logOutput(request, output)
+        return reply
 
-        # build call with parameters
+    def _scriptCall(self, request):
+        """
+        pass the request to a drush process running server_script
+        that ends right after answering it
+        """
+        process = DrushProcess(self._getServerCommand(), self.codec, self.timeout)
+        process.start()
+        try:
+            reply, output = process.call(request)
+        finally:
+            process.stop()
+        self._logOutput(request, output)
+        return reply
+
+    def _logOutput(self, request, output):
+        for line in output:
+            self.log("drush output: %s" % line.decode('utf-8', 'replace').rstrip(),
+                logging.WARN, 'API', request.get('action', 'batch'), request.get('entity', ''), '', '', 0)
+
+    def _drushCall(self, entity, action, params):
+        """
+        run a single API call with its own 'drush civicrm-api' process
+        """
         call_params = [self.drush_path, '-r', self.folder, '-l', self.site, 'civicrm-api', '--out=json', '--in=json']
-        call_params.append(params['entity'] + '.' + params['action'])
-        
+        call_params.append(entity + '.' + action)
+        drush = subprocess.Popen(call_params, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+            reply = drush.communicate(input=self.codec.dumps(params).encode('utf-8'), timeout=self.timeout)[0]
+        except subprocess.TimeoutExpired:
+            drush.kill()
+            drush.communicate()
+            raise DrushProcessError("drush didn't reply within %s seconds" % self.timeout)
+        return self.codec.loads(reply)
+
+    def close(self):
+        """
+        stop the resident drush processes
+        """
+        if self._pool is not None:
+            self._pool.close()
+
+    def _buildRequest(self, params):
         # remove unsuitable parameters
+        call_params = params.copy()
         for non_param in self.non_parameters:
-            params.pop(non_param, None)
-        query = json.dumps(params)
-
-        try:
-            drush = subprocess.Popen(call_params, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.STDOUT)
-            reply = drush.communicate(input=query)[0]
+            call_params.pop(non_param, None)
+        return {'entity': params['entity'], 'action': params['action'], 'params': call_params}
 
-            self.log("API call completed - parameters: '%s'" % str(call_params), 
-                logging.DEBUG, 'API', params.get('action', "NO ACTION SET"), params.get('entity', "NO ENTITY SET!"), params.get('id', ''), params.get('external_identifier', ''), time.time()-timestamp)
+    def performAPICalls(self, list_of_params, batch_size=None):
+        """
+        run a list of API calls, sending batch_size (default: self.batch_size)
+        calls to a single drush process at once, so the bootstrap is paid per
+        batch rather than per call.
 
-            result = json.loads(reply)
+        Returns the results in the same order. A failing call doesn't affect
+        the others, its result is an API error reply (is_error set). If drush
+        itself fails, all calls of the batch get an error reply.
+        """
+        batch_size = batch_size or self.batch_size
+        results = list()
+        for start in range(0, len(list_of_params), batch_size):
+            timestamp = time.time()
+            calls = [self._buildRequest(params) for params in list_of_params[start:start+batch_size]]
+            request = {'calls': calls}
+            try:
+                if self.persistent:
+                    batch_results = self._serverCall(request)['results']
+                else:
+                    batch_results = self._scriptCall(request)['results']
+            except (CiviAPIException, OSError, ValueError, KeyError) as err:
+                self._countError()
+                self.log("API batch call failed: %s" % err,
+                    logging.ERROR, 'API', 'batch', '', '', '', time.time()-timestamp)
+                batch_results = [{'is_error': 1, 'error_message': "DRUSH failed: %s" % err} for call in calls]
 
-            # do some logging
             runtime = time.time()-timestamp
-            self._api_calls += 1
-            self._api_calls_time += runtime
-
-            if 'undefined_fields' in result:
-                fields = result['undefined_fields']
-                if fields:
-                    self.log("API call: Undefined fields reported: %s" % str(fields), 
-                        logging.DEBUG, 'API', params['action'], params['entity'], params.get('id', ''), params.get('external_identifier', ''), time.time()-timestamp)
-
-            if result['is_error']:
-                self.log("API call error: '%s'" % result['error_message'], 
-                    logging.ERROR, 'API', params['action'], params['entity'], params.get('id', ''), params.get('external_identifier', ''), time.time()-timestamp)
-                raise CiviAPIException(result['error_message'])
-            else:
-                return result
+            self._countCalls(runtime, len(calls))
+            self.log("API batch call completed - %d calls" % len(calls),
+                logging.DEBUG, 'API', 'batch', '', '', '', runtime)
+            for call, result in zip(calls, batch_results):
+                if not result.get('is_error'):
+                    self._callCompleted(call['entity'], call['action'], call['params'])
+            results.extend(batch_results)
+        return results
+
+    def performAPICall(self, params=dict(), execParams=dict()):
+        timestamp = time.time()
+        request = self._buildRequest(params)
+        entity = request['entity']
+        action = request['action']
+        params = request['params']
 
-        except:
+        try:
+            if self.persistent:
+                result = self._serverCall(request)
+            else:
+                result = self._drushCall(entity, action, params)
+        except DrushProcessError:
+            self._countError()
+            raise
+        except (OSError, ValueError):
+            self._countError()
             raise CiviAPIException("DRUSH failed! Please check paths.")
 
+        self.log("API call completed - %s.%s" % (entity, action),
+            logging.DEBUG, 'API', action, entity, params.get('id', ''), params.get('external_identifier', ''), time.time()-timestamp)
+
+        # do some logging
+        runtime = time.time()-timestamp
+        self._countCalls(runtime)
+
+        if 'undefined_fields' in result:
+            fields = result['undefined_fields']
+            if fields:
+                self.log("API call: Undefined fields reported: %s" % str(fields),
+                    logging.DEBUG, 'API', action, entity, params.get('id', ''), params.get('external_identifier', ''), time.time()-timestamp)
+
+        if result['is_error']:
+            self.log("API call error: '%s'" % result['error_message'],
+                logging.ERROR, 'API', action, entity, params.get('id', ''), params.get('external_identifier', ''), time.time()-timestamp)
+            raise CiviAPIException(result['error_message'])
+        else:
+            self._callCompleted(entity, action, params)
+            return result
@@ -37,9 +37,22 @@ import time
 import threading
 import os
 import traceback
+import random
+import collections
+import email.utils
+import tempfile
 import requests
+try:
+    import fcntl
+except ImportError:
+    # no inter-process locking of the endpoint cache (Windows)
+    fcntl = None
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
 from distutils.version import LooseVersion
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.exceptions import NewConnectionError
 
 from .CiviEntity import *
 from .CiviCRM import CiviCRM
@@ -51,30 +64,147 @@ if LooseVersion(requests.__version__) < LooseVersion('1.1.0'):
     sys.exit(1)
 
 
+class CircuitBreaker(object):
+    """
+    Pauses all callers sharing this breaker for 'pause' seconds, as soon as
+    the error rate of the last 'window' calls reaches 'threshold'.
+    """
+    def __init__(self, threshold=0.5, window=20, min_calls=10, pause=30.0):
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.pause = pause
+        self.outcomes = collections.deque(maxlen=window)
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def isOpen(self):
+        return time.monotonic() < self.open_until
+
+    def wait(self):
+        """
+        block while the breaker is open
+        """
+        delay = self.open_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def record(self, success):
+        """
+        record the outcome of a call, returns True if this tripped the breaker
+        """
+        with self.lock:
+            self.outcomes.append(success)
+            if len(self.outcomes) < self.min_calls:
+                return False
+            error_rate = float(self.outcomes.count(False)) / len(self.outcomes)
+            if error_rate < self.threshold:
+                return False
+            self.open_until = time.monotonic() + self.pause
+            self.outcomes.clear()
+            return True
+
+
+class RetryPolicy(object):
+    """
+    Defines if and when a failed API call is repeated:
+
+    Calls failing with one of the given response codes, or with a transport
+    error (connection refused/reset, timeout) are retried up to 'retakes' times,
+    calls changing data (create, delete, ...) only if the request can't have
+    reached the server (connection refused or timed out while connecting),
+    waiting a random time between 0 and base_delay * 2^attempt (but at most
+    max_delay) - or the time the server asked for via 'Retry-After', plus the
+    same random jitter, so the workers don't all retry at the same moment.
+    An optional (shared) CircuitBreaker pauses all calls if the server is overloaded.
+    """
+    # exceptions raised by requests when the server is unreachable or overloaded
+    TRANSPORT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+    def __init__(self, retakes=3, base_delay=0.5, max_delay=30.0, codes=list(range(500, 600)) + [429], circuit_breaker=None):
+        self.retakes = retakes
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.codes = codes
+        self.circuit_breaker = circuit_breaker
+
+    def isServerError(self, error):
+        """
+        check if the exception means the server (or the connection) failed
+        """
+        if isinstance(error, self.TRANSPORT_ERRORS):
+            return True
+        return getattr(error, 'code', None) in self.codes
+
+    def isRetriable(self, error, action=None):
+        """
+        check if the call can be repeated: read calls after any server error,
+        others only if the request was never sent - replaying a create that
+        timed out after the server committed it would create a duplicate
+        """
+        if not self.isServerError(error):
+            return False
+        if not isinstance(error, self.TRANSPORT_ERRORS) or str(action).lower().startswith('get'):
+            return True
+        return _wasNotSent(error)
+
+    def getDelay(self, attempt, retry_after=None):
+        jitter = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            return min(retry_after, self.max_delay) + jitter
+        return jitter
+
+
+def _wasNotSent(error):
+    """
+    check if the transport error happened before the request was sent,
+    i.e. the connection could not be established
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        reason = getattr(error.args[0], 'reason', error.args[0])
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
 class ApiCallRepeater(object):
+    # defaults for instances without a retry_policy
     RETAKES = 0
     SLEEP = 0
     CODES = list(range(500, 600))
 
     def __call__(self, method):
         def new_method(obj, *args, **kwargs):
-            counter = self.RETAKES
-            while counter:
-                counter -= 1
+            policy = getattr(obj, 'retry_policy', None)
+            if policy is None:
+                policy = RetryPolicy(self.RETAKES, self.SLEEP, self.SLEEP, self.CODES)
+            breaker = policy.circuit_breaker
+
+            attempt = 0
+            while True:
+                if breaker:
+                    breaker.wait()
                 try:
-                    result =  method(obj, *args, **kwargs)
-                except CiviAPIException as error:
-                    if counter and error.code in self.CODES:
-                        retakes = abs(counter - self.RETAKES)
-                        obj.log("Response Code {}: Let's try again... ({}/{})".format(error.code, retakes, self.RETAKES),
+                    result = method(obj, *args, **kwargs)
+                except (CiviAPIException,) + RetryPolicy.TRANSPORT_ERRORS as error:
+                    server_error = policy.isServerError(error)
+                    if breaker and breaker.record(not server_error):
+                        obj.log("Error rate too high, pausing all calls for {}s".format(breaker.pause),
+                            logging.WARN, 'ApiCallRepeater', None, None, None, None, None)
+                    params = args[0] if args else kwargs.get('params', dict())
+                    if policy.isRetriable(error, params.get('action')) and attempt < policy.retakes:
+                        attempt += 1
+                        delay = policy.getDelay(attempt, getattr(error, 'retry_after', None))
+                        reason = "Response Code {}".format(error.code) if isinstance(error, CiviAPIException) else type(error).__name__
+                        obj.log("{}: Let's try again in {:.1f}s... ({}/{})".format(reason, delay, attempt, policy.retakes),
                             logging.WARN, 'ApiCallRepeater', None, None, None, None, None)
-                        time.sleep(self.SLEEP)
+                        time.sleep(delay)
                     else:
                         raise
                 else:
+                    if breaker:
+                        breaker.record(True)
                     return result
-            else:
-                return method(obj, *args, **kwargs)
 
         return new_method
 
@@ -82,14 +212,102 @@ api_call_repeater = ApiCallRepeater()
 
 
 class CiviAPIException(Exception):
-    def __init__(self, msg, code=None):
+    def __init__(self, msg, code=None, retry_after=None):
         self.msg = msg
         self.code = code
+        self.retry_after = retry_after
 
     def __str__(self):
         return self.msg
 
 
+def _getRetryAfter(reply):
+    """
+    extract the 'Retry-After' header (seconds or HTTP date) in seconds
+    """
+    value = reply.headers.get('Retry-After', None)
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_date.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _exceedsGetLength(url, params, max_get_length):
+    """
+    check if the call would produce a GET URL longer than max_get_length
+    """
+    if not max_get_length:
+        return False
+    return len(url) + 1 + len(urlencode(params, doseq=True)) > max_get_length
+
+
+DEFAULT_ENDPOINT_CACHE = os.path.join(os.path.expanduser('~'), '.pycivi_endpoints.json')
+
+
+def _readEndpointCache(path):
+    """
+    read the {base url: rest url} map from the endpoint cache file
+    """
+    try:
+        with open(path, 'r') as cache_file:
+            endpoints = json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        return dict()
+    if not isinstance(endpoints, dict):
+        return dict()
+    return endpoints
+
+
+def _writeEndpointCache(path, base_url, rest_url):
+    """
+    set (or remove, if rest_url is None) the entry for base_url in the
+    endpoint cache file. The read-modify-write runs under an exclusive
+    lock on <path>.lock, so concurrent worker processes don't lose each
+    other's entries, and the file is replaced atomically, so readers
+    never see a half written file.
+    """
+    try:
+        lock_file = open(path + '.lock', 'a')
+    except (IOError, OSError):
+        # the cache is only an optimisation
+        return
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        endpoints = _readEndpointCache(path)
+        if rest_url is None:
+            if base_url not in endpoints:
+                return
+            del endpoints[base_url]
+        else:
+            if endpoints.get(base_url) == rest_url:
+                return
+            endpoints[base_url] = rest_url
+
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, tmp_path = tempfile.mkstemp(dir=directory, prefix='.pycivi_endpoints')
+        try:
+            with os.fdopen(handle, 'w') as cache_file:
+                json.dump(endpoints, cache_file)
+            os.replace(tmp_path, path)
+        except (IOError, OSError):
+            os.unlink(tmp_path)
+            raise
+    except (IOError, OSError):
+        # the cache is only an optimisation
+        pass
+    finally:
+        # closing the file releases the lock
+        lock_file.close()
+
+
 class CiviCRM_REST(CiviCRM):
 
     URL_PATHS = [
@@ -103,7 +321,9 @@ class CiviCRM_REST(CiviCRM):
         "\"Prefer standalone scripts\" here: \"../civicrm/admin/setting/url\"."
 
     def __init__(self, url, site_key, user_key, logfile=None, htaccess=None,
-                 force_post=False, debug=False, verify_ssl=True, json_params=None):
+                 force_post=False, debug=False, verify_ssl=True, json_params=None,
+                 pool_size=10, keep_alive=True, retry_policy=None, max_get_length=2000,
+                 probe_url=True, endpoint_cache=None):
         # init some attributes
         super().__init__(logfile)
         self.url = url
@@ -113,10 +333,23 @@ class CiviCRM_REST(CiviCRM):
         self.debug = debug
         self.verify_ssl = verify_ssl
         self.json_parameters = json_params
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.retry_policy = retry_policy
+        self.max_get_length = max_get_length
+        if endpoint_cache is True:
+            endpoint_cache = DEFAULT_ENDPOINT_CACHE
+        self.endpoint_cache = endpoint_cache
+        self.probe_url = probe_url
 
         self.headers = {}
         self.auth = None
         self.rest_url = None
+        self.base_url = None
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._probe_lock = threading.Lock()
+        self._endpoint_stale = False
 
         if htaccess and 'auth_user' in htaccess and 'auth_pass' in htaccess:
             self.auth = HTTPBasicAuth(htaccess['auth_user'], htaccess['auth_pass'])
@@ -125,31 +358,155 @@ class CiviCRM_REST(CiviCRM):
         if url.endswith('extern/rest.php'):
             # in this case it's fine, this is the rest URL
             self.rest_url = url
-            self.test_rest_api(self.rest_url)
+            if probe_url:
+                self.test_rest_api(self.rest_url)
         else:
             if url.endswith('/civicrm'):
                 url = url[:-8]
+            self.base_url = url.rstrip('/')
 
-            exceptions = list()
-            for path in self.URL_PATHS:
-                rest_url = url.rstrip('/') + path
-                try:
-                    self.test_rest_api(rest_url)
-                except CiviAPIException as exc:
-                    exceptions.append(exc)
-                else:
-                    self.rest_url = rest_url
-                    break
+            if self.endpoint_cache:
+                self.rest_url = _readEndpointCache(self.endpoint_cache).get(self.base_url)
 
             if not self.rest_url:
-                msg = '\n\n'.join(e.msg for e in exceptions)
-                msg += self.API_ERROR_MSG
-                raise CiviAPIException(msg)
+                if probe_url:
+                    self.rest_url = self._probeRestURL(self.base_url)
+                else:
+                    self.rest_url = self.base_url + self.URL_PATHS[0]
+                if self.endpoint_cache and probe_url:
+                    _writeEndpointCache(self.endpoint_cache, self.base_url, self.rest_url)
+
+    def _getTransport(self):
+        """
+        get the object to send the HTTP requests with:
+
+        a shared requests.Session keeping up to pool_size connections alive,
+        or the requests module itself (a new connection per call) if
+        keep_alive is disabled.
+        """
+        if not self.keep_alive:
+            return requests
+
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    self._mountAdapter(session)
+                    self._session = session
+        return self._session
+
+    def _mountAdapter(self, session):
+        """
+        mount a new adapter with pool_size connections, closing the
+        connections pooled by the adapter it replaces
+        """
+        old_adapters = set(session.adapters.get(prefix) for prefix in ('http://', 'https://'))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        for old_adapter in old_adapters:
+            if old_adapter is not None:
+                old_adapter.close()
+
+    def setPoolSize(self, pool_size):
+        """
+        set the number of connections kept alive, this should
+        match the number of threads using this instance
+        """
+        with self._session_lock:
+            if pool_size == self.pool_size:
+                return
+            self.pool_size = pool_size
+            if self._session is not None:
+                self._mountAdapter(self._session)
+
+    def close(self):
+        """
+        close all pooled connections
+        """
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def getSiteIdentifier(self):
+        return self.rest_url
+
+    def _probeRestURL(self, base_url):
+        """
+        test all candidate paths at the same time,
+        the first working one in the order of URL_PATHS wins
+        """
+        def probe(path):
+            rest_url = base_url + path
+            try:
+                self.test_rest_api(rest_url)
+            except CiviAPIException as exc:
+                return exc
+            return None
+
+        with ThreadPoolExecutor(max_workers=len(self.URL_PATHS)) as executor:
+            results = list(executor.map(probe, self.URL_PATHS))
+
+        for path, error in zip(self.URL_PATHS, results):
+            if error is None:
+                return base_url + path
+
+        msg = '\n\n'.join(e.msg for e in results)
+        msg += self.API_ERROR_MSG
+        raise CiviAPIException(msg)
+
+    def _dropCachedEndpoint(self):
+        """
+        remove the resolved rest_url from the endpoint cache, and
+        make the next call probe for it again
+        """
+        if self.base_url:
+            if self.endpoint_cache:
+                _writeEndpointCache(self.endpoint_cache, self.base_url, None)
+            if self.probe_url:
+                self._endpoint_stale = True
+
+    def _reprobeRestURL(self):
+        """
+        probe for the rest_url again after it stopped working,
+        only one thread probes, the others wait for the result
+        """
+        with self._probe_lock:
+            if not self._endpoint_stale:
+                return
+            self.rest_url = self._probeRestURL(self.base_url)
+            self._endpoint_stale = False
+            self.log("REST endpoint probed again: %s" % self.rest_url,
+                logging.INFO, 'API', 'probe', None, None, None, 0)
+            if self.endpoint_cache:
+                _writeEndpointCache(self.endpoint_cache, self.base_url, self.rest_url)
+
+    def _send(self, params, post, headers=None):
+        """
+        send the request, invalidating a cached endpoint if it is not
+        there (anymore). Transport errors don't, those are usually
+        transient and left to the retry_policy
+        """
+        if self._endpoint_stale:
+            self._reprobeRestURL()
+        transport = self._getTransport()
+        try:
+            if post:
+                reply = transport.post(self.rest_url, data=params, verify=self.verify_ssl, auth=self.auth, headers=headers)
+            else:
+                reply = transport.get(self.rest_url, params=params, verify=self.verify_ssl, auth=self.auth, headers=headers)
+        except requests.exceptions.RequestException:
+            self._countError()
+            raise
+        if reply.status_code == 404 or reply.history:
+            self._dropCachedEndpoint()
+        return reply
 
     def test_rest_api(self, url):
         msg = "The api is not reachable at: {}".format(url)
         try:
-            reply = requests.get(url, verify=self.verify_ssl, auth=self.auth)
+            reply = self._getTransport().get(url, verify=self.verify_ssl, auth=self.auth)
         except Exception as exc:
             msg += "\nAn error occured:"
             msg += "\n{}: {}".format(type(exc).__name__, exc)
@@ -161,9 +518,20 @@ class CiviCRM_REST(CiviCRM):
             msg += "\nError code was: {}".format(reply.status_code)
             raise CiviAPIException(msg)
 
+    def _decodeReply(self, reply):
+        """
+        parse the reply straight from the received bytes,
+        falling back to the text decoded by requests
+        """
+        try:
+            return self.codec.loads(reply.content)
+        except ValueError:
+            return json.loads(reply.text)
+
     @api_call_repeater
     def performAPICall(self, params=dict(), execParams=dict()):
         timestamp = time.time()
+        call_params = params
         params = params.copy()
         params['api_key'] = self.user_key
         params['key'] = self.site_key
@@ -173,14 +541,14 @@ class CiviCRM_REST(CiviCRM):
         if self.debug:
             params['debug'] = 1
 
-        if self.json_parameters:
+        if self.json_parameters or execParams.get('json_parameters', False):
             # pack complex parameters into a serialised json block
             not_json = ['api_key', 'key', 'action', 'entity']
             json_params = dict()
-            for param in params.keys():
+            for param in list(params.keys()):
                 if not param in not_json:
                     json_params[param] = params.pop(param)
-            params['json'] = json.dumps(json_params)
+            params['json'] = self.codec.dumps(json_params)
 
         # check for complex parameters
         for param in params:
@@ -190,10 +558,8 @@ class CiviCRM_REST(CiviCRM):
                 break
 
         forcePost = execParams.get('forcePost', False) or self.forcePost
-        if (params['action'] in ['create', 'delete']) or forcePost:
-            reply = requests.post(self.rest_url, data=params, verify=self.verify_ssl, auth=self.auth, headers=self.headers)
-        else:
-            reply = requests.get(self.rest_url, params=params, verify=self.verify_ssl, auth=self.auth, headers=self.headers)
+        post = (params['action'] in ['create', 'delete']) or forcePost or _exceedsGetLength(self.rest_url, params, self.max_get_length)
+        reply = self._send(params, post, self.headers)
 
         self.log("API call completed - status: %d, url: '%s'" % (reply.status_code, reply.url),
             logging.DEBUG, 'API', params.get('action', "NO ACTION SET"), params.get('entity', "NO ENTITY SET!"), params.get('id', ''), params.get('external_identifier', ''), time.time()-timestamp)
@@ -201,19 +567,19 @@ class CiviCRM_REST(CiviCRM):
         if reply.status_code == 414:
             raise CiviAPIException("Request is too long, please check server settings or use forcePost")
         elif reply.status_code != 200:
-            raise CiviAPIException("HTML response code %d received, please check URL" % reply.status_code, reply.status_code)
+            self._countError()
+            raise CiviAPIException("HTML response code %d received, please check URL" % reply.status_code, reply.status_code, _getRetryAfter(reply))
 
         try:
-            result = json.loads(reply.text)
-        except json.decoder.JSONDecodeError as exc:
+            result = self._decodeReply(reply)
+        except ValueError as exc:
             print('Unable to parse reply as json:')
             print(reply.text)
             raise exc
 
         # do some logging
         runtime = time.time()-timestamp
-        self._api_calls += 1
-        self._api_calls_time += runtime
+        self._countCalls(runtime)
 
         if 'undefined_fields' in result:
             fields = result['undefined_fields']
@@ -226,6 +592,7 @@ class CiviCRM_REST(CiviCRM):
                 logging.ERROR, 'API', params['action'], params['entity'], params.get('id', ''), params.get('external_identifier', ''), time.time()-timestamp)
             raise CiviAPIException(result['error_message'])
         else:
+            self._callCompleted(call_params.get('entity'), call_params.get('action'), call_params)
             return result
 
     @api_call_repeater
@@ -239,19 +606,18 @@ class CiviCRM_REST(CiviCRM):
         if self.debug:
             params['debug'] = 1
 
-        if (params['action'] in ['create', 'delete']) or (execParams.get('forcePost', False)):
-            reply = requests.post(self.rest_url, data=params, verify=self.verify_ssl, auth=self.auth)
-        else:
-            reply = requests.get(self.rest_url, params=params, verify=self.verify_ssl, auth=self.auth)
+        post = (params['action'] in ['create', 'delete']) or (execParams.get('forcePost', False)) or _exceedsGetLength(self.rest_url, params, self.max_get_length)
+        reply = self._send(params, post)
 
         self.log("API call completed - status: %d, url: '%s'" % (reply.status_code, reply.url),
             logging.DEBUG, 'API', params.get('action', "NO ACTION SET"), params.get('entity', "NO ENTITY SET!"), params.get('id', ''), params.get('external_identifier', ''), time.time()-timestamp)
 
         if reply.status_code != 200:
-            raise CiviAPIException("HTML response code %d received, please check URL" % reply.status_code, reply.status_code)
+            self._countError()
+            raise CiviAPIException("HTML response code %d received, please check URL" % reply.status_code, reply.status_code, _getRetryAfter(reply))
 
         try:
-            result = json.loads(reply.text)
+            result = self._decodeReply(reply)
         except ValueError as err:
             self.log('Error: {0}. String: {1}'.format(err, reply.text),
                 logging.ERROR, 'API', params.get('action', "NO ACTION SET"), params.get('entity', "NO ENTITY SET!"), params.get('id', ''), params.get('external_identifier', ''), time.time()-timestamp)
@@ -259,8 +625,7 @@ class CiviCRM_REST(CiviCRM):
 
         # do some logging
         runtime = time.time()-timestamp
-        self._api_calls += 1
-        self._api_calls_time += runtime
+        self._countCalls(runtime)
 
         if 'undefined_fields' in result:
             fields = result['undefined_fields']
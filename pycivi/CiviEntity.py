@@ -30,57 +30,177 @@ __email__       = "endres[at]systopia.de"
 
 from . import entity_type
 import logging
+import collections.abc
+
+class CiviAttributes(collections.abc.MutableMapping):
+    """
+    entity.attributes: a view of the entity's attributes, setting
+    them through it marks them as changed (see CiviEntity.getChanges).
+
+    This is not a dict: isinstance(entity.attributes, dict) is False and
+    the json module can't serialize it (pycivi's codecs can). Use
+    entity.attributes.copy() where a real dict is needed.
+    """
+    __slots__ = ('entity',)
+
+    def __init__(self, entity):
+        self.entity = entity
+
+    def __getitem__(self, key):
+        return self.entity._data[key]
+
+    def get(self, key, default=None):
+        return self.entity._data.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.entity._data
+
+    def __iter__(self):
+        return iter(self.entity._data)
+
+    def __len__(self):
+        return len(self.entity._data)
+
+    def __repr__(self):
+        return repr(self.entity._data)
+
+    def keys(self):
+        return self.entity._data.keys()
+
+    def items(self):
+        return self.entity._data.items()
+
+    def values(self):
+        return self.entity._data.values()
+
+    def copy(self):
+        return dict(self.entity._data)
+
+    def __setitem__(self, key, value):
+        self.entity._setAttribute(key, value)
+
+    def __delitem__(self, key):
+        del self.entity._data[key]
+
+
+class CiviEntity(object):
+    # entities are created for every row fetched, so keep them small:
+    # the attributes are kept as loaded (_data), the view entity.attributes
+    # is only created when accessed
+    __slots__ = ('entity_type', '_data', 'civicrm', '_original', '_dirty')
 
-class CiviEntity:
     def __init__(self, entity_type, entity_id, civicrm, attributes=dict()):
         self.entity_type = entity_type
-        self.attributes = attributes
+        self._data = attributes
         self.civicrm = civicrm
-        self.attributes['id'] = entity_id
+        self._data['id'] = entity_id
+        self._resetChanges()
+
+    @property
+    def attributes(self):
+        return CiviAttributes(self)
+
+    @attributes.setter
+    def attributes(self, attributes):
+        # assigned attributes are considered to be the stored state
+        self._data = attributes if isinstance(attributes, dict) else dict(attributes)
+        self._resetChanges()
 
     def __str__(self):
         return '{} entity [{}]'.format(self.entity_type, self.getInt('id'))
 
     def get(self, attribute_key, default_value=None):
-        return self.attributes.get(attribute_key, default_value)
+        return self._data.get(attribute_key, default_value)
 
     def getInt(self, attribute_key):
-        return int(self.attributes.get(attribute_key, -1))
+        return int(self._data.get(attribute_key, -1))
 
     def getID(self):
         return self.get('id')
 
     def set(self, attribute_key, new_value):
-        self.attributes[attribute_key] = new_value
+        self._setAttribute(attribute_key, new_value)
+
+    def _setAttribute(self, attribute_key, new_value):
+        """
+        set the attribute and mark it as changed. The attributes as loaded
+        are only copied (as the original state) on the first change
+        """
+        if self._dirty is None:
+            self._original = dict(self._data)
+            self._dirty = set()
+        self._data[attribute_key] = new_value
+        self._dirty.add(attribute_key)
+
+    def _resetChanges(self):
+        """
+        declare the current attributes to be the stored state
+        """
+        self._original = None
+        self._dirty = None
+
+    def getChanges(self):
+        """
+        get the attributes that have been changed since the entity was
+        loaded (or stored), leaving out the ones that have been set back
+        (or removed). This includes writes to entity.attributes[...]
+        """
+        changes = dict()
+        if self._dirty:
+            for key in self._dirty:
+                if key in self._data and (key not in self._original or self._original[key]!=self._data[key]):
+                    changes[key] = self._data[key]
+        return changes
+
+    def _getCiviCRM(self, civi=None):
+        """
+        get the CiviCRM instance for the entity's API calls (civi, or the one
+        the entity came from). These calls are synchronous, so entities of an
+        asynchronous implementation have to be handled by its coroutines instead
+        """
+        if civi==None: civi = self.civicrm
+        if getattr(civi, 'asynchronous', False):
+            raise TypeError("Entities of %s can't do API calls themselves, use its coroutines (e.g. 'await civicrm.storeEntity(entity)') instead." % civi.__class__.__name__)
+        return civi
 
     def _storeChanges(self, changed_attributes):
         if changed_attributes:
             request = dict(changed_attributes)
             request['action'] = 'create'
             request['entity'] = self.entity_type
-            request['id'] = self.attributes['id']
-            self.civicrm.performAPICall(request)
+            request['id'] = self._data['id']
+            return self.civicrm.performAPICall(request)
+
+    def _storeAndReset(self, changed, store):
+        """
+        store the changed attributes (if requested), all pending changes
+        are considered stored then
+        """
+        if store:
+            self._getCiviCRM()
+            changes = self.getChanges()
+            changes.update(changed)
+            self._storeChanges(changes)
+            self._resetChanges()
 
     # update all provided attributes.
     def update(self, attributes, store=False):
         changed = dict()
         for key in attributes.keys():
-            if (self.attributes.get(key, None)!=attributes[key]):
-                self.attributes[key] = attributes[key]
-                changed[key] = self.attributes[key]
-        if store:
-            self._storeChanges(changed)
+            if (self._data.get(key, None)!=attributes[key]):
+                self._setAttribute(key, attributes[key])
+                changed[key] = self._data[key]
+        self._storeAndReset(changed, store)
         return changed
 
     # fill all provided attributes, i.e. do not overwrite any data, only set the ones that hadn't been set before
     def fill(self, attributes, store=False):
         changed = dict()
         for key in attributes.keys():
-            if not self.attributes.get(key, None):
-                self.attributes[key] = attributes[key]
-                changed[key] = self.attributes[key]
-        if store:
-            self._storeChanges(changed)
+            if not self._data.get(key, None):
+                self._setAttribute(key, attributes[key])
+                changed[key] = self._data[key]
+        self._storeAndReset(changed, store)
         return changed
 
 
@@ -88,50 +208,62 @@ class CiviEntity:
     def replace(self, attributes, store=False):
         changed = dict()
         for key in attributes.keys():
-            if key in self.attributes:
-                if (self.attributes[key]!=attributes[key]):
-                    self.attributes[key] = attributes[key]
-                    changed[key] = self.attributes[key]
-        if store:
-            self._storeChanges(changed)
+            if key in self._data:
+                if (self._data[key]!=attributes[key]):
+                    self._setAttribute(key, attributes[key])
+                    changed[key] = self._data[key]
+        self._storeAndReset(changed, store)
         return changed
 
 
     def reload(self, civi=None):
-        if civi==None: civi = self.civicrm
-        result = civi.performAPICall({'entity':self.entity_type, 'action':'get', 'id':self.attributes['id']})
+        civi = self._getCiviCRM(civi)
+        result = civi.performAPICall({'entity':self.entity_type, 'action':'get', 'id':self._data['id']})
         self.attributes = result['values'][0]
+        self._resetChanges()
 
 
-    def store(self, civi=None):
-        if civi==None: civi = self.civicrm
-        result = civi.performAPICall({'entity':self.entity_type, 'action':'get', 'id':self.attributes['id']})
-        current_state = result['values'][0]
+    def store(self, civi=None, verify=False):
+        """
+        store the attributes changed since the entity was loaded (see getChanges).
 
-        # find the fields that have changed
-        changes = dict()
-        for key in self.attributes:
-            if key not in current_state or self.attributes[key]!=current_state[key]:
-                changes[key] = self.attributes[key]
+        If verify is set, the entity is fetched again and all attributes
+        differing from the stored state are written instead
+        """
+        civi = self._getCiviCRM(civi)
+        if verify:
+            result = civi.performAPICall({'entity':self.entity_type, 'action':'get', 'id':self._data['id']})
+            current_state = result['values'][0]
+
+            # find the fields that have changed
+            changes = dict()
+            for key in self._data:
+                if key not in current_state or self._data[key]!=current_state[key]:
+                    changes[key] = self._data[key]
+        else:
+            changes = self.getChanges()
 
         if changes:
             self._storeChanges(changes)
-            civi.log("Stored changes to '%s'" % str(str(self), 'utf8'), logging.INFO)
+            self._resetChanges()
+            civi.log("Stored changes to '%s'" % str(self), logging.INFO)
         else:
-            civi.log("No changes have been made, not storing '%s'" % str(str(self), 'utf8'), logging.INFO)
+            civi.log("No changes have been made, not storing '%s'" % str(self), logging.INFO)
 
 
     def delete(self, final=True, civi=None):
-        if civi==None: civi = self.civicrm
-        civi.performAPICall({'entity':self.entity_type, 'action':'delete', 'id':self.attributes['id']})
+        civi = self._getCiviCRM(civi)
+        civi.performAPICall({'entity':self.entity_type, 'action':'delete', 'id':self._data['id']})
 
 
 
 class CiviTaggableEntity(CiviEntity):
-    pass
+    __slots__ = ()
 
 
 class CiviContactEntity(CiviTaggableEntity):
+    __slots__ = ()
+
     def __str__(self):
         return '{} [{}]'.format(self.get('display_name'), self.get('id'))
 
@@ -145,8 +277,8 @@ class CiviContactEntity(CiviTaggableEntity):
         """
         deleting a contact can be more tricky than other entities...
         """
-        if civi==None: civi = self.civicrm
-        query = {'entity':self.entity_type, 'action':'delete', 'id':self.attributes['id']}
+        civi = self._getCiviCRM(civi)
+        query = {'entity':self.entity_type, 'action':'delete', 'id':self._data['id']}
         if final:
             query['skip_undelete'] = 1
 
@@ -248,20 +380,26 @@ class CiviContactEntity(CiviTaggableEntity):
         request['action'] = 'update'
         request['entity'] = self.entity_type
         request['id'] = self.get('id')
-        self.civicrm.performAPICall(request, {'forcePost': True})
+        self._getCiviCRM().performAPICall(request, {'forcePost': True})
 
 
 class CiviPhoneEntity(CiviEntity):
+    __slots__ = ()
+
     def __str__(self):
         return "%s:'%s'" % (self.get('phone_type', "#"), self.get('phone'))
 
 
 class CiviCampaignEntity(CiviEntity):
+    __slots__ = ()
+
     def __str__(self):
         return "Campaign (%s): \"%s\"" % (self.get('id'), self.get('title'))
 
 
 class CiviContributionEntity(CiviTaggableEntity):
+    __slots__ = ()
+
     def __str__(self):
         return 'Contribution [%s]' % self.get('id')
 
@@ -283,6 +421,8 @@ class CiviContributionEntity(CiviTaggableEntity):
 
 
 class CiviNoteEntity(CiviTaggableEntity):
+    __slots__ = ()
+
     def _storeChanges(self, changed_attributes):
         if changed_attributes:
             # we have to submit the entity_id
@@ -298,6 +438,8 @@ class CiviNoteEntity(CiviTaggableEntity):
 
 
 class CiviRelationshipTypeEntity(CiviEntity):
+    __slots__ = ()
+
     def createOrUpdateRelation(self, contact_a_id, contact_b_id, parameters=dict()):
         '''
         will create a relationship if it does not already exist
@@ -305,10 +447,12 @@ class CiviRelationshipTypeEntity(CiviEntity):
         parameters['contact_id_a'] = contact_a_id
         parameters['contact_id_b'] = contact_b_id
         parameters['relationship_type_id'] = self.getID()
-        relation = self.civicrm.createOrUpdate('Relationship', parameters, 'update', ['relationship_type_id', 'contact_id_a', 'contact_id_b'])
+        relation = self._getCiviCRM().createOrUpdate('Relationship', parameters, 'update', ['relationship_type_id', 'contact_id_a', 'contact_id_b'])
 
 
 class CiviAddressEntity(CiviEntity):
+    __slots__ = ()
+
     def shareWith(self, contact_id):
         '''
         share the address with the given contact
@@ -317,10 +461,12 @@ class CiviAddressEntity(CiviEntity):
         new_address_data['master_id'] = self.getID()
         new_address_data['contact_id'] = contact_id
         del new_address_data['id']
-        return self.civicrm.createEntity(self.entity_type, new_address_data)
+        return self._getCiviCRM().createEntity(self.entity_type, new_address_data)
 
 
 class CiviEmailEntity(CiviEntity):
+    __slots__ = ()
+
     # update all provided attributes.
     # FIX for Civicrm-4.3.7:
     # We need to provide all attributes of the entity for an update
@@ -331,3 +477,37 @@ class CiviEmailEntity(CiviEntity):
                 changed_attributes['email'] = self.get('email')
             return CiviEntity._storeChanges(self, changed_attributes)
         return dict()
+
+
+
+# entity type => class used by CiviCRM._createEntity
+ENTITY_CLASSES = {
+    entity_type.CONTACT:            CiviContactEntity,
+    entity_type.CONTRIBUTION:       CiviContributionEntity,
+    entity_type.PHONE:              CiviPhoneEntity,
+    entity_type.CAMPAIGN:           CiviCampaignEntity,
+    entity_type.NOTE:               CiviNoteEntity,
+    entity_type.RELATIONSHIP_TYPE:  CiviRelationshipTypeEntity,
+    entity_type.ADDRESS:            CiviAddressEntity,
+    entity_type.EMAIL:              CiviEmailEntity,
+}
+
+
+def registerEntityClass(entity_type_name, entity_class):
+    """
+    use entity_class (a subclass of CiviEntity) for the entities
+    of the given type, e.g. registerEntityClass('SepaMandate', MyMandateEntity)
+
+    Subclasses should declare __slots__ (at least an empty one),
+    otherwise every instance gets a __dict__ again.
+    """
+    if not issubclass(entity_class, CiviEntity):
+        raise TypeError("%s is not a CiviEntity class" % entity_class.__name__)
+    ENTITY_CLASSES[entity_type_name] = entity_class
+
+
+def getEntityClass(entity_type_name):
+    """
+    get the class registered for the entity type, CiviEntity by default
+    """
+    return ENTITY_CLASSES.get(entity_type_name, CiviEntity)
@@ -0,0 +1,474 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+This is a python API wrapper for CiviCRM (https://civicrm.org/)
+Copyright (C) 2013 Systopia  (endres@systopia.de)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+__author__      = "Björn Endres"
+__copyright__   = "Copyright 2013, Systopia"
+__license__     = "GPLv3"
+__maintainer__  = "Björn Endres"
+__email__       = "endres[at]systopia.de"
+
+
+
+import threading
+import time
+import json
+import sqlite3
+import collections
+
+# returned by get() if there's no (valid) entry
+MISSING = object()
+
+
+class _Flight(object):
+    """
+    a running lookup other threads can wait for
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class LookupCache(object):
+    """
+    Thread safe cache for resolved values (mostly IDs), organised in
+    namespaces like 'option_group' or 'location_type2id'.
+
+    Each namespace can be configured with
+      ttl           seconds an entry stays valid (None: forever)
+      max_size      maximum number of entries, the least recently used are evicted (None: unbounded)
+      negative_ttl  seconds a cached miss (value 0, None or '') stays valid,
+                    None: same as ttl, 0: misses are not cached
+      persistent    write the entries to the store (if there is one), default True
+      casefold      match (string) keys case insensitively, like MySQL
+                    compares names, default False
+      index_values  keep an index value => keys, for discardValue(), default False
+    Namespaces not configured use the defaults passed to the constructor.
+
+    The entries expire by clock(), time.monotonic by default.
+    """
+
+    def __init__(self, ttl=None, max_size=None, negative_ttl=None, clock=time.monotonic):
+        self.defaults = {'ttl': ttl, 'max_size': max_size, 'negative_ttl': negative_ttl, 'persistent': True, 'casefold': False, 'index_values': False}
+        self.settings = dict()
+        self.namespaces = dict()
+        self.flights = dict()
+        self.complete = dict()
+        self.indexes = dict()
+        self.store = None
+        self.clock = clock
+        self.lock = threading.RLock()
+
+
+    def attachStore(self, store):
+        """
+        use the (e.g. SQLiteLookupStore) store as a persistent backing store,
+        loading all entries that haven't expired (ttl and negative_ttl are
+        applied to their timestamps)
+        """
+        now = time.time()
+        with self.lock:
+            self.store = store
+            for namespace, key, value, stored in store.load():
+                if not self.getSetting(namespace, 'persistent'):
+                    continue
+                ttl = self._getTTL(namespace, value in (0, None, ''))
+                if ttl == 0:
+                    continue
+                if ttl is None:
+                    expires = None
+                elif stored + ttl <= now:
+                    continue
+                else:
+                    expires = self.clock() + (stored + ttl - now)
+                entries = self.namespaces.setdefault(namespace, collections.OrderedDict())
+                self._put(namespace, entries, self.storedKey(namespace, key), value, expires)
+                self._evict(namespace)
+
+
+    def configure(self, namespace, **settings):
+        """
+        set ttl, max_size, negative_ttl, persistent, casefold and/or index_values for the namespace
+        """
+        for setting in settings:
+            if setting not in self.defaults:
+                raise ValueError("Unknown cache setting '%s'" % setting)
+        with self.lock:
+            self.settings.setdefault(namespace, dict(self.defaults)).update(settings)
+            self._evict(namespace)
+
+
+    def getSetting(self, namespace, setting):
+        return self.settings.get(namespace, self.defaults)[setting]
+
+
+    def storedKey(self, namespace, key):
+        """
+        the key as stored, i.e. casefolded if the namespace is configured so
+        """
+        if self.getSetting(namespace, 'casefold'):
+            return _foldKey(key)
+        return key
+
+
+    def get(self, namespace, key, default=None):
+        """
+        get the cached value, or default if there is no valid entry
+        """
+        key = self.storedKey(namespace, key)
+        with self.lock:
+            entries = self.namespaces.get(namespace)
+            if entries is None or key not in entries:
+                return default
+            value, expires = entries[key]
+            if expires is not None and expires <= self.clock():
+                self._remove(namespace, entries, key)
+                return default
+            entries.move_to_end(key)
+            return value
+
+
+    def _getTTL(self, namespace, negative):
+        ttl = self.getSetting(namespace, 'ttl')
+        if negative:
+            negative_ttl = self.getSetting(namespace, 'negative_ttl')
+            if negative_ttl is not None:
+                ttl = negative_ttl
+        return ttl
+
+
+    def set(self, namespace, key, value, negative=None):
+        """
+        store a value. If negative isn't given, 0, None and ''
+        are treated as negative (i.e. 'not found') entries
+        """
+        self.setMany(namespace, [(key, value)], negative)
+
+
+    def setMany(self, namespace, items, negative=None):
+        """
+        store a list of (key, value) items, see set()
+        """
+        stored = list()
+        with self.lock:
+            entries = self.namespaces.setdefault(namespace, collections.OrderedDict())
+            for key, value in items:
+                key = self.storedKey(namespace, key)
+                is_negative = value in (0, None, '') if negative is None else negative
+                ttl = self._getTTL(namespace, is_negative)
+                if ttl == 0:
+                    # negative caching disabled
+                    if key in entries:
+                        self._remove(namespace, entries, key)
+                    continue
+                expires = None if ttl is None else self.clock() + ttl
+                self._put(namespace, entries, key, value, expires)
+                stored.append((key, value))
+            self._evict(namespace)
+
+        if self.store is not None and stored and self.getSetting(namespace, 'persistent'):
+            self.store.save(namespace, stored)
+
+
+    def setComplete(self, namespace, miss_value=0, ttl=None):
+        """
+        declare that the namespace holds all existing entries (e.g. after
+        a preload), so lookup() returns miss_value for unknown keys instead
+        of calling the loader. This expires after ttl seconds, by default
+        with the namespace's ttl.
+        """
+        if ttl is None:
+            ttl = self.getSetting(namespace, 'ttl')
+        with self.lock:
+            self.complete[namespace] = (miss_value, None if ttl is None else self.clock() + ttl)
+
+
+    def isComplete(self, namespace):
+        with self.lock:
+            if namespace not in self.complete:
+                return False
+            miss_value, expires = self.complete[namespace]
+            if expires is not None and expires <= self.clock():
+                del self.complete[namespace]
+                return False
+            return True
+
+
+    def find(self, namespace, key):
+        """
+        get the cached value, the miss value if the namespace is
+        complete, or MISSING if it has to be loaded
+        """
+        with self.lock:
+            value = self.get(namespace, key, MISSING)
+            if value is MISSING and self.isComplete(namespace):
+                value = self.complete[namespace][0]
+            return value
+
+
+    def delete(self, namespace, key):
+        key = self.storedKey(namespace, key)
+        with self.lock:
+            entries = self.namespaces.get(namespace, dict())
+            if key in entries:
+                self._remove(namespace, entries, key)
+        if self.store is not None and self.getSetting(namespace, 'persistent'):
+            self.store.delete(namespace, key)
+
+
+    def discard(self, namespace, predicate):
+        """
+        remove all entries of the namespace for which predicate(key, value) is true,
+        with the keys as stored (see casefold)
+        """
+        with self.lock:
+            entries = self.namespaces.get(namespace, dict())
+            keys = [key for key, (value, expires) in entries.items() if predicate(key, value)]
+            for key in keys:
+                self._remove(namespace, entries, key)
+        if self.store is not None and self.getSetting(namespace, 'persistent'):
+            for key in keys:
+                self.store.delete(namespace, key)
+
+
+    def discardValue(self, namespace, value):
+        """
+        remove all entries of the namespace with the value, without going
+        through all of them if the namespace is configured with index_values
+        """
+        if not self.getSetting(namespace, 'index_values'):
+            return self.discard(namespace, lambda key, entry_value: entry_value == value)
+        with self.lock:
+            entries = self.namespaces.get(namespace, dict())
+            keys = list(self.indexes.get(namespace, dict()).get(value, ()))
+            for key in keys:
+                self._remove(namespace, entries, key)
+        if self.store is not None and self.getSetting(namespace, 'persistent'):
+            for key in keys:
+                self.store.delete(namespace, key)
+
+
+    def clear(self, namespace=None):
+        """
+        remove all entries of the namespace, or of all namespaces
+        """
+        with self.lock:
+            if namespace is None:
+                self.namespaces.clear()
+                self.complete.clear()
+                self.indexes.clear()
+            else:
+                self.namespaces.pop(namespace, None)
+                self.complete.pop(namespace, None)
+                self.indexes.pop(namespace, None)
+        if self.store is not None and (namespace is None or self.getSetting(namespace, 'persistent')):
+            self.store.clear(namespace)
+
+
+    def lookup(self, namespace, key, loader, verify_miss=False):
+        """
+        get the cached value, calling loader() to
+        resolve (and cache) it if there is no valid entry.
+        If verify_miss is set, cached misses (and misses in a complete
+        namespace) are loaded again, e.g. before creating the entity.
+
+        Concurrent lookups of the same key are only loaded once:
+        the other threads wait for the result (or the exception)
+        of the first one.
+        """
+        with self.lock:
+            value = self.find(namespace, key)
+            if value is not MISSING and not (verify_miss and value in (0, None, '')):
+                return value
+            key = self.storedKey(namespace, key)
+            flight = self.flights.get((namespace, key))
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self.flights[(namespace, key)] = flight
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+            self.set(namespace, key, flight.value)
+        except BaseException as err:
+            flight.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.flights[(namespace, key)]
+            flight.done.set()
+        return flight.value
+
+
+    def _put(self, namespace, entries, key, value, expires):
+        if key in entries:
+            self._unindex(namespace, key, entries[key][0])
+        entries[key] = (value, expires)
+        entries.move_to_end(key)
+        if self.getSetting(namespace, 'index_values'):
+            self.indexes.setdefault(namespace, dict()).setdefault(value, set()).add(key)
+
+
+    def _remove(self, namespace, entries, key):
+        value, expires = entries.pop(key)
+        self._unindex(namespace, key, value)
+
+
+    def _unindex(self, namespace, key, value):
+        index = self.indexes.get(namespace)
+        if index is None or value not in index:
+            return
+        index[value].discard(key)
+        if not index[value]:
+            del index[value]
+
+
+    def _evict(self, namespace):
+        max_size = self.getSetting(namespace, 'max_size')
+        entries = self.namespaces.get(namespace)
+        if max_size is None or entries is None:
+            return
+        while len(entries) > max_size:
+            key, (value, expires) = entries.popitem(last=False)
+            self._unindex(namespace, key, value)
+            # evicted entries aren't known to be missing
+            self.complete.pop(namespace, None)
+
+
+
+def _foldKey(key):
+    if isinstance(key, str):
+        return key.casefold()
+    if isinstance(key, tuple):
+        return tuple(_foldKey(part) for part in key)
+    return key
+
+
+def _encodeKey(key):
+    return json.dumps(key)
+
+def _decodeKey(data):
+    key = json.loads(data)
+    if isinstance(key, list):
+        return tuple(key)
+    return key
+
+
+class SQLiteLookupStore(object):
+    """
+    persistent backing store for a LookupCache, shared by all runs and
+    processes working on the same site (e.g. the REST URL).
+
+    Every entry keeps the time it was stored. The table 'meta' records
+    the preloaded metadata tables with their row count, so they can be
+    validated cheaply (see CiviCRM.preload).
+
+    The database is used in WAL mode, so multiple processes
+    can read while one of them writes.
+    """
+
+    def __init__(self, path, site, timeout=30.0):
+        self.path = path
+        self.site = site
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS entries (
+                site TEXT, namespace TEXT, key TEXT, value TEXT, stored REAL,
+                PRIMARY KEY (site, namespace, key))""")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS meta (
+                site TEXT, name TEXT, entity_type TEXT, count INTEGER, loaded REAL, checked REAL, namespaces TEXT,
+                PRIMARY KEY (site, name))""")
+            self.connection.commit()
+
+    def _write(self, statement, rows):
+        with self.lock:
+            with self.connection:
+                self.connection.executemany(statement, rows)
+
+    def load(self):
+        """
+        get all entries of the site as (namespace, key, value, stored)
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT namespace, key, value, stored FROM entries WHERE site=?", (self.site,)).fetchall()
+        return [(namespace, _decodeKey(key), json.loads(value), stored) for namespace, key, value, stored in rows]
+
+    def save(self, namespace, items):
+        now = time.time()
+        self._write("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+            [(self.site, namespace, _encodeKey(key), json.dumps(value), now) for key, value in items])
+
+    def delete(self, namespace, key):
+        self._write("DELETE FROM entries WHERE site=? AND namespace=? AND key=?", [(self.site, namespace, _encodeKey(key))])
+
+    def clear(self, namespace=None):
+        """
+        remove the entries of the namespace (or all of them), along with
+        the preloaded tables they belong to, which are no longer complete
+        """
+        with self.lock:
+            with self.connection:
+                if namespace is None:
+                    self.connection.execute("DELETE FROM entries WHERE site=?", (self.site,))
+                    self.connection.execute("DELETE FROM meta WHERE site=?", (self.site,))
+                    return
+                self.connection.execute("DELETE FROM entries WHERE site=? AND namespace=?", (self.site, namespace))
+                tables = self.connection.execute("SELECT name, namespaces FROM meta WHERE site=?", (self.site,)).fetchall()
+                self.connection.executemany("DELETE FROM meta WHERE site=? AND name=?",
+                    [(self.site, name) for name, namespaces in tables if namespace in json.loads(namespaces)['all']])
+
+    def getTable(self, name):
+        """
+        get the information on a preloaded metadata table,
+        None if it hasn't been loaded
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT entity_type, count, loaded, checked, namespaces FROM meta WHERE site=? AND name=?", (self.site, name)).fetchone()
+        if row is None:
+            return None
+        entity_type, count, loaded, checked, namespaces = row
+        return {'entity_type': entity_type, 'count': count, 'loaded': loaded, 'checked': checked, 'namespaces': json.loads(namespaces)}
+
+    def setTable(self, name, entity_type, count, namespaces):
+        now = time.time()
+        self._write("INSERT OR REPLACE INTO meta VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(self.site, name, entity_type, count, now, now, json.dumps(namespaces))])
+
+    def touchTable(self, name):
+        self._write("UPDATE meta SET checked=? WHERE site=? AND name=?", [(time.time(), self.site, name)])
+
+    def dropTable(self, name):
+        self._write("DELETE FROM meta WHERE site=? AND name=?", [(self.site, name)])
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
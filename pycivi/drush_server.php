@@ -0,0 +1,108 @@
+<?php
+/*
+  This is a python API wrapper for CiviCRM (https://civicrm.org/)
+  Copyright (C) 2013 Systopia  (endres@systopia.de)
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+*/
+
+/**
+ * Resident API server for pycivi's CiviCRM_DRUSH backend, run with
+ *
+ *   drush -r <drupal root> -l <site> php-script drush_server.php
+ *
+ * Reads one JSON encoded request per line from STDIN:
+ *   {"entity": "Contact", "action": "get", "params": {...}}
+ * and writes the JSON encoded API result to STDOUT, framed as
+ *   #pycivi-reply#<length in bytes>
+ *   <JSON>
+ * on lines of their own.
+ * A batch request {"calls": [{...}, {...}]} is answered with
+ * {"results": [{...}, {...}]} in the same order.
+ * The health check request {"ping": 1} is answered with {"pong": 1}.
+ * Any other output (notices, warnings) is logged by pycivi, the framing
+ * keeps it from garbling the reply even without a trailing line break.
+ * The process terminates when STDIN is closed.
+ */
+
+/**
+ * run a single API call, errors are returned, never thrown
+ */
+function pycivi_call($request) {
+  if (!is_array($request) || empty($request['entity']) || empty($request['action'])) {
+    return array('is_error' => 1, 'error_message' => 'Invalid request.');
+  }
+  $params = isset($request['params']) && is_array($request['params']) ? $request['params'] : array();
+  $params['version'] = 3;
+  try {
+    return civicrm_api($request['entity'], $request['action'], $params);
+  }
+  catch (Throwable $e) {
+    return array('is_error' => 1, 'error_message' => get_class($e) . ': ' . $e->getMessage());
+  }
+}
+
+/**
+ * encode a reply, without line breaks
+ */
+function pycivi_encode($reply) {
+  $json = json_encode($reply);
+  if ($json === FALSE) {
+    $json = json_encode(array('is_error' => 1, 'error_message' => 'Reply could not be encoded: ' . json_last_error_msg()));
+  }
+  return $json;
+}
+
+/**
+ * run a batch of API calls, encoding each result on its own
+ * so a single failing call doesn't affect the others
+ */
+function pycivi_batch($calls) {
+  $results = array();
+  foreach ($calls as $call) {
+    $results[] = pycivi_encode(pycivi_call($call));
+  }
+  return '{"results":[' . implode(',', $results) . ']}';
+}
+
+/**
+ * write a framed reply, starting on a new line in case
+ * some output without a line break was written before
+ */
+function pycivi_reply($json) {
+  echo "\n#pycivi-reply#", strlen($json), "\n", $json, "\n";
+  flush();
+}
+
+civicrm_initialize();
+while (ob_get_level()) {
+  ob_end_flush();
+}
+
+while (($line = fgets(STDIN)) !== FALSE) {
+  $line = trim($line);
+  if ($line === '') {
+    continue;
+  }
+  $request = json_decode($line, TRUE);
+  if (isset($request['ping'])) {
+    pycivi_reply(pycivi_encode(array('pong' => 1)));
+  }
+  elseif (isset($request['calls']) && is_array($request['calls'])) {
+    pycivi_reply(pycivi_batch($request['calls']));
+  }
+  else {
+    pycivi_reply(pycivi_encode(pycivi_call($request)));
+  }
+}
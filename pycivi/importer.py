@@ -128,6 +128,68 @@ def _prepare_parameters(parameters):
         parameters['lock'] = threading.Condition()
 
 
+def _get_column_ids(civicrm, record, key_fields, parameters, name, table, resolve, command):
+    """
+    Get the IDs for the (non-key) columns of the record, e.g. tag names,
+    resolved with resolve (like civicrm.getOrCreateTagIDs) and kept in parameters[name].
+
+    The first call preloads the whole table (see CiviCRM.preload) in a locked
+    section, so the following columns are resolved without further API calls.
+    """
+    column_ids = parameters.get(name, dict())
+    unknown = [column for column in record.keys() if column not in key_fields and column not in column_ids]
+    if unknown:
+        preloaded = name + '_preloaded'
+        if not parameters.get(preloaded, False):
+            parameters_lock = parameters['lock']
+            parameters_lock.acquire()
+            # test again, maybe another thread already loaded them...
+            if not parameters.get(preloaded, False):
+                civicrm.preload([table])
+                parameters[preloaded] = True
+            parameters_lock.notifyAll()
+            parameters_lock.release()
+
+        resolved = resolve(unknown)
+        entity_type = civicrm.PRELOAD_ENTITIES[table]
+        for column in unknown:
+            civicrm.log("%s '%s' has ID %s" % (entity_type, column, resolved[column]),
+                logging.INFO, 'importer', command, entity_type, resolved[column], None, 0)
+        column_ids = dict(parameters.get(name, dict()))
+        column_ids.update(resolved)
+        parameters[name] = column_ids
+    return column_ids
+
+
+def preresolve_contact_ids(civicrm, records, keys=['external_identifier', 'contact_external_identifier']):
+    """
+    Resolves the contact external identifiers of all the given records in bulk,
+    so the importers' getContactID calls will be served from the cache
+    """
+    identifiers = list()
+    for record in records:
+        for key in keys:
+            if record.get(key, None):
+                identifiers.append(record[key])
+    if identifiers:
+        civicrm.getContactIDs(identifiers)
+
+
+def _preresolving_iterator(civicrm, record_source, chunk_size):
+    chunk = list()
+    for record in record_source:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            preresolve_contact_ids(civicrm, chunk)
+            for chunk_record in chunk:
+                yield chunk_record
+            chunk = list()
+    if chunk:
+        preresolve_contact_ids(civicrm, chunk)
+        for chunk_record in chunk:
+            yield chunk_record
+
+
 def import_contributions(civicrm, record_source, parameters=dict()):
     """
     Imports import_contributions
@@ -364,7 +426,7 @@ def import_notes(civicrm, record_source, parameters=dict()):
             try:
                 note = civicrm.createOrUpdate('Note', record, update_type='update', primary_attributes=primary_attributes)
             except CiviAPIException as ex:
-                civicrm.log("Failed to create/update note. Please make sure that GET/POST parameter length (e.g. PHP's suhosin.get.max_value_length) is greater than %d" % len(record['note']),
+                civicrm.log("Failed to create/update note. Please make sure that the POST parameter length (e.g. PHP's suhosin.post.max_value_length) is greater than %d" % len(record['note']),
                     logging.ERROR, 'importer', 'import_notes', 'Note', None, None, time.time()-timestamp)
                 raise ex
 
@@ -920,54 +982,73 @@ def import_membership(civicrm, record_source, parameters=dict()):
                 logging.ERROR, 'importer', 'import_membership', 'Membership', None, record['contact_id'], time.time()-timestamp)
 
 
+def _iter_chunks(record_source, chunk_size):
+    chunk = list()
+    for record in record_source:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+
 def import_contact_groups(civicrm, record_source, parameters=dict()):
+    """
+    Set the group memberships for contacts
+
+    The records are processed in chunks of parameters['chunk_size'] (default 500):
+    the current memberships are fetched for the whole chunk at once (see
+    getContactGroupIdMap), and the changes are written per group (see setGroupMemberships)
+    """
     _prepare_parameters(parameters)
     entity_type = parameters.get('entity_type', 'Contact')
     key_fields = parameters.get('key_fields', ['id', 'external_identifier'])
+    chunk_size = parameters.get('chunk_size', 500)
+
+    for chunk in _iter_chunks(record_source, chunk_size):
+        contacts = list()
+        for record in chunk:
+            contact_id = civicrm.getContactID(record)
+            if not contact_id:
+                civicrm.log("Contact not found: ID %s" % contact_id,
+                    logging.WARN, 'importer', 'import_contact_groups', 'Contact', contact_id, None, 0)
+                continue
+            contacts.append((contact_id, record))
+
+        currentGroupMap = civicrm.getContactGroupIdMap([contact_id for contact_id, record in contacts])
+        pending = dict()
+        for contact_id, record in contacts:
+            group_ids = _get_column_ids(civicrm, record, key_fields, parameters, 'group_ids', 'groups', civicrm.getOrCreateGroupIDs, 'import_contact_groups')
+
+            currentGroups = currentGroupMap[contact_id]
+            groups2change = dict()
+            for group_name in record.keys():
+                if not (group_name in key_fields):
+                    desiredState = (record[group_name].lower() in ['true', 1, '1', 'x', 'yes', 'y', 'ja', 'j'])
+                    currentState = (group_ids[group_name] in currentGroups)
+                    if currentState != desiredState:
+                        groups2change[group_ids[group_name]] = desiredState
+            if groups2change:
+                civicrm.log("Modifying groups for contact %s" % contact_id,
+                    logging.INFO, 'importer', 'import_contact_groups', 'Contact', contact_id, None, 0)
+                for group_id in groups2change:
+                    pending.setdefault(group_id, dict())[contact_id] = groups2change[group_id]
+                    # keep the snapshot up to date, the contact might appear again
+                    if groups2change[group_id]:
+                        currentGroups.add(group_id)
+                    else:
+                        currentGroups.discard(group_id)
+            else:
+                civicrm.log("Groups are up to date for contact %s" % contact_id,
+                    logging.INFO, 'importer', 'import_contact_groups', 'Contact', contact_id, None, 0)
 
-    for record in record_source:
-        contact_id = civicrm.getContactID(record)
-        if not contact_id:
-            civicrm.log("Contact not found: ID %s" % contact_id,
-                logging.WARN, 'importer', 'import_contact_groups', 'Contact', contact_id, None, 0)
-            continue
-
-        group_ids = parameters.get('group_ids', None)
-        if group_ids==None:    # GET THE TAG IDS!
-            parameters_lock = parameters['lock']
-            parameters_lock.acquire()
-            # test again, maybe another thread already created them...
-            group_ids = parameters.get('group_ids', None)
-            if group_ids==None:
-                # no? ok, then it's up to us to query the tag ids
-                group_ids = dict()
-                for group_name in record.keys():
-                    if group_name in key_fields:
-                        continue
-                    group_id = civicrm.getOrCreateGroupID(group_name)
-                    group_ids[group_name] = group_id
-                    civicrm.log("Group '%s' has ID %s" % (group_name, group_id),
-                        logging.INFO, 'importer', 'import_contact_groups', 'GroupContact', group_id, None, 0)
-                parameters['group_ids'] = group_ids
-            parameters_lock.notifyAll()
-            parameters_lock.release()
-
-        currentGroups = civicrm.getContactGroupIds(contact_id)
-        groups2change = dict()
-        for group_name in record.keys():
-            if not (group_name in key_fields):
-                desiredState = (record[group_name].lower() in ['true', 1, '1', 'x', 'yes', 'y', 'ja', 'j'])
-                currentState = (group_ids[group_name] in currentGroups)
-                if currentState != desiredState:
-                    groups2change[group_ids[group_name]] = desiredState
-        if groups2change:
-            civicrm.log("Modifying groups for contact %s" % contact_id,
-                logging.INFO, 'importer', 'import_contact_groups', 'Contact', contact_id, None, 0)
-            for tag_id in groups2change:
-                civicrm.setGroupMembership(contact_id, tag_id, groups2change[tag_id])
-        else:
-            civicrm.log("Groups are up to date for contact %s" % contact_id,
-                logging.INFO, 'importer', 'import_contact_groups', 'Contact', contact_id, None, 0)
+        # write the changes of the whole chunk, grouped by group
+        for group_id, changes in pending.items():
+            for value in (True, False):
+                contact_ids = [contact_id for contact_id in changes if changes[contact_id]==value]
+                if contact_ids:
+                    civicrm.setGroupMemberships(group_id, contact_ids, value)
 
 
 
@@ -984,8 +1065,13 @@ def import_contact_tags(civicrm, record_source, parameters=dict()):
 def import_entity_tags(civicrm, record_source, parameters=dict()):
     """
     (Un)set a set of tags for entities
+
+    The records are processed in chunks of parameters['chunk_size'] (default 500):
+    the current tags are fetched for the whole chunk at once (see getEntityTagIdMap),
+    and the changes are written per tag (see tagEntities)
     """
     _prepare_parameters(parameters)
+    timestamp = time.time()
 
     entity_type = parameters.get('entity_type', None)
     if not entity_type:
@@ -1000,65 +1086,58 @@ def import_entity_tags(civicrm, record_source, parameters=dict()):
         return
 
     key_fields = parameters.get('key_fields', ['id', 'external_identifier'])
+    chunk_size = parameters.get('chunk_size', 500)
+
+    for chunk in _iter_chunks(record_source, chunk_size):
+        entities = list()
+        for record in chunk:
+            if entity_type=='Contact':
+                entity_id = civicrm.getContactID(record)
+                if not entity_id:
+                    civicrm.log("Contact not found: ID %s" % entity_id,
+                        logging.WARN, 'importer', 'import_contact_tags', 'Contact', entity_id, None, 0)
+                    continue
+            else:
+                entity_id = civicrm.getEntityID(record, entity_type, key_fields)
+            entities.append((entity_id, record))
 
-
-    for record in record_source:
         if entity_type=='Contact':
-            entity_id = civicrm.getContactID(record)
-            if not entity_id:
-                civicrm.log("Contact not found: ID %s" % entity_id,
-                    logging.WARN, 'importer', 'import_contact_tags', 'Contact', entity_id, None, 0)
-                continue
+            currentTagMap = civicrm.getContactTagIdMap([entity_id for entity_id, record in entities])
         else:
-            entity_id = civicrm.getEntityID(record, entity_type, key_fields)
-
+            currentTagMap = civicrm.getEntityTagIdMap([entity_id for entity_id, record in entities], entity_table)
 
-        tag_ids = parameters.get('tag_ids', None)
-        allFound = False
-        if not tag_ids==None:
-            # find the tags
-            allFound = True
-            for tag_name in record.keys():
-                allFound &= (tag_name in tag_ids)
+        pending = dict()
+        for entity_id, record in entities:
+            tag_ids = _get_column_ids(civicrm, record, key_fields, parameters, 'tag_ids', 'tags', civicrm.getOrCreateTagIDs, 'import_entity_tags')
 
-        if not allFound:    # GET THE TAG IDS!
-            parameters_lock = parameters['lock']
-            parameters_lock.acquire()
-            # test again, maybe another thread already created them...
-            tag_ids = parameters.get('tag_ids', dict())
-            parameters['tag_ids'] = tag_ids
+            currentTags = currentTagMap[entity_id]
+            tags2change = dict()
             for tag_name in record.keys():
-                tag_id = civicrm.getOrCreateTagID(tag_name)
-                tag_ids[tag_name] = tag_id
-                civicrm.log("Tag '%s' has ID %s" % (tag_name, tag_id),
-                    logging.INFO, 'importer', 'import_entity_tags', 'EntityTag', tag_id, None, 0)
-
-            parameters_lock.notifyAll()
-            parameters_lock.release()
+                if not (tag_name in key_fields):
+                    desiredState = (record[tag_name].lower() in ['true', 1, '1', 'x', 'yes', 'y', 'ja', 'j'])
+                    currentState = (tag_ids[tag_name] in currentTags)
+                    if currentState != desiredState:
+                        tags2change[tag_ids[tag_name]] = desiredState
+            if tags2change:
+                civicrm.log("Modifying tags for %s [%s]" % (entity_type, entity_id),
+                    logging.INFO, 'importer', 'import_entity_tags', 'EntityTag', entity_id, None, 0)
+                for tag_id in tags2change:
+                    pending.setdefault(tag_id, dict())[entity_id] = tags2change[tag_id]
+                    # keep the snapshot up to date, the entity might appear again
+                    if tags2change[tag_id]:
+                        currentTags.add(tag_id)
+                    else:
+                        currentTags.discard(tag_id)
+            else:
+                civicrm.log("Tags are up to date for %s [%s]" % (entity_type, entity_id),
+                    logging.INFO, 'importer', 'import_entity_tags', 'EntityTag', entity_id, None, 0)
 
-        if entity_type=='Contact':
-            currentTags = civicrm.getContactTagIds(entity_id)
-        else:
-            currentTags = civicrm.getEntityTagIds(entity_id, entity_table)
-
-        tags2change = dict()
-        for tag_name in record.keys():
-            if not (tag_name in key_fields):
-                desiredState = (record[tag_name].lower() in ['true', 1, '1', 'x', 'yes', 'y', 'ja', 'j'])
-                currentState = (tag_ids[tag_name] in currentTags)
-                if currentState != desiredState:
-                    tags2change[tag_ids[tag_name]] = desiredState
-        if tags2change:
-            civicrm.log("Modifying tags for %s [%s]" % (entity_type, entity_id),
-                logging.INFO, 'importer', 'import_entity_tags', 'EntityTag', entity_id, None, 0)
-            for tag_id in tags2change:
-                if entity_type=='Contact':
-                    civicrm.tagContact(entity_id, tag_id, tags2change[tag_id])
-                else:
-                    civicrm.tagEntity(entity_id, entity_table, tag_id, tags2change[tag_id])
-        else:
-            civicrm.log("Tags are up to date for %s [%s]" % (entity_type, entity_id),
-                logging.INFO, 'importer', 'import_entity_tags', 'EntityTag', entity_id, None, 0)
+        # write the changes of the whole chunk, grouped by tag
+        for tag_id, changes in pending.items():
+            for value in (True, False):
+                entity_ids = [entity_id for entity_id in changes if changes[entity_id]==value]
+                if entity_ids:
+                    civicrm.tagEntities(tag_id, entity_ids, value, entity_table)
 
 
 def import_delete_entity(civicrm, record_source, parameters=dict()):
@@ -1122,35 +1201,156 @@ def import_delete_entity(civicrm, record_source, parameters=dict()):
 
 
 
+class ConcurrencyController:
+    """
+    Limits the number of records processed at the same time by parallelize.
+
+    The limit starts at 'initial_workers' (default: min_workers) and is adjusted
+    every 'interval' seconds following an AIMD rule, based on the API calls since
+    the last adjustment: it grows by 'increase' while the calls go well, and is
+    multiplied by 'decrease' if the error rate (error replies and calls without
+    a reply) exceeds 'max_error_rate' or the average latency exceeds the best
+    latency observed by 'max_latency_factor'.
+    """
+    def __init__(self, civicrm, max_workers, min_workers=1, interval=5.0, decrease=0.5,
+                 max_error_rate=0.05, max_latency_factor=2.0, initial_workers=None, increase=1):
+        self.civicrm = civicrm
+        self.max_workers = max_workers
+        self.min_workers = min_workers
+        self.interval = interval
+        self.decrease = decrease
+        self.increase = increase
+        self.max_error_rate = max_error_rate
+        self.max_latency_factor = max_latency_factor
+
+        if initial_workers is None:
+            initial_workers = min_workers
+        self.limit = max(min_workers, min(max_workers, initial_workers))
+        self.active = 0
+        self.base_latency = None
+        self.condition = threading.Condition()
+        self._sample = self._takeSample()
+
+    def _takeSample(self):
+        return (time.time(),) + self.civicrm.getCallStats()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self._adjust()
+            self.condition.notify_all()
+
+    def _adjust(self):
+        sample = self._takeSample()
+        if sample[0] - self._sample[0] < self.interval:
+            return
+        calls = sample[1] - self._sample[1]
+        errors = sample[3] - self._sample[3]
+        if not calls + errors:
+            return
+        runtime = sample[2] - self._sample[2]
+        self._sample = sample
+
+        error_rate = float(errors) / (calls + errors)
+        latency = runtime / calls if calls else None
+        if latency is not None:
+            if self.base_latency is None:
+                self.base_latency = latency
+            else:
+                # allow the baseline to drift up slowly, so we can recover from a bad start
+                self.base_latency = min(latency, self.base_latency * 1.1)
+
+        old_limit = self.limit
+        if error_rate > self.max_error_rate or (latency is not None and latency > self.base_latency * self.max_latency_factor):
+            self.limit = max(self.min_workers, int(self.limit * self.decrease))
+        else:
+            self.limit = min(self.max_workers, self.limit + self.increase)
+
+        if self.limit != old_limit:
+            self.civicrm.log("Concurrency adjusted from %d to %d (error rate %.2f, latency %sms)" % (old_limit, self.limit, error_rate, int(latency * 1000) if latency is not None else 'n/a'),
+                logging.INFO, 'importer', 'parallelize', None, None, None, runtime)
+
+
+# the import functions that process the records passed to them in bulk,
+# parallelize passes them chunks of parameters['chunk_size'] records
+BULK_IMPORTERS = [import_contact_groups, import_contact_tags, import_entity_tags]
+
+
+def _failed_records(chunk):
+    if len(chunk)==1:
+        return "Failed record was: %s" % str(chunk[0])
+    return "Failed records were: %s" % str(chunk)
+
+
 def parallelize(civicrm, import_function, workers, record_source, parameters=dict()):
+    """
+    Runs the import_function with the given number of worker threads
+
+    parameters['preresolve_contacts'] if True, the records' contact external identifiers
+                                     will be resolved in chunks beforehand (see getContactIDs)
+    parameters['preresolve_chunk_size'] number of records to resolve at once, default is 500
+    parameters['adaptive_concurrency'] if True, the number of active workers will be adjusted
+                                     between parameters['min_workers'] (default 1) and workers,
+                                     based on the observed API latency and error rate, starting
+                                     with parameters['initial_workers'] (default min_workers),
+                                     growing by parameters['increase_workers'] (default 1) every
+                                     parameters['adjust_interval'] seconds (default 5)
+    parameters['chunk_size']         number of records passed at once to the bulk importers listed in
+                                     BULK_IMPORTERS (e.g. import_contact_groups), default is 500. If such a
+                                     call fails, its whole chunk is logged as failed.
+                                     All other import functions are called record by record.
+    """
     _prepare_parameters(parameters)
+    if parameters.get('preresolve_contacts', False):
+        record_source = _preresolving_iterator(civicrm, record_source, parameters.get('preresolve_chunk_size', 500))
+    if import_function in BULK_IMPORTERS:
+        chunk_size = parameters.get('chunk_size', 500)
+    else:
+        chunk_size = 1
+    chunk_source = _iter_chunks(record_source, chunk_size)
+
     # if only on worker, just call directly
     if workers==1:
-        for record in record_source:
+        for chunk in chunk_source:
             try:
                 timestamp = time.time()
-                import_function(civicrm, [record], parameters)
+                import_function(civicrm, chunk, parameters)
             except:
                 civicrm.logException("Exception caught for '%s' on procedure '%s'. Exception was: " % (threading.currentThread().name, import_function.__name__),
                     logging.ERROR, 'importer', import_function.__name__, None, None, None, time.time()-timestamp)
-                civicrm.log("Failed record was: %s" % str(record),
+                civicrm.log(_failed_records(chunk),
                     logging.ERROR, 'importer', import_function.__name__, None, None, None, time.time()-timestamp)
         return
 
     # multithreaded
     timestamp = time.time()
+    civicrm.setPoolSize(workers)
     record_list = list()
     record_list_lock = threading.Condition()
     thread_list = list()
 
-    # first fill the queue
-    record_source_iterator = record_source.__iter__()
-    for i in range(5 * workers):
+    # first fill the queue (with chunks of records)
+    for i in range((5 if chunk_size==1 else 2) * workers):
         try:
-            record_list.append(next(record_source_iterator))
+            record_list.append(next(chunk_source))
         except:
             break
 
+    # set up the adaptive concurrency control
+    if parameters.get('adaptive_concurrency', False):
+        controller = ConcurrencyController(civicrm, workers, parameters.get('min_workers', 1),
+                                           interval=parameters.get('adjust_interval', 5.0),
+                                           initial_workers=parameters.get('initial_workers', None),
+                                           increase=parameters.get('increase_workers', 1))
+    else:
+        controller = None
+
     # then start the threads
     class Worker(threading.Thread):
         def __init__(self, function, civicrm, parameters, record_list, record_list_lock):
@@ -1173,25 +1373,30 @@ def parallelize(civicrm, import_function, workers, record_source, parameters=dic
                     record_list_lock.acquire()
 
                 if len(record_list)>0:
-                    record = record_list.pop(0)
+                    chunk = record_list.pop(0)
                 else:
                     active = False
-                    record = None
+                    chunk = None
 
                 if record_list_lock:
                     record_list_lock.notifyAll()
                     record_list_lock.release()
 
-                if record:
+                if chunk:
+                    if controller:
+                        controller.acquire()
                     # execute standard function
                     try:
                         timestamp = time.time()
-                        self.function(self.civicrm, [record], self.parameters)
+                        self.function(self.civicrm, chunk, self.parameters)
                     except:
-                        civicrm.logException("Exception caught for '%s' on procedure '%s'. Exception was: " % (threading.currentThread().name, import_function.__name__),
+                        civicrm.logException("Exception caught for '%s' on procedure '%s'. Exception was: " % (threading.current_thread().name, import_function.__name__),
                             logging.ERROR, 'importer', import_function.__name__, None, None, None, time.time()-timestamp)
-                        civicrm.log("Failed record was: %s" % str(record),
+                        civicrm.log(_failed_records(chunk),
                             logging.ERROR, 'importer', import_function.__name__, None, None, None, time.time()-timestamp)
+                    finally:
+                        if controller:
+                            controller.release()
 
 
 
@@ -1204,13 +1409,13 @@ def parallelize(civicrm, import_function, workers, record_source, parameters=dic
         record_list_lock.acquire()
         record_list_lock.wait()
         try:
-            record_list.append(next(record_source_iterator))
+            record_list.append(next(chunk_source))
         except:
             remaining_records = False
         record_list_lock.release()
 
     for worker in thread_list:
-        if worker.isAlive():
+        if worker.is_alive():
             worker.join()
 
     civicrm.log("Parallelized procedure '%s' completed." % import_function.__name__,
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+This is a python API wrapper for CiviCRM (https://civicrm.org/)
+Copyright (C) 2013 Systopia  (endres@systopia.de)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+__author__      = "Björn Endres"
+__copyright__   = "Copyright 2013, Systopia"
+__license__     = "GPLv3"
+__maintainer__  = "Björn Endres"
+__email__       = "endres[at]systopia.de"
+
+
+import collections.abc
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _default(data):
+    """
+    serialize mappings that aren't dicts, e.g. entity.attributes
+    """
+    if isinstance(data, collections.abc.Mapping):
+        return dict(data)
+    raise TypeError("Object of type %s is not JSON serializable" % type(data).__name__)
+
+
+class StdlibCodec(object):
+    """
+    JSON codec based on python's json module
+
+    loads accepts str or (UTF-8) bytes, dumps returns str.
+    Parse errors raise a ValueError with all codecs.
+    """
+    name = 'json'
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, data):
+        return json.dumps(data, default=_default)
+
+
+class OrjsonCodec(StdlibCodec):
+    name = 'orjson'
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def dumps(self, data):
+        return orjson.dumps(data, default=_default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+
+class UjsonCodec(StdlibCodec):
+    name = 'ujson'
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+    def dumps(self, data):
+        return ujson.dumps(data, default=_default)
+
+
+def getCodec(name=None):
+    """
+    get the codec with the given name ('orjson', 'ujson' or 'json'),
+    or the fastest one installed
+    """
+    available = list()
+    if orjson:
+        available.append(OrjsonCodec)
+    if ujson:
+        available.append(UjsonCodec)
+    available.append(StdlibCodec)
+
+    if name is None:
+        return available[0]()
+    for codec in available:
+        if codec.name == name:
+            return codec()
+    raise ValueError("JSON codec '%s' is not available." % name)
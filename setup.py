@@ -3,9 +3,15 @@ from setuptools import setup
 setup(
     name = 'pycivi',
     packages = ['pycivi'],
+    package_data = {
+        'pycivi': ['drush_server.php'],
+    },
     install_requires = [
         'requests',
         'chardet',
         'charset_normalizer',
     ],
+    extras_require = {
+        'async': ['aiohttp'],
+    },
 )
\ No newline at end of file
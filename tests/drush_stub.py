@@ -0,0 +1,46 @@
+'''
+A stand-in for drush_server.php, speaking the same protocol without
+PHP, drush or CiviCRM: every request is answered with a framed reply.
+
+Special entities simulate misbehaving PHP processes:
+    Fail    an API error reply, like a failing civicrm_api call
+    Notice  a notice without a trailing line break before the reply
+    Hang    no reply at all
+    Exit    the process terminates
+'''
+import json
+import sys
+import time
+
+
+def call(request):
+    entity = request.get('entity')
+    if entity == 'Fail':
+        return {'is_error': 1, 'error_message': 'API (Fail, %s) does not exist' % request.get('action')}
+    elif entity == 'Notice':
+        sys.stdout.write('PHP Notice:  Undefined index: foo in drush_server.php on line 1')
+    elif entity == 'Hang':
+        sys.stdout.flush()
+        time.sleep(60)
+    elif entity == 'Exit':
+        sys.exit(3)
+    return {'is_error': 0, 'count': 1, 'values': [dict(request.get('params', {}), entity=entity)]}
+
+
+def reply(data):
+    data = json.dumps(data)
+    sys.stdout.write('\n#pycivi-reply#%d\n%s\n' % (len(data.encode('utf-8')), data))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        if 'ping' in request:
+            reply({'pong': 1})
+        elif 'calls' in request:
+            reply({'results': [call(single) for single in request['calls']]})
+        else:
+            reply(call(request))
@@ -0,0 +1,249 @@
+'''
+A minimal stand-in for the CiviCRM REST API (v3), serving entities from
+memory, so the REST based implementations can be tested without a site.
+
+    server = StandInServer({'Contact': [{'id': '1', 'external_identifier': 'A'}]})
+    civicrm = CiviCRM_REST(server.url, 'site_key', 'user_key')
+    ...
+    server.stop()
+
+Every request is recorded in server.requests (the raw parameters as
+sent, and the decoded ones). server.handler can be set to a function
+(params) => (status, headers, reply) or None, to simulate errors.
+
+It also emulates the API bridge (see CiviCRM_BRIDGED): 'ApiBridge' create
+returns push and fetch URLs, the calls pushed there are answered after
+server.bridge_polls fetches (default 0, i.e. right away).
+'''
+import datetime
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl
+
+REST_PATH = '/sites/all/modules/civicrm/extern/rest.php'
+BRIDGE_PATH = '/bridge'
+RESERVED = ['entity', 'action', 'api_key', 'key', 'json', 'sequential', 'version', 'options', 'return', 'debug']
+# like API v3, these are answered by legacy code for a single ID (no IN, no paging)
+LEGACY_GET = {'GroupContact': 'contact_id', 'EntityTag': 'entity_id'}
+
+
+class StandInRequest(object):
+    def __init__(self, method, raw, params):
+        self.method = method
+        self.raw = raw          # list of (name, value) as sent
+        self.params = params    # decoded, including the json parameters
+
+
+class StandInServer(object):
+
+    def __init__(self, entities=None):
+        self.entities = entities if entities is not None else dict()
+        self.requests = list()
+        self.handler = None
+        self.lock = threading.Lock()
+        self.bridges = dict()       # bridge_key => {call_id: [polls left, reply]}
+        self.bridge_polls = 0
+        self.bridge_counter = 0
+
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def _reply(self, method, raw):
+                status, headers, reply = server.handle(method, raw, urlparse(self.path).path)
+                body = reply if isinstance(reply, bytes) else json.dumps(reply).encode('utf8')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._reply('GET', parse_qsl(urlparse(self.path).query, keep_blank_values=True))
+
+            def do_POST(self):
+                data = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf8')
+                if urlparse(self.path).path == BRIDGE_PATH:
+                    # the bridge receives the calls as json
+                    self._reply('POST', parse_qsl(urlparse(self.path).query) + [('body', data)])
+                else:
+                    self._reply('POST', parse_qsl(data, keep_blank_values=True))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d%s' % (self.server.server_address[1], REST_PATH)
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def calls(self, entity=None, action=None):
+        """
+        the decoded parameters of the API calls received
+        """
+        return [request.params for request in self.requests if 'entity' in request.params
+                and (entity is None or request.params['entity'] == entity)
+                and (action is None or request.params['action'] == action)]
+
+    def handle(self, method, raw, path):
+        params = dict(raw)
+        if params.get('json', '1') not in ('', '1'):
+            params.update(json.loads(params['json']))
+        with self.lock:
+            self.requests.append(StandInRequest(method, raw, params))
+        if path == BRIDGE_PATH:
+            with self.lock:
+                return self.bridge(params)
+        if path != REST_PATH:
+            return 404, {}, b''
+        if 'entity' not in params:
+            return 200, {}, {'is_error': 1, 'error_message': 'no entity'}
+        if self.handler is not None:
+            reply = self.handler(params)
+            if reply is not None:
+                return reply
+        try:
+            with self.lock:
+                return 200, {}, self.call(params)
+        except Exception as err:
+            return 200, {}, {'is_error': 1, 'error_message': str(err)}
+
+    def bridge(self, params):
+        """
+        the push and fetch endpoints of a bridge
+        """
+        calls = self.bridges.get(params.get('bridge_key'))
+        if calls is None:
+            return 404, {}, b''
+        if 'body' in params:
+            pushed = json.loads(params['body'])
+            if not params.get('batch'):
+                pushed = {params['call_id']: pushed}
+            for call_id, call in pushed.items():
+                try:
+                    reply = self.call(dict(call))
+                except Exception as err:
+                    reply = {'is_error': 1, 'error_message': str(err)}
+                calls[call_id] = [self.bridge_polls, reply]
+            return 200, {}, {'is_error': 0}
+
+        ready = dict()
+        for call_id in params.get('call_ids', params.get('call_id', '')).split(','):
+            if call_id in calls:
+                if calls[call_id][0] > 0:
+                    calls[call_id][0] -= 1
+                else:
+                    ready[call_id] = calls.pop(call_id)[1]
+        if not ready:
+            return 204, {}, b''
+        if 'call_id' in params:
+            return 200, {}, ready[params['call_id']]
+        return 200, {}, ready
+
+    def bridgeApi(self, params):
+        if params['action'].lower() == 'create':
+            self.bridge_counter += 1
+            bridge_key = 'bridge%d' % self.bridge_counter
+            self.bridges[bridge_key] = dict()
+            url = '%s%s?bridge_key=%s' % (self.base_url.rstrip('/'), BRIDGE_PATH, bridge_key)
+            # like CiviCRM, in the server's local time
+            expires = datetime.datetime.now() + datetime.timedelta(hours=1)
+            return {'is_error': 0, 'values': {'bridge_key': bridge_key, 'push_url': url, 'fetch_url': url,
+                                              'expires': expires.strftime('%Y-%m-%d %H:%M:%S')}}
+        elif params['action'].lower() == 'delete':
+            self.bridges.pop(params['bridge_key'], None)
+            return {'is_error': 0, 'values': 1}
+        raise Exception("API (%s, %s) does not exist" % (params['entity'], params['action']))
+
+    def call(self, params):
+        if params['entity'] == 'ApiBridge':
+            return self.bridgeApi(params)
+        rows = self.entities.setdefault(params['entity'], list())
+        action = params['action'].lower()
+        legacy_key = LEGACY_GET.get(params['entity'])
+        if action == 'get' and params.get(legacy_key):
+            if isinstance(params[legacy_key], (dict, list)):
+                raise Exception("DB Error: syntax error")
+            values = [dict(row) for row in rows if _matches(row, dict((key, value) for key, value in params.items() if key != 'id'))]
+            if params['entity'] == 'EntityTag':
+                return {'is_error': 0, 'count': len(values), 'values': dict((row['tag_id'], {'tag_id': row['tag_id']}) for row in values)}
+            return {'is_error': 0, 'count': len(values), 'values': values}
+        if action in ('get', 'getcount'):
+            if params['entity'] == 'Contact':
+                # like CiviCRM: deleted contacts only if asked for, and the ID as contact_id
+                rows = [dict(row, contact_id=row['id'], is_deleted=row.get('is_deleted', '0')) for row in rows]
+                if 'is_deleted' not in params and 'id' not in params:
+                    rows = [row for row in rows if str(row['is_deleted']) != '1']
+            values = [row for row in rows if _matches(row, params)]
+            if action == 'getcount':
+                return {'is_error': 0, 'result': len(values)}
+            options = params.get('options', dict())
+            if isinstance(options, dict):
+                if options.get('sort'):
+                    values.sort(key=lambda row: int(row['id']))
+                offset = int(options.get('offset', 0) or 0)
+                limit = int(options.get('limit', 25))
+                values = values[offset:offset + limit] if limit else values[offset:]
+            else:
+                values = values[:25]
+            values = [dict(row) for row in values]
+            for row in values:
+                for key, chained in params.items():
+                    if key.startswith('api.'):
+                        # chained call, with '$value.<field>' taken from the row
+                        entity, chained_action = key.split('.')[1:3]
+                        calls = chained if isinstance(chained, list) else [chained]
+                        results = list()
+                        for call in calls:
+                            call = dict((name, row.get(value[7:]) if isinstance(value, str) and value.startswith('$value.') else value)
+                                        for name, value in call.items())
+                            results.append(self.call(dict(call, entity=entity, action=chained_action)))
+                        # multiple calls with the same key deliver a list of results
+                        row[key] = results if isinstance(chained, list) else results[0]
+            return {'is_error': 0, 'count': len(values), 'values': values}
+        elif action == 'create':
+            attributes = dict((key, value) for key, value in params.items() if key not in RESERVED)
+            for row in rows:
+                if 'id' in attributes and str(row['id']) == str(attributes['id']):
+                    row.update(attributes)
+                    return {'is_error': 0, 'count': 1, 'id': row['id'], 'values': [dict(row)]}
+            attributes['id'] = str(max([int(row['id']) for row in rows] + [0]) + 1)
+            rows.append(attributes)
+            return {'is_error': 0, 'count': 1, 'id': attributes['id'], 'values': [dict(attributes)]}
+        elif action == 'delete':
+            rows[:] = [row for row in rows if str(row['id']) != str(params['id'])]
+            return {'is_error': 0, 'count': 1, 'values': 1}
+        raise Exception("API (%s, %s) does not exist" % (params['entity'], params['action']))
+
+
+def _matches(row, params):
+    for key, condition in params.items():
+        if key in RESERVED or key.startswith('api.'):
+            continue
+        value = row.get(key)
+        if isinstance(condition, dict):
+            if 'IN' in condition:
+                if str(value).lower() not in [str(item).lower() for item in condition['IN']]:
+                    return False
+            elif '>' in condition:
+                if value is None or int(value) <= int(condition['>']):
+                    return False
+        elif str(value).lower() != str(condition).lower():
+            # MySQL compares case insensitively
+            return False
+    return True
@@ -0,0 +1,89 @@
+import asyncio
+import unittest
+
+try:
+    from pycivi.CiviCRM_ASYNC import CiviCRM_ASYNC
+except ImportError:
+    CiviCRM_ASYNC = None
+
+from standin import StandInServer
+
+
+@unittest.skipIf(CiviCRM_ASYNC is None, "aiohttp is not installed")
+class AsyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer({
+            'Contact': [{'id': '1', 'external_identifier': 'A', 'first_name': 'Anna'},
+                        {'id': '2', 'external_identifier': 'B', 'first_name': 'Bert', 'is_deleted': '1'}],
+            'CustomGroup': [{'id': '1', 'extends': 'Individual'}, {'id': '2', 'extends': 'Contribution'}],
+            'CustomField': [{'id': '10', 'label': 'Source', 'custom_group_id': '1'},
+                            {'id': '20', 'label': 'Source', 'custom_group_id': '2'}],
+        })
+
+    def tearDown(self):
+        self.server.stop()
+
+    def run_async(self, function):
+        async def main():
+            async with CiviCRM_ASYNC(self.server.base_url, 'key', 'api_key', max_in_flight=5) as civicrm:
+                civicrm._logger.setLevel('ERROR')
+                return await function(civicrm)
+        return asyncio.run(main())
+
+    def test_probe_finds_rest_url(self):
+        async def function(civicrm):
+            return civicrm.rest_url
+        self.assertEqual(self.run_async(function), self.server.url)
+
+    def test_get_contact_id(self):
+        async def function(civicrm):
+            return await asyncio.gather(*[civicrm.getContactID({'external_identifier': identifier}) for identifier in ['A', 'B', 'C', 'A']])
+        self.assertEqual(self.run_async(function), ['1', '2', 0, '1'])
+
+    def test_custom_field_by_entity_type(self):
+        async def function(civicrm):
+            return (await civicrm.getCustomFieldID('Source'), await civicrm.getCustomFieldID('Source', 'Contribution'),
+                    await civicrm.getCustomFieldID('Source', 'Membership'))
+        self.assertEqual(self.run_async(function), ('10', '20', 0))
+
+    def test_custom_field_lookups_are_shared(self):
+        async def function(civicrm):
+            # the synchronous custom_field namespace (e.g. preloaded) is not used
+            civicrm.lookup_cache.setComplete('custom_field')
+            return await asyncio.gather(*[civicrm.getCustomFieldID('source') for i in range(3)])
+        self.assertEqual(self.run_async(function), ['10', '10', '10'])
+        self.assertEqual(len(self.server.calls('CustomField', 'get')), 1)
+        self.assertEqual(len(self.server.calls('CustomGroup', 'get')), 1)
+
+    def test_deleted_contact_is_forgotten(self):
+        async def function(civicrm):
+            # e.g. resolved by a synchronous instance sharing the cache
+            civicrm.lookup_cache.set('contact', 'A', '1')
+            await civicrm.deleteEntity(await civicrm.getEntity('Contact', {'external_identifier': 'A'}))
+            return civicrm.lookup_cache.get('contact', 'A')
+        self.assertEqual(self.run_async(function), None)
+
+    def test_create_or_update_stores_changes(self):
+        async def function(civicrm):
+            return await civicrm.createOrUpdate('Contact', {'external_identifier': 'A', 'first_name': 'Anne'})
+        entity = self.run_async(function)
+        self.assertEqual(entity.get('first_name'), 'Anne')
+        self.assertEqual(self.server.entities['Contact'][0]['first_name'], 'Anne')
+
+    def test_store_entity(self):
+        async def function(civicrm):
+            entity = await civicrm.getEntity('Contact', {'external_identifier': 'A'})
+            entity.set('first_name', 'Annie')
+            # the synchronous methods would return coroutines nobody awaits
+            with self.assertRaises(TypeError):
+                entity.store()
+            await civicrm.storeEntity(entity)
+            return entity
+        entity = self.run_async(function)
+        self.assertEqual(entity.getChanges(), {})
+        self.assertEqual(self.server.entities['Contact'][0]['first_name'], 'Annie')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import datetime
+import threading
+import time
+import unittest
+from concurrent.futures import TimeoutError
+
+from pycivi.CiviCRM_REST import CiviCRM_REST
+from pycivi.CiviCRM_BRIDGED import CiviCRM_BRIDGED, CiviAPIException
+
+from standin import StandInServer
+
+
+class BridgeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer({'Contact': [{'id': str(i), 'external_identifier': 'C%d' % i} for i in range(1, 6)]})
+
+    def tearDown(self):
+        self.server.stop()
+
+    def connect(self, **options):
+        instance = CiviCRM_REST(self.server.url, 'key', 'api_key')
+        instance._logger.setLevel('CRITICAL')
+        civicrm = CiviCRM_BRIDGED(instance, options=options)
+        civicrm._logger.setLevel('CRITICAL')
+        civicrm.poll_delay = 0.01
+        self.addCleanup(civicrm.close)
+        return civicrm
+
+    def bridge_requests(self, method, name):
+        return [request for request in self.server.requests
+                if request.method == method and dict(request.raw).get(name) is not None and 'bridge_key' in dict(request.raw)]
+
+    def test_single_calls(self):
+        civicrm = self.connect()
+        self.server.bridge_polls = 2
+        result = civicrm.performAPICall({'entity': 'Contact', 'action': 'get', 'id': '2'})
+        self.assertEqual(result['values'][0]['external_identifier'], 'C2')
+        with self.assertRaises(CiviAPIException):
+            civicrm.performAPICall({'entity': 'Nothing', 'action': 'frobnicate'})
+
+    def test_batch_push_and_fetch(self):
+        civicrm = self.connect(batch=True, batch_size=3)
+        calls = [{'entity': 'Contact', 'action': 'get', 'id': str(i)} for i in range(1, 6)]
+        calls.insert(2, {'entity': 'Nothing', 'action': 'frobnicate'})
+        results = civicrm.performAPICalls(calls)
+        self.assertEqual([result['values'][0]['id'] for result in results if not result.get('is_error')], ['1', '2', '3', '4', '5'])
+        self.assertEqual(results[2]['is_error'], 1)
+        # 6 calls in batches of 3
+        self.assertEqual(len(self.bridge_requests('POST', 'batch')), 2)
+        self.assertEqual(len(self.bridge_requests('GET', 'call_ids')), 2)
+        self.assertEqual(self.bridge_requests('POST', 'call_id'), [])
+
+    def test_gather_times_out(self):
+        civicrm = self.connect()
+        self.server.bridge_polls = 1000
+        futures = civicrm.submitAll([{'entity': 'Contact', 'action': 'get'}] * 2)
+        timestamp = time.time()
+        with self.assertRaises(TimeoutError):
+            civicrm.gather(futures, timeout=0.3)
+        self.assertLess(time.time() - timestamp, 2)
+        # polled with a backoff
+        self.assertLess(len(self.bridge_requests('GET', 'call_id')), 30)
+
+    def test_lease_renewal(self):
+        civicrm = self.connect(renew_lease=True, lease_time=0.5)
+        civicrm.max_exec_time = 0.1
+        self.assertEqual(civicrm.performAPICall({'entity': 'Contact', 'action': 'get', 'id': '1'})['count'], 1)
+        first_bridge = civicrm.bridge
+        deadline = time.time() + 5
+        while first_bridge['bridge_key'] in self.server.bridges and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertIsNot(civicrm.bridge, first_bridge)
+        # the retired bridge had no pending calls, so it's deleted
+        self.assertNotIn(first_bridge['bridge_key'], self.server.bridges)
+        self.assertEqual(civicrm.retired_bridges, [])
+        self.assertEqual(civicrm.performAPICall({'entity': 'Contact', 'action': 'get', 'id': '1'})['count'], 1)
+
+    def test_bridge_is_created_once(self):
+        civicrm = self.connect()
+        creating = threading.Event()
+        proceed = threading.Event()
+        def handler(params):
+            if params.get('entity') == 'ApiBridge' and params.get('action') == 'create':
+                creating.set()
+                proceed.wait(5)
+        self.server.handler = handler
+
+        bridges = list()
+        threads = [threading.Thread(target=lambda: bridges.append(civicrm.getBridge())) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        creating.wait(5)
+        # the lock isn't held while the bridge is created
+        self.assertTrue(civicrm.bridge_lock.acquire(timeout=1))
+        civicrm.bridge_lock.release()
+        proceed.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.server.calls('ApiBridge', 'create')), 1)
+        self.assertTrue(all(bridge is bridges[0] for bridge in bridges))
+
+    def test_expiry_with_timezone(self):
+        civicrm = self.connect()
+        expires = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=-9))) + datetime.timedelta(hours=1)
+        self.assertAlmostEqual(civicrm._getLeaseTime({'expires': expires.isoformat()}), 3600, delta=5)
+        # implausible (e.g. another timezone without offset) isn't taken as expired
+        expires = datetime.datetime.now() - datetime.timedelta(hours=2)
+        self.assertEqual(civicrm._getLeaseTime({'expires': expires.strftime('%Y-%m-%d %H:%M:%S')}), 2 * civicrm.max_exec_time)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import threading
+import unittest
+
+import requests
+
+from pycivi.CiviCRM import CiviCRM
+from pycivi.CiviCRM_REST import CiviCRM_REST
+from pycivi.importer import ConcurrencyController
+
+from standin import StandInServer
+
+
+class Counting(CiviCRM):
+    def performAPICall(self, params=dict(), execParams=dict()):
+        self._countCalls(0.01)
+        return {'is_error': 0, 'count': 0, 'values': []}
+
+
+class ConcurrencyControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.civicrm = Counting()
+        self.civicrm._logger.setLevel('ERROR')
+
+    def test_counters_are_thread_safe(self):
+        def work():
+            for i in range(10000):
+                self.civicrm._countCalls(0.0)
+                self.civicrm._countError()
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        calls, runtime, errors = self.civicrm.getCallStats()
+        self.assertEqual((calls, errors), (80000, 80000))
+
+    def test_initial_limit_and_increase(self):
+        controller = ConcurrencyController(self.civicrm, 20, min_workers=2, interval=0, initial_workers=8, increase=4)
+        self.assertEqual(controller.limit, 8)
+        controller.acquire()
+        self.civicrm.performAPICall()
+        controller.release()
+        self.assertEqual(controller.limit, 12)
+
+    def test_transport_errors_decrease_the_limit(self):
+        server = StandInServer()
+        try:
+            civicrm = CiviCRM_REST(server.url, 'key', 'api_key')
+            civicrm._logger.setLevel('ERROR')
+            controller = ConcurrencyController(civicrm, 20, interval=0, initial_workers=8)
+            civicrm.rest_url = 'http://127.0.0.1:1/rest.php'
+            controller.acquire()
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                civicrm.performAPICall({'entity': 'Contact', 'action': 'get'})
+            controller.release()
+            self.assertEqual(controller.limit, 4)
+        finally:
+            server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+import unittest
+
+from pycivi.CiviCRM_REST import CiviCRM_REST
+
+from standin import StandInServer
+
+
+class ContactIDsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer({'Contact': [
+            {'id': '1', 'external_identifier': 'A'},
+            {'id': '2', 'external_identifier': 'B', 'is_deleted': '1'},
+            {'id': '3', 'external_identifier': 'C', 'is_deleted': '1'},
+            {'id': '4', 'external_identifier': 'C'},
+        ]})
+        self.civicrm = CiviCRM_REST(self.server.url, 'key', 'api_key')
+        self.civicrm._logger.setLevel('ERROR')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_one_query_per_chunk(self):
+        identifiers = ['A', 'B', 'C', 'D'] * 1000
+        contact_ids = self.civicrm.getContactIDs(identifiers, chunk_size=2)
+        self.assertEqual(contact_ids, {'A': '1', 'B': '2', 'C': '4', 'D': 0})
+        self.assertEqual(len(self.server.calls('Contact', 'get')), 2)
+
+    def test_without_deleted(self):
+        contact_ids = self.civicrm.getContactIDs(['A', 'B'], search_deleted=False)
+        self.assertEqual(contact_ids, {'A': '1', 'B': 0})
+
+    def test_created_contact_clears_its_misses(self):
+        self.assertEqual(self.civicrm.getContactID({'external_identifier': 'X'}), 0)
+        self.assertEqual(self.civicrm.getContactID({'external_identifier': 'Y'}), 0)
+        self.civicrm.createEntity('Contact', {'contact_type': 'Individual', 'external_identifier': 'x'})
+        calls = len(self.server.calls('Contact', 'get'))
+        self.assertEqual(self.civicrm.getContactID({'external_identifier': 'X'}), '5')
+        self.assertEqual(self.civicrm.getContactID({'external_identifier': 'Y'}), 0)
+        # only X has been looked up again
+        self.assertEqual(len(self.server.calls('Contact', 'get')), calls + 1)
+
+    def test_deleted_contact_is_forgotten(self):
+        self.civicrm.getContactIDs(['A', 'C'])
+        self.civicrm._contactDeleted('4')
+        self.assertEqual(self.civicrm.lookup_cache.get('contact', self.civicrm._getContactCacheKey({'external_identifier': 'C'}, ['external_identifier'], True)), None)
+        self.assertEqual(self.civicrm.lookup_cache.get('contact', self.civicrm._getContactCacheKey({'external_identifier': 'A'}, ['external_identifier'], True)), '1')
+        self.assertEqual(self.civicrm.lookup_cache.indexes['contact'], {'1': {((('external_identifier', 'A'),), True)}})
+
+
+    def cached(self, identifier):
+        return self.civicrm.lookup_cache.get('contact', self.civicrm._getContactCacheKey({'external_identifier': identifier}, ['external_identifier'], True))
+
+    def test_deleted_and_merged_contacts_are_forgotten(self):
+        self.server.handler = lambda params: (200, {}, {'is_error': 0, 'values': []}) if params['action'] == 'merge' else None
+        self.civicrm.getContactIDs(['A', 'C'])
+        self.civicrm.performAPICall({'entity': 'Contact', 'action': 'delete', 'id': '1'})
+        self.assertEqual(self.cached('A'), None)
+        self.assertEqual(self.cached('C'), '4')
+        self.civicrm.performAPICalls([{'entity': 'Contact', 'action': 'merge', 'to_remove_id': '4', 'to_keep_id': '1'}])
+        self.assertEqual(self.cached('C'), None)
+
+    def test_resolved_contacts_expire(self):
+        clock = [1000.0]
+        self.civicrm.lookup_cache.clock = lambda: clock[0]
+        self.civicrm.getContactIDs(['A'])
+        self.assertEqual(self.cached('A'), '1')
+        clock[0] += 600
+        self.assertEqual(self.cached('A'), None)
+
+
+class EntityStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer({'Contact': [{'id': '1', 'first_name': 'Ann', 'last_name': 'Smith'}]})
+        self.civicrm = CiviCRM_REST(self.server.url, 'key', 'api_key')
+        self.civicrm._logger.setLevel('ERROR')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_direct_writes_are_stored(self):
+        result = self.civicrm.performAPICall({'entity': 'Contact', 'action': 'get', 'id': '1'})
+        entity = self.civicrm._createEntity('Contact', result['values'][0])
+        entity.attributes['first_name'] = 'Anna'
+        entity.attributes['last_name'] = 'Smith'
+        self.assertEqual(entity.getChanges(), {'first_name': 'Anna'})
+        entity.store()
+        self.assertEqual(self.server.entities['Contact'][0]['first_name'], 'Anna')
+        self.assertEqual([dict((key, call[key]) for key in ('id', 'first_name') if key in call) for call in self.server.calls('Contact', 'create')],
+                         [{'id': '1', 'first_name': 'Anna'}])
+        self.assertEqual(entity.getChanges(), {})
+
+
+class IterEntitiesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer({'Contact': [{'id': str(i), 'external_identifier': 'C%d' % i} for i in (9, 2, 10, 4, 1, 7, 3)]})
+        self.civicrm = CiviCRM_REST(self.server.url, 'key', 'api_key')
+        self.civicrm._logger.setLevel('ERROR')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_keyset_paging(self):
+        for prefetch in (False, True):
+            del self.server.requests[:]
+            contacts = list(self.civicrm.iterEntities('Contact', page_size=3, prefetch=prefetch, return_fields=['external_identifier']))
+            self.assertEqual([contact.get('id') for contact in contacts], ['1', '2', '3', '4', '7', '9', '10'])
+            self.assertEqual(contacts[0].get('external_identifier'), 'C1')
+            pages = self.server.calls('Contact', 'get')
+            self.assertEqual([page.get('id') for page in pages], [None, {'>': '3'}, {'>': '9'}])
+            self.assertTrue(all('offset' not in page['options'] for page in pages))
+            self.assertTrue(all('id' in page['return'] for page in pages))
+
+    def test_offset_paging_with_id_filter(self):
+        ids = ['10', '1', '2', '9', '4']
+        contacts = list(self.civicrm.iterEntities('Contact', {'id': {'IN': ids}}, page_size=2, raw=True))
+        self.assertEqual([contact['id'] for contact in contacts], ['1', '2', '4', '9', '10'])
+        pages = self.server.calls('Contact', 'get')
+        self.assertEqual([page['options']['offset'] for page in pages], [0, 2, 4])
+        self.assertTrue(all(page['id'] == {'IN': ids} for page in pages))
+
+
+class ChainTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer({
+            'Contact': [{'id': '1', 'external_identifier': 'A'}, {'id': '2', 'external_identifier': 'B'}],
+            'Email': [{'id': '10', 'contact_id': '1', 'email': 'a@example.org', 'is_primary': '1'},
+                      {'id': '11', 'contact_id': '1', 'email': 'a@example.com', 'is_primary': '0'},
+                      {'id': '12', 'contact_id': '2', 'email': 'b@example.org', 'is_primary': '1'}],
+            'Phone': [{'id': '20', 'contact_id': '1', 'phone': '123'}],
+        })
+        self.civicrm = CiviCRM_REST(self.server.url, 'key', 'api_key')
+        self.civicrm._logger.setLevel('ERROR')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_execute(self):
+        chain = self.civicrm.chain('Contact', 'get', {'external_identifier': 'A',
+                                                      'api.Email.get': [{'contact_id': '$value.id', 'is_primary': 1}]}) \
+                            .then('Email', 'get', {'contact_id': '$value.id'}) \
+                            .then('Phone', 'get', {'contact_id': '$value.id'})
+        for i in range(2):
+            contact, emails, phones = chain.execute()
+            self.assertEqual(contact.entity_type, 'Contact')
+            self.assertEqual(contact.get('id'), '1')
+            self.assertEqual('api.Email.get' in contact.attributes, False)
+            # the result of the call passed in params is skipped
+            self.assertEqual([email.get('id') for email in emails], ['10', '11'])
+            self.assertEqual([phone.get('id') for phone in phones], ['20'])
+        # the query doesn't grow
+        self.assertEqual(len(chain.getQuery()['api.Email.get']), 2)
+        self.assertEqual(len(chain.params['api.Email.get']), 1)
+        self.assertEqual(len(self.server.calls('Contact', 'get')), 2)
+
+    def test_execute_without_result(self):
+        result = self.civicrm.chain('Contact', 'get', {'external_identifier': 'X'}).then('Email', 'get', {'contact_id': '$value.id'}).execute()
+        self.assertEqual(result, [None, []])
+
+
+class GroupMembershipsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.server.handler = lambda params: (200, {}, {'is_error': 0, 'added': len([key for key in params if key.startswith('contact_id.')])})
+        self.civicrm = CiviCRM_REST(self.server.url, 'key', 'api_key')
+        self.civicrm._logger.setLevel('ERROR')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_few_post_variables_per_chunk(self):
+        added = self.civicrm.setGroupMemberships('7', [str(i) for i in range(1, 1501)])
+        self.assertEqual(added, 1500)
+        requests = [request for request in self.server.requests if request.params.get('entity') == 'GroupContact']
+        self.assertEqual(len(requests), 2)
+        for request in requests:
+            # PHP's max_input_vars is 1000
+            self.assertLess(len(request.raw), 10)
+            self.assertEqual(request.params['group_id'], '7')
+
+
+if __name__ == '__main__':
+    unittest.main()
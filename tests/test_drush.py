@@ -0,0 +1,132 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+from pycivi.CiviCRM_DRUSH import CiviCRM_DRUSH, CiviAPIException, DrushProcessError
+
+STUB_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'drush_stub.py')
+
+
+class StubDrush(CiviCRM_DRUSH):
+    """
+    runs tests/drush_stub.py instead of drush_server.php
+    """
+    def _getServerCommand(self):
+        return [sys.executable, STUB_SCRIPT]
+
+
+class DrushProcessTest(unittest.TestCase):
+
+    def connect(self, **kwargs):
+        civicrm = StubDrush(persistent=True, **kwargs)
+        civicrm._logger.setLevel('CRITICAL')
+        self.addCleanup(civicrm.close)
+        return civicrm
+
+    def test_reply(self):
+        civicrm = self.connect()
+        result = civicrm.performAPICall({'entity': 'Contact', 'action': 'get', 'id': 1})
+        self.assertEqual(result['values'], [{'id': 1, 'entity': 'Contact'}])
+
+    def test_notice_without_line_break(self):
+        civicrm = self.connect(timeout=5)
+        result = civicrm.performAPICall({'entity': 'Notice', 'action': 'get'})
+        self.assertEqual(result['values'], [{'entity': 'Notice'}])
+        # the process is still in sync
+        result = civicrm.performAPICall({'entity': 'Contact', 'action': 'get'})
+        self.assertEqual(result['values'], [{'entity': 'Contact'}])
+
+    def test_hung_process_times_out(self):
+        civicrm = self.connect(timeout=0.5)
+        timestamp = time.time()
+        with self.assertRaises(DrushProcessError):
+            civicrm.performAPICall({'entity': 'Hang', 'action': 'get'})
+        self.assertLess(time.time() - timestamp, 10)
+        # the hung process was replaced
+        result = civicrm.performAPICall({'entity': 'Contact', 'action': 'get'})
+        self.assertEqual(result['values'], [{'entity': 'Contact'}])
+
+    def test_deleted_contact_is_forgotten(self):
+        civicrm = self.connect(timeout=5)
+        civicrm.lookup_cache.set('contact', 'A', '1')
+        civicrm.lookup_cache.set('contact', 'B', '2')
+        civicrm.performAPICalls([{'entity': 'Contact', 'action': 'delete', 'id': '1'}])
+        self.assertEqual(civicrm.lookup_cache.get('contact', 'A'), None)
+        self.assertEqual(civicrm.lookup_cache.get('contact', 'B'), '2')
+
+    def test_failing_call_in_batch(self):
+        civicrm = self.connect(timeout=5, batch_size=2)
+        civicrm.lookup_cache.set('contact', 'A', '1')
+        civicrm.lookup_cache.set('contact', 'B', '2')
+        calls = [{'entity': 'Contact', 'action': 'get', 'id': i} for i in range(4)]
+        calls.insert(1, {'entity': 'Fail', 'action': 'delete', 'id': '1'})
+        calls.insert(3, {'entity': 'Contact', 'action': 'delete', 'id': '2'})
+        results = civicrm.performAPICalls(calls)
+        self.assertEqual([result['is_error'] for result in results], [0, 1, 0, 0, 0, 0])
+        self.assertIn('Fail', results[1]['error_message'])
+        self.assertEqual([result['values'][0]['id'] for result in results if not result['is_error']], [0, 1, '2', 2, 3])
+        # the delete after the failing call is still applied to the cache
+        self.assertEqual(civicrm.lookup_cache.get('contact', 'A'), '1')
+        self.assertEqual(civicrm.lookup_cache.get('contact', 'B'), None)
+
+    def test_failing_batch(self):
+        civicrm = self.connect(timeout=5, batch_size=2)
+        calls = [{'entity': 'Contact', 'action': 'get', 'id': i} for i in range(4)]
+        calls.insert(1, {'entity': 'Exit', 'action': 'get'})
+        results = civicrm.performAPICalls(calls)
+        # only the batch drush failed on gets errors
+        self.assertEqual([result['is_error'] for result in results], [1, 1, 0, 0, 0])
+        self.assertEqual([result['values'][0]['id'] for result in results[2:]], [1, 2, 3])
+
+    def test_terminated_process(self):
+        civicrm = self.connect(timeout=5)
+        with self.assertRaises(CiviAPIException):
+            civicrm.performAPICall({'entity': 'Exit', 'action': 'get'})
+        results = civicrm.performAPICalls([{'entity': 'Contact', 'action': 'get', 'id': i} for i in range(3)])
+        self.assertEqual([result['values'][0]['id'] for result in results], [0, 1, 2])
+
+
+class DrushPoolTest(unittest.TestCase):
+
+    def connect(self, **kwargs):
+        civicrm = StubDrush(persistent=True, timeout=5, **kwargs)
+        civicrm._logger.setLevel('CRITICAL')
+        self.addCleanup(civicrm.close)
+        return civicrm
+
+    def test_ping_is_not_counted(self):
+        civicrm = self.connect(max_calls=2, health_check_interval=0)
+        for i in range(3):
+            civicrm.performAPICall({'entity': 'Contact', 'action': 'get'})
+        process = civicrm._pool.acquire()
+        try:
+            self.assertTrue(process.ping())
+            self.assertEqual(process.calls, 1)
+        finally:
+            civicrm._pool.release(process)
+
+    def test_pinned_processes(self):
+        civicrm = self.connect(pool_size=2, pin_threads=True)
+        pool = civicrm._pool
+        running = list()
+        def work():
+            civicrm.performAPICall({'entity': 'Contact', 'action': 'get'})
+            with pool._lock:
+                running.append(len(pool._processes))
+            civicrm.performAPICall({'entity': 'Contact', 'action': 'get'})
+
+        threads = [threading.Thread(target=work) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # never more than pool_size processes, and all stopped with their threads
+        self.assertEqual(len(running), 6)
+        self.assertLessEqual(max(running), 2)
+        self.assertEqual(pool._processes, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
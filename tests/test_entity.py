@@ -0,0 +1,95 @@
+import json
+import unittest
+
+from pycivi import json_codec
+from pycivi.CiviCRM_REST import CiviCRM_REST
+from pycivi.CiviEntity import CiviEntity, CiviContactEntity, ENTITY_CLASSES, registerEntityClass, getEntityClass
+
+from standin import StandInServer
+
+
+class MandateEntity(CiviEntity):
+    __slots__ = ()
+
+    def getReference(self):
+        return self.get('reference')
+
+
+class AttributesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.entity = CiviEntity('Contact', '1', None, {'display_name': 'Jane', 'tags': ['a']})
+
+    def test_copy(self):
+        attributes = self.entity.attributes.copy()
+        self.assertIsInstance(attributes, dict)
+        self.assertEqual(attributes, {'id': '1', 'display_name': 'Jane', 'tags': ['a']})
+        # changing the copy doesn't change the entity
+        attributes['display_name'] = 'John'
+        self.assertEqual(self.entity.get('display_name'), 'Jane')
+        self.assertEqual(self.entity.attributes, {'id': '1', 'display_name': 'Jane', 'tags': ['a']})
+
+    def test_serialization(self):
+        for name in ['json', 'orjson']:
+            if name == 'orjson' and not json_codec.orjson:
+                continue
+            with self.subTest(codec=name):
+                codec = json_codec.getCodec(name)
+                self.assertEqual(json.loads(codec.dumps({'contact': self.entity.attributes})),
+                                 {'contact': {'id': '1', 'display_name': 'Jane', 'tags': ['a']}})
+                with self.assertRaises(TypeError):
+                    codec.dumps(self.entity)
+        self.assertEqual(json.loads(json.dumps(self.entity.attributes.copy()))['display_name'], 'Jane')
+
+    def test_no_instance_dict(self):
+        for entity in [self.entity, CiviContactEntity('Contact', '1', None, {}), MandateEntity('SepaMandate', '1', None, {})]:
+            self.assertFalse(hasattr(entity, '__dict__'))
+
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer({
+            'Contact': [{'id': '1', 'external_identifier': 'A'}, {'id': '2', 'external_identifier': 'A'}],
+            'SepaMandate': [{'id': '7', 'reference': 'M-7'}],
+        })
+        self.civicrm = CiviCRM_REST(self.server.url, 'key', 'api_key')
+        self.civicrm._logger.setLevel('ERROR')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def register(self, entity_type, entity_class):
+        previous = ENTITY_CLASSES.get(entity_type)
+        registerEntityClass(entity_type, entity_class)
+        if previous:
+            self.addCleanup(registerEntityClass, entity_type, previous)
+        else:
+            self.addCleanup(ENTITY_CLASSES.pop, entity_type)
+
+    def test_registered_class(self):
+        self.assertIs(getEntityClass('Contact'), CiviContactEntity)
+        self.assertIs(getEntityClass('SepaMandate'), CiviEntity)
+        self.register('SepaMandate', MandateEntity)
+        self.assertIs(getEntityClass('SepaMandate'), MandateEntity)
+        mandate, = self.civicrm.getEntities('SepaMandate', {'id': '7'})
+        self.assertIsInstance(mandate, MandateEntity)
+        self.assertEqual(mandate.getReference(), 'M-7')
+        self.assertEqual(mandate.civicrm, self.civicrm)
+
+    def test_only_entity_classes(self):
+        with self.assertRaises(TypeError):
+            registerEntityClass('SepaMandate', dict)
+        self.assertNotIn('SepaMandate', ENTITY_CLASSES)
+
+    def test_raw(self):
+        contacts = self.civicrm.getEntities('Contact', {'external_identifier': 'A'})
+        self.assertEqual([type(contact) for contact in contacts], [CiviContactEntity] * 2)
+        contacts = self.civicrm.getEntities('Contact', {'external_identifier': 'A'}, raw=True)
+        self.assertEqual([(type(contact), contact['id']) for contact in contacts], [(dict, '1'), (dict, '2')])
+        mandates = list(self.civicrm.iterEntities('SepaMandate', raw=True))
+        self.assertEqual(mandates, [{'id': '7', 'reference': 'M-7'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import threading
+import unittest
+
+from pycivi.CiviCRM_REST import CiviCRM_REST
+from pycivi import importer
+from pycivi.importer import parallelize
+
+from standin import StandInServer
+
+
+class RelatedIdMapTest(unittest.TestCase):
+
+    def setUp(self):
+        contacts = [{'id': str(i), 'external_identifier': 'C%d' % i} for i in range(1, 8)]
+        contacts[2]['is_deleted'] = '1'
+        self.server = StandInServer({
+            'Contact': contacts,
+            'GroupContact': [{'id': str(i), 'contact_id': str(1 + i % 7), 'group_id': str(10 + i % 3), 'status': 'Added'} for i in range(20)]
+                            + [{'id': '99', 'contact_id': '1', 'group_id': '19', 'status': 'Removed'}],
+            'EntityTag': [{'id': str(i), 'entity_id': str(1 + i % 5), 'entity_table': 'civicrm_contact', 'tag_id': str(20 + i)} for i in range(10)]
+                         + [{'id': '99', 'entity_id': '1', 'entity_table': 'civicrm_activity', 'tag_id': '29'}],
+        })
+        self.civicrm = CiviCRM_REST(self.server.url, 'key', 'api_key')
+        self.civicrm._logger.setLevel('ERROR')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def expected(self, entity, key_field, value_field, **filters):
+        expected = dict((str(i), set()) for i in range(1, 9))
+        for row in self.server.entities[entity]:
+            if all(row[key] == value for key, value in filters.items()):
+                expected[row[key_field]].add(row[value_field])
+        return expected
+
+    def test_groups_of_many_contacts_are_paged(self):
+        group_map = self.civicrm.getContactGroupIdMap([str(i) for i in range(1, 9)], chunk_size=4, page_size=2)
+        self.assertEqual(group_map, self.expected('GroupContact', 'contact_id', 'group_id', status='Added'))
+        # the contacts of each chunk have been fetched page by page
+        pages = self.server.calls('Contact', 'get')
+        self.assertEqual([len(page['id']['IN']) for page in pages], [4, 4, 4, 4, 4])
+        self.assertEqual(self.server.calls('GroupContact', 'get'), [])
+
+    def test_tags_of_many_entities_are_paged(self):
+        tag_map = self.civicrm.getContactTagIdMap([str(i) for i in range(1, 9)], chunk_size=3, page_size=2)
+        self.assertEqual(tag_map, self.expected('EntityTag', 'entity_id', 'tag_id', entity_table='civicrm_contact'))
+
+
+class ParallelizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.civicrm = CiviCRM_REST(self.server.url, 'key', 'api_key')
+        self.civicrm._logger.setLevel('CRITICAL')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def collector(self):
+        chunks = list()
+        lock = threading.Lock()
+        def import_function(civicrm, records, parameters):
+            with lock:
+                chunks.append(list(records))
+            if any(record['id'] == '3' for record in records):
+                raise Exception("failed")
+        return import_function, chunks
+
+    def test_records_are_passed_one_by_one(self):
+        for workers in (1, 3):
+            import_function, chunks = self.collector()
+            parallelize(self.civicrm, import_function, workers, [{'id': str(i)} for i in range(10)], {'chunk_size': 4})
+            # the failing record doesn't take the others with it
+            self.assertEqual(sorted(int(chunk[0]['id']) for chunk in chunks), list(range(10)))
+            self.assertEqual(set(len(chunk) for chunk in chunks), {1})
+
+    def test_bulk_importers_get_chunks(self):
+        for workers in (1, 3):
+            import_function, chunks = self.collector()
+            importer.BULK_IMPORTERS.append(import_function)
+            self.addCleanup(importer.BULK_IMPORTERS.remove, import_function)
+            parallelize(self.civicrm, import_function, workers, [{'id': str(i)} for i in range(10)], {'chunk_size': 4})
+            self.assertEqual(sorted(len(chunk) for chunk in chunks), [2, 4, 4])
+            self.assertEqual(sorted(int(record['id']) for chunk in chunks for record in chunk), list(range(10)))
+
+if __name__ == '__main__':
+    unittest.main()
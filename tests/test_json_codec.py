@@ -0,0 +1,48 @@
+import unittest
+from unittest import mock
+
+from pycivi import json_codec
+
+
+DATA = {'is_error': 0, 'count': 2, 'values': [{'id': '1', 'display_name': 'Jürgen Müller', 'amount': 12.5}, {'id': '2', 'tags': [], 'deleted': None, 'active': True}]}
+
+
+def installed():
+    return [codec.name for codec in (json_codec.OrjsonCodec, json_codec.UjsonCodec)
+            if getattr(json_codec, codec.name)] + ['json']
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for name in installed():
+            with self.subTest(codec=name):
+                codec = json_codec.getCodec(name)
+                self.assertEqual(codec.name, name)
+                encoded = codec.dumps(DATA)
+                self.assertIsInstance(encoded, str)
+                self.assertEqual(codec.loads(encoded), DATA)
+                self.assertEqual(codec.loads(encoded.encode('utf-8')), DATA)
+                # interchangeable with the standard library
+                self.assertEqual(json_codec.StdlibCodec().loads(encoded), DATA)
+
+    def test_parse_errors(self):
+        for name in installed():
+            with self.subTest(codec=name):
+                with self.assertRaises(ValueError):
+                    json_codec.getCodec(name).loads(b'<html>Fatal error</html>')
+
+    def test_fastest_is_default(self):
+        self.assertEqual(json_codec.getCodec().name, installed()[0])
+
+    def test_fallback(self):
+        with mock.patch.object(json_codec, 'orjson', None), mock.patch.object(json_codec, 'ujson', None):
+            self.assertIsInstance(json_codec.getCodec(), json_codec.StdlibCodec)
+            with self.assertRaises(ValueError):
+                json_codec.getCodec('orjson')
+            with self.assertRaises(ValueError):
+                json_codec.getCodec('ujson')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,244 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from pycivi.CiviCRM_REST import CiviCRM_REST
+from pycivi.CiviLookupCache import LookupCache, MISSING
+
+from standin import StandInServer
+
+
+class PreloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer({
+            'LocationType': [{'id': '1', 'name': 'Home'}, {'id': '2', 'name': 'Work'}],
+            'Tag': [{'id': '5', 'name': 'VIP'}, {'id': '6', 'name': 'vip'}, {'id': '7', 'name': 'Donor'}],
+        })
+        self.civicrm = CiviCRM_REST(self.server.url, 'key', 'api_key')
+        self.civicrm._logger.setLevel('ERROR')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_complete_namespace_ignores_case(self):
+        self.civicrm.preload(['location_types'])
+        calls = len(self.server.calls())
+        self.assertEqual(self.civicrm.getLocationTypeID('home'), '1')
+        self.assertEqual(self.civicrm.getLocationTypeID('WORK'), '2')
+        self.assertEqual(self.civicrm.getLocationTypeID('Other'), 0)
+        self.assertEqual(len(self.server.calls()), calls)
+
+    def test_names_differing_in_case_are_duplicates(self):
+        self.civicrm.preload(['tags'])
+        self.assertFalse(self.civicrm.lookup_cache.isComplete('tag'))
+        self.assertEqual(self.civicrm.lookup_cache.get('tag', 'VIP'), None)
+        self.assertEqual(self.civicrm.lookup_cache.get('tag', 'donor'), '7')
+
+    def test_cleared_namespace_is_loaded_again(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'lookup.sqlite')
+        self.civicrm.useLookupStore(path)
+        self.civicrm.preload(['location_types'])
+        self.civicrm.lookup_cache.clear('location_type2id')
+        self.civicrm.lookup_store.close()
+
+        civicrm = CiviCRM_REST(self.server.url, 'key', 'api_key')
+        civicrm._logger.setLevel('ERROR')
+        civicrm.useLookupStore(path)
+        civicrm.preload(['location_types'])
+        self.assertEqual(civicrm.getLocationTypeID('Home'), '1')
+        self.assertEqual(len(self.server.calls('LocationType', 'get')), 2)
+        civicrm.lookup_store.close()
+
+    def test_complete_namespace_expires_with_validation(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.civicrm.useLookupStore(os.path.join(directory, 'lookup.sqlite'))
+        self.addCleanup(self.civicrm.lookup_store.close)
+        self.civicrm.preload(['location_types'], validate_interval=3600)
+        self.assertTrue(self.civicrm.lookup_cache.isComplete('location_type2id'))
+        # the stored table is validated again right away, but only complete until the next validation
+        self.civicrm.preload(['location_types'], validate_interval=0)
+        self.assertEqual(len(self.server.calls('LocationType', 'getcount')), 1)
+        self.assertFalse(self.civicrm.lookup_cache.isComplete('location_type2id'))
+
+    def test_missing_names_are_queried_before_creating(self):
+        self.server.entities['Tag'] = [{'id': '7', 'name': 'Donor'}]
+        self.civicrm.preload(['tags'])
+        self.assertTrue(self.civicrm.lookup_cache.isComplete('tag'))
+        # created by another process
+        self.server.entities['Tag'].append({'id': '8', 'name': 'Member'})
+        self.assertEqual(self.civicrm.getOrCreateTagIDs(['donor', 'member']), {'donor': '7', 'member': '8'})
+        self.assertEqual(self.server.calls('Tag', 'create'), [])
+
+
+class TagsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer({'Tag': [{'id': '5', 'name': 'VIP'}]})
+        self.civicrm = CiviCRM_REST(self.server.url, 'key', 'api_key')
+        self.civicrm._logger.setLevel('ERROR')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_names_are_matched_case_insensitively(self):
+        tag_ids = self.civicrm.getOrCreateTagIDs(['vip', 'Vip', 'Donor', 'donor'])
+        self.assertEqual(tag_ids, {'vip': '5', 'Vip': '5', 'Donor': '6', 'donor': '6'})
+        self.assertEqual(len(self.server.calls('Tag', 'get')), 1)
+        self.assertEqual([call['name'] for call in self.server.calls('Tag', 'create')], ['Donor'])
+        self.assertEqual(self.civicrm.getOrCreateTagID('DONOR'), '6')
+        self.assertEqual(len(self.server.calls('Tag')), 2)
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class LookupCacheTest(unittest.TestCase):
+
+    def test_ttl(self):
+        clock = Clock()
+        cache = LookupCache(ttl=10, clock=clock)
+        cache.set('names', 'a', '1')
+        clock.now += 9.9
+        self.assertEqual(cache.get('names', 'a'), '1')
+        clock.now += 0.1
+        self.assertEqual(cache.get('names', 'a'), None)
+        self.assertEqual(list(cache.namespaces['names']), [])
+
+    def test_negative_ttl(self):
+        clock = Clock()
+        cache = LookupCache(negative_ttl=5, clock=clock)
+        cache.configure('uncached', negative_ttl=0)
+        cache.setMany('names', [('found', '1'), ('missing', 0)])
+        cache.set('uncached', 'missing', 0)
+        self.assertEqual(cache.get('uncached', 'missing', 'default'), 'default')
+        clock.now += 5
+        self.assertEqual(cache.find('names', 'missing'), MISSING)
+        # positive entries don't expire
+        clock.now += 10 ** 6
+        self.assertEqual(cache.get('names', 'found'), '1')
+
+    def test_lru_bound(self):
+        cache = LookupCache(max_size=2)
+        cache.set('names', 'a', '1')
+        cache.set('names', 'b', '2')
+        cache.get('names', 'a')
+        cache.set('names', 'c', '3')
+        # b was the least recently used
+        self.assertEqual(list(cache.namespaces['names']), ['a', 'c'])
+        cache.setComplete('names')
+        cache.set('names', 'd', '4')
+        # with entries evicted, the namespace isn't complete anymore
+        self.assertFalse(cache.isComplete('names'))
+
+    def test_complete_expires(self):
+        clock = Clock()
+        cache = LookupCache(ttl=60, clock=clock)
+        cache.setComplete('names', ttl=10)
+        self.assertEqual(cache.find('names', 'x'), 0)
+        clock.now += 10
+        self.assertEqual(cache.find('names', 'x'), MISSING)
+
+    def run_flight(self, cache, loader, followers=3):
+        """
+        run a lookup of loader, and the followers joining it while it's loading
+        """
+        started = threading.Event()
+        proceed = threading.Event()
+        def load():
+            started.set()
+            proceed.wait(5)
+            return loader()
+
+        outcomes = list()
+        def lookup(function):
+            try:
+                outcomes.append(cache.lookup('names', 'a', function))
+            except Exception as err:
+                outcomes.append(err)
+        leader = threading.Thread(target=lookup, args=(load,))
+        leader.start()
+        started.wait(5)
+        threads = [threading.Thread(target=lookup, args=(lambda: 'not called',)) for i in range(followers)]
+        for thread in threads:
+            thread.start()
+        # give the followers the time to join the flight
+        time.sleep(0.1)
+        proceed.set()
+        for thread in [leader] + threads:
+            thread.join()
+        return outcomes
+
+    def test_single_flight(self):
+        cache = LookupCache()
+        calls = list()
+        def loader():
+            calls.append(1)
+            return '1'
+        self.assertEqual(self.run_flight(cache, loader), ['1'] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.flights, dict())
+
+    def test_failed_flight(self):
+        cache = LookupCache()
+        error = ValueError("API down")
+        def loader():
+            raise error
+        outcomes = self.run_flight(cache, loader)
+        # everybody gets the exception, nobody a stale MISSING or None
+        self.assertEqual(len(outcomes), 4)
+        self.assertTrue(all(outcome is error for outcome in outcomes))
+        self.assertEqual(cache.flights, dict())
+        self.assertEqual(cache.find('names', 'a'), MISSING)
+        # the next lookup loads again
+        self.assertEqual(cache.lookup('names', 'a', lambda: '2'), '2')
+
+    def test_casefold(self):
+        cache = LookupCache()
+        cache.configure('names', casefold=True)
+        cache.set('names', ('1', 'Straße'), 'a')
+        cache.set('other', 'Key', 'b')
+        self.assertEqual(cache.get('names', ('1', 'STRASSE')), 'a')
+        self.assertEqual(cache.get('other', 'key'), None)
+        self.assertEqual(cache.lookup('names', ('1', 'strasse'), lambda: 'c'), 'a')
+
+    def test_clear_keeps_persistent_entries(self):
+        class Store(object):
+            cleared = list()
+            def load(self):
+                return []
+            def clear(self, namespace=None):
+                self.cleared.append(namespace)
+        cache = LookupCache()
+        cache.configure('transient', persistent=False)
+        cache.attachStore(Store())
+        cache.clear('transient')
+        cache.clear('names')
+        self.assertEqual(Store.cleared, ['names'])
+
+    def test_value_index(self):
+        cache = LookupCache()
+        cache.configure('contact', max_size=3, index_values=True)
+        cache.setMany('contact', [('a', '1'), ('b', '2'), ('c', '1')])
+        cache.set('contact', 'b', '1')
+        cache.set('contact', 'd', '3')
+        # 'a' has been evicted
+        self.assertEqual(cache.indexes['contact'], {'1': {'b', 'c'}, '3': {'d'}})
+        cache.discardValue('contact', '1')
+        self.assertEqual(list(cache.namespaces['contact']), ['d'])
+        self.assertEqual(cache.indexes['contact'], {'3': {'d'}})
+
+
+if __name__ == '__main__':
+    unittest.main()
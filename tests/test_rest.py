@@ -0,0 +1,169 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from pycivi.CiviCRM_REST import CiviCRM_REST, CiviAPIException, RetryPolicy, CircuitBreaker
+
+from standin import StandInServer
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer({'Contact': [{'id': '1', 'external_identifier': 'A'}]})
+
+    def tearDown(self):
+        self.server.stop()
+
+    def connect(self, policy):
+        civicrm = CiviCRM_REST(self.server.url, 'key', 'api_key', retry_policy=policy)
+        civicrm._logger.setLevel('ERROR')
+        return civicrm
+
+    def test_retry_after_with_jitter(self):
+        policy = RetryPolicy(retakes=3, base_delay=1.0, max_delay=10.0)
+        delays = set(policy.getDelay(1, retry_after=2.0) for i in range(20))
+        self.assertTrue(all(2.0 <= delay <= 4.0 for delay in delays))
+        self.assertGreater(len(delays), 1)
+
+    def test_server_errors_are_retried(self):
+        failures = [2]
+        def handler(params):
+            if failures[0]:
+                failures[0] -= 1
+                return 503, {'Retry-After': '0'}, b''
+        civicrm = self.connect(RetryPolicy(retakes=3, base_delay=0.01))
+        self.server.handler = handler
+        result = civicrm.performAPICall({'entity': 'Contact', 'action': 'get'})
+        self.assertEqual(result['count'], 1)
+        self.assertEqual(len(self.server.calls('Contact')), 3)
+
+    def test_transport_errors_are_retried_and_counted(self):
+        breaker = CircuitBreaker(threshold=0.5, window=4, min_calls=2, pause=0.2)
+        civicrm = self.connect(RetryPolicy(retakes=2, base_delay=0.01, circuit_breaker=breaker))
+        transport = civicrm._getTransport()
+        send = transport.request
+        failures = [2]
+        def request(*args, **kwargs):
+            if failures[0]:
+                failures[0] -= 1
+                raise requests.exceptions.ConnectionError("connection reset")
+            return send(*args, **kwargs)
+        transport.request = request
+
+        timestamp = time.time()
+        result = civicrm.performAPICall({'entity': 'Contact', 'action': 'get'})
+        self.assertEqual(result['count'], 1)
+        # two failures out of two calls tripped the breaker
+        self.assertGreaterEqual(time.time() - timestamp, 0.2)
+
+    def failing_transport(self, civicrm, error, failures):
+        transport = civicrm._getTransport()
+        send = transport.request
+        failures = [failures]
+        def request(*args, **kwargs):
+            if failures[0]:
+                failures[0] -= 1
+                raise error
+            return send(*args, **kwargs)
+        transport.request = request
+
+    def test_writes_are_not_replayed(self):
+        civicrm = self.connect(RetryPolicy(retakes=2, base_delay=0.01))
+        self.failing_transport(civicrm, requests.exceptions.ReadTimeout("read timed out"), 1)
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            civicrm.performAPICall({'entity': 'Contact', 'action': 'create', 'external_identifier': 'B'})
+        # reads are
+        self.failing_transport(civicrm, requests.exceptions.ReadTimeout("read timed out"), 1)
+        self.assertEqual(civicrm.performAPICall({'entity': 'Contact', 'action': 'get'})['count'], 1)
+
+    def test_writes_not_sent_are_retried(self):
+        civicrm = self.connect(RetryPolicy(retakes=2, base_delay=0.01))
+        refused = NewConnectionError(None, "Connection refused")
+        self.failing_transport(civicrm, requests.exceptions.ConnectionError(MaxRetryError(None, self.server.url, refused)), 1)
+        result = civicrm.performAPICall({'entity': 'Contact', 'action': 'create', 'external_identifier': 'B'})
+        self.assertEqual(result['id'], '2')
+        self.assertEqual(len(self.server.calls('Contact', 'create')), 1)
+
+
+class GetLengthTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer({'Contact': [{'id': str(i), 'external_identifier': 'C%d' % i} for i in range(1, 4)]})
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_long_queries_are_posted(self):
+        civicrm = CiviCRM_REST(self.server.url, 'key', 'api_key', max_get_length=500)
+        civicrm._logger.setLevel('ERROR')
+        short_query = {'entity': 'Contact', 'action': 'get', 'id': '1'}
+        long_query = {'entity': 'Contact', 'action': 'get', 'external_identifier': {'IN': ['C1', 'C2'] + ['X%d' % i for i in range(100)]}}
+        self.assertEqual(civicrm.performAPICall(short_query)['count'], 1)
+        self.assertEqual(civicrm.performAPICall(long_query, {'json_parameters': True})['count'], 2)
+        self.assertEqual([request.method for request in self.server.requests if 'entity' in request.params], ['GET', 'POST'])
+
+        # without a limit, everything is sent as GET
+        civicrm.max_get_length = None
+        self.assertEqual(civicrm.performAPICall(long_query, {'json_parameters': True})['count'], 2)
+        self.assertEqual(self.server.requests[-1].method, 'GET')
+
+
+class EndpointCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer({'Contact': [{'id': '1', 'external_identifier': 'A'}]})
+        self.directory = tempfile.mkdtemp()
+        self.cache = os.path.join(self.directory, 'endpoints.json')
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def test_stale_endpoint_is_probed_again(self):
+        base_url = self.server.base_url.rstrip('/')
+        with open(self.cache, 'w') as cache_file:
+            json.dump({base_url: base_url + '/moved/extern/rest.php', 'http://other': 'http://other/rest.php'}, cache_file)
+        civicrm = CiviCRM_REST(self.server.base_url, 'key', 'api_key', endpoint_cache=self.cache)
+        civicrm._logger.setLevel('CRITICAL')
+        self.assertTrue(civicrm.rest_url.endswith('/moved/extern/rest.php'))
+
+        # the call hitting the stale endpoint fails, the next one probes again
+        with self.assertRaises(CiviAPIException):
+            civicrm.performAPICall({'entity': 'Contact', 'action': 'get'})
+        result = civicrm.performAPICall({'entity': 'Contact', 'action': 'get'})
+        self.assertEqual(result['count'], 1)
+        self.assertEqual(civicrm.rest_url, self.server.url)
+        with open(self.cache) as cache_file:
+            self.assertEqual(json.load(cache_file), {base_url: self.server.url, 'http://other': 'http://other/rest.php'})
+
+    def test_transport_errors_keep_the_endpoint(self):
+        civicrm = CiviCRM_REST(self.server.base_url, 'key', 'api_key', endpoint_cache=self.cache,
+                               retry_policy=RetryPolicy(retakes=2, base_delay=0.01))
+        civicrm._logger.setLevel('CRITICAL')
+        transport = civicrm._getTransport()
+        send = transport.request
+        failures = [1]
+        def request(*args, **kwargs):
+            if failures[0]:
+                failures[0] -= 1
+                raise requests.exceptions.ConnectionError("connection reset")
+            return send(*args, **kwargs)
+        transport.request = request
+
+        probes = len(self.server.requests)
+        result = civicrm.performAPICall({'entity': 'Contact', 'action': 'get'})
+        self.assertEqual(result['count'], 1)
+        self.assertFalse(civicrm._endpoint_stale)
+        # retried right away, without probing
+        self.assertEqual(len(self.server.requests), probes + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()